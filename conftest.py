@@ -76,9 +76,11 @@ def cache_isolation() -> Iterator[None]:
     """Keep timetable cache state local to the requesting test."""
     caches["default"].clear()
     caches["disk"].clear()
+    caches["local"].clear()
     yield
     caches["default"].clear()
     caches["disk"].clear()
+    caches["local"].clear()
 
 
 @pytest.fixture
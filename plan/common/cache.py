@@ -1,29 +1,249 @@
 import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from concurrent import futures
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import Generic, TypeVar
 
+from django.conf import settings
 from django.core.cache import caches
+from django.db import connections
 from opentelemetry import trace
-from opentelemetry.trace import SpanKind
+from opentelemetry.trace import Link, SpanContext, SpanKind
 
 T = TypeVar("T")
 _MISSING = object()
 logger = logging.getLogger(__name__)
 tracer = trace.get_tracer(__name__)
 
+# How long a worker may hold the lease on a key it is recomputing, and how long
+# others wait for it before computing the value themselves.
+LEASE_TIMEOUT = 30
+LEASE_WAIT = 2.0
+LEASE_POLL = 0.05
+
+# Alias of the in-process cache, which other processes never see.
+LOCAL_ALIAS = "local"
+
+_key_locks: dict[str, list] = {}
+_key_locks_guard = threading.Lock()
+
+_REVALIDATE_WORKERS = 2
+_MAX_PENDING_REVALIDATIONS = 256
+
+_revalidations: dict[str, futures.Future] = {}
+_revalidations_guard = threading.Lock()
+_revalidate_pool: futures.ThreadPoolExecutor | None = None
+
+_flights: dict[str, futures.Future] = {}
+_flights_guard = threading.Lock()
+
+
+@contextmanager
+def _key_lock(key: str, timeout: float) -> Iterator[tuple[bool, bool]]:
+    """Hold the in-process lock for ``key``, yielding (acquired, contended)."""
+    with _key_locks_guard:
+        entry = _key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    lock = entry[0]
+    try:
+        contended = not lock.acquire(blocking=False)
+        acquired = not contended or lock.acquire(timeout=timeout)
+        try:
+            yield acquired, contended
+        finally:
+            if acquired:
+                lock.release()
+    finally:
+        with _key_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _key_locks[key]
+
+
+def local_layer() -> dict[str, int]:
+    """The in-process ``local`` layer to put in front of a MultiCache, if enabled.
+
+    Meant for small values that are read on most requests and keyed by
+    version, as deletes do not reach other processes.
+    """
+    ttl = settings.TIMETABLE_LOCAL_CACHE_TTL
+    return {} if ttl is None else {LOCAL_ALIAS: ttl}
+
+
+def _get_revalidate_pool() -> futures.ThreadPoolExecutor:
+    global _revalidate_pool
+    with _revalidations_guard:
+        if _revalidate_pool is None:
+            _revalidate_pool = futures.ThreadPoolExecutor(
+                max_workers=_REVALIDATE_WORKERS,
+                thread_name_prefix="cache-revalidate",
+            )
+        return _revalidate_pool
+
+
+def flush_for_tests() -> None:
+    with _revalidations_guard:
+        pending = list(_revalidations.values())
+    futures.wait(pending)
+
+
+def single_flight[T](
+    key: str, compute: Callable[[], T], wait: float = LEASE_WAIT
+) -> tuple[T, bool]:
+    """Value of ``compute``, shared by callers in this process with the same key.
+
+    The first caller computes the value while concurrent callers wait up to
+    ``wait`` seconds for it, and compute it themselves after that. Nothing is
+    kept once the first caller is done, this only coalesces concurrent calls.
+    Returns the value and whether this caller computed it.
+    """
+    with _flights_guard:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = futures.Future()
+
+    if not leader:
+        try:
+            return flight.result(timeout=wait), False
+        except futures.TimeoutError:
+            return compute(), True
+
+    try:
+        value = compute()
+    except BaseException as e:
+        flight.set_exception(e)
+        raise
+    else:
+        flight.set_result(value)
+        return value, True
+    finally:
+        with _flights_guard:
+            del _flights[key]
+
 
 @dataclass(frozen=True)
 class CacheResult(Generic[T]):
     hit: bool
     value: T | None = None
+    stale: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class _Entry:
+    """Cached value with its soft expiry, the layer TTL is the hard one."""
+
+    value: object
+    fresh_until: float
+
+
+def _hit(value) -> CacheResult:
+    if isinstance(value, _Entry):
+        return CacheResult(
+            hit=True, value=value.value, stale=value.fresh_until <= time.time()
+        )
+    return CacheResult(hit=True, value=value)
+
+
+def get_many(lookups: Sequence[tuple["MultiCache", str]]) -> list[CacheResult]:
+    """Look up ``(cache, key)`` pairs with one ``get_many`` per layer.
+
+    Layers are walked in order like :meth:`MultiCache.get`, but keys of every
+    cache that reads the same layer at that depth are fetched together, so the
+    snapshot and semester freshness lookups share one round trip. Hits are
+    promoted to the layers that missed them with one ``set_many`` per layer
+    and TTL.
+    """
+    results = [CacheResult(hit=False)] * len(lookups)
+    missed: list[list[tuple[str, int | None]]] = [[] for _lookup in lookups]
+    pending = list(range(len(lookups)))
+    attributes = {
+        "cache.layers": sorted({n for c, _k in lookups for n, _t in c.layers}),
+        "cache.key.count": len(lookups),
+    }
+    with tracer.start_as_current_span(
+        "MULTI CACHE GET MANY", kind=SpanKind.CLIENT, attributes=attributes
+    ) as span:
+        promotions: dict[tuple[str, int | None], tuple[object, dict]] = {}
+        depth = 0
+        while pending:
+            by_layer: dict[str, list[int]] = {}
+            for index in pending:
+                cache, _key = lookups[index]
+                if depth < len(cache.layers):
+                    by_layer.setdefault(cache.layers[depth][0], []).append(index)
+
+            pending = []
+            for name, indexes in by_layer.items():
+                backend = lookups[indexes[0]][0].backends[name]
+                try:
+                    found = backend.get_many({lookups[i][1] for i in indexes})
+                except Exception:
+                    logger.exception(
+                        "MultiCache backend get_many failed",
+                        extra={"cache_layer": name},
+                    )
+                    found = {}
+
+                for index in indexes:
+                    cache, key = lookups[index]
+                    if key not in found:
+                        missed[index].append(cache.layers[depth])
+                        pending.append(index)
+                        continue
+
+                    results[index] = _hit(found[key])
+                    for missed_name, missed_ttl in missed[index]:
+                        _backend, values = promotions.setdefault(
+                            (missed_name, missed_ttl),
+                            (cache.backends[missed_name], {}),
+                        )
+                        values[key] = found[key]
+            depth += 1
+
+        for (name, ttl), (backend, values) in promotions.items():
+            try:
+                backend.set_many(values, ttl)
+            except Exception:
+                logger.exception(
+                    "MultiCache backend promotion set_many failed",
+                    extra={"cache_layer": name},
+                )
+
+        span.set_attribute("cache.hit.count", sum(r.hit for r in results))
+        span.set_attribute("cache.miss.count", sum(not r.hit for r in results))
+        span.set_attribute(
+            "cache.promoted.count", sum(len(v) for _b, v in promotions.values())
+        )
+        span.set_attribute("cache.stale.count", sum(r.stale for r in results))
+    return results
 
 
 class MultiCache(Generic[T]):
-    def __init__(self, **layers: int | None) -> None:
+    def __init__(
+        self, *, revalidate_after: int | None = None, **layers: int | None
+    ) -> None:
+        """Cache reading ``layers`` in order, with their TTLs as values.
+
+        With ``revalidate_after`` set, values older than that many seconds are
+        still returned until the layer TTL expires, but flagged as stale so
+        :meth:`get_or_compute` can refresh them in the background.
+        """
         if not layers:
             raise ValueError("MultiCache needs at least one layer")
 
+        self.revalidate_after = revalidate_after
         self.layers = tuple(layers.items())
+        # Leases must be seen by other processes, so skip the in-process layer.
+        self.lease_layer = next(
+            (name for name, _ttl in self.layers if name != LOCAL_ALIAS),
+            self.layers[0][0],
+        )
         self.backends = {}
         for name, _ttl in self.layers:
             try:
@@ -65,11 +285,13 @@ class MultiCache(Generic[T]):
                                 extra={"cache_layer": missed_name},
                             )
 
+                    result = _hit(value)
                     span.set_attribute("cache.hit", True)
                     span.set_attribute("cache.hit.layer", name)
                     span.set_attribute("cache.miss.count", len(missed))
                     span.set_attribute("cache.promoted", promoted)
-                    return CacheResult(hit=True, value=value)
+                    span.set_attribute("cache.stale", result.stale)
+                    return result
 
                 missed.append((name, ttl))
 
@@ -78,10 +300,192 @@ class MultiCache(Generic[T]):
             span.set_attribute("cache.promoted", False)
             return CacheResult(hit=False)
 
+    def get_many(self, keys: Iterable[str]) -> dict[str, CacheResult[T]]:
+        keys = list(keys)
+        return dict(zip(keys, get_many([(self, key) for key in keys])))
+
     def set(self, key: str, value: T) -> None:
+        if self.revalidate_after is not None:
+            value = _Entry(value, time.time() + self.revalidate_after)
         for name, ttl in self.layers:
             self.backends[name].set(key, value, ttl)
 
+    def set_many(self, values: Mapping[str, T]) -> None:
+        if not values:
+            return
+        if self.revalidate_after is not None:
+            fresh_until = time.time() + self.revalidate_after
+            values = {key: _Entry(value, fresh_until) for key, value in values.items()}
+        for name, ttl in self.layers:
+            self.backends[name].set_many(values, ttl)
+
     def delete(self, key: str) -> None:
         for name, _ttl in self.layers:
             self.backends[name].delete(key)
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], T],
+        *,
+        lease_timeout: int = LEASE_TIMEOUT,
+        wait: float = LEASE_WAIT,
+    ) -> T:
+        """Cached value of ``key``, calling ``compute`` and storing it on a miss.
+
+        Only one caller rebuilds a missing key at a time: threads in this
+        process share a lock and processes share a lease taken with ``add()``
+        on the first layer that is not process-local. Everyone else polls the
+        cache for up to ``wait`` seconds and then computes the value without
+        the lease, so a slow or crashed lease holder never blocks requests for
+        long. Stale values are returned as is while :meth:`revalidate`
+        refreshes them.
+        """
+        result = self.get(key)
+        if result.hit:
+            if result.stale:
+                self.revalidate(key, compute)
+            return result.value
+
+        attributes = {
+            "cache.layers": [name for name, _ttl in self.layers],
+            "cache.key": key,
+        }
+        with tracer.start_as_current_span(
+            "MULTI CACHE COMPUTE", kind=SpanKind.CLIENT, attributes=attributes
+        ) as span:
+            deadline = time.monotonic() + wait
+            with _key_lock(key, wait) as (acquired, contended):
+                span.set_attribute("cache.lock.contended", contended)
+                span.set_attribute("cache.lock.acquired", acquired)
+                if contended:
+                    result = self.get(key)
+                    if result.hit:
+                        span.set_attribute("cache.computed", False)
+                        return result.value
+
+                lease_key = f"lease:{key}"
+                token = uuid.uuid4().hex
+                leased = self._add_lease(lease_key, token, lease_timeout)
+                span.set_attribute("cache.lease.acquired", leased)
+                if not leased:
+                    result = self._wait_for(key, lease_key, deadline)
+                    span.set_attribute("cache.lease.waited", True)
+                    if result.hit:
+                        span.set_attribute("cache.computed", False)
+                        return result.value
+
+                try:
+                    value = compute()
+                    self.set(key, value)
+                finally:
+                    if leased:
+                        self._release_lease(lease_key, token)
+
+            span.set_attribute("cache.computed", True)
+            return value
+
+    def _add_lease(self, lease_key: str, token: str, timeout: int) -> bool:
+        name = self.lease_layer
+        try:
+            return self.backends[name].add(lease_key, token, timeout)
+        except Exception:
+            logger.exception(
+                "MultiCache lease add failed",
+                extra={"cache_layer": name},
+            )
+            return True
+
+    def _release_lease(self, lease_key: str, token: str) -> None:
+        name = self.lease_layer
+        backend = self.backends[name]
+        try:
+            if backend.get(lease_key) == token:
+                backend.delete(lease_key)
+        except Exception:
+            logger.exception(
+                "MultiCache lease release failed",
+                extra={"cache_layer": name},
+            )
+
+    def _wait_for(self, key: str, lease_key: str, deadline: float) -> CacheResult[T]:
+        name = self.lease_layer
+        while time.monotonic() < deadline:
+            time.sleep(LEASE_POLL)
+            result = self.get(key)
+            if result.hit:
+                return result
+            if self.backends[name].get(lease_key) is None:
+                # The lease holder gave up without storing a value.
+                break
+        return CacheResult(hit=False)
+
+    def revalidate(self, key: str, compute: Callable[[], T]) -> bool:
+        """Recompute and store ``key`` on a background worker.
+
+        Only one refresh per key is queued in a process, and only the worker
+        that gets the lease recomputes the key. Returns False when the refresh
+        was not queued.
+        """
+        with _revalidations_guard:
+            if key in _revalidations:
+                return False
+            if len(_revalidations) >= _MAX_PENDING_REVALIDATIONS:
+                logger.warning(
+                    "dropping cache revalidation due to full queue",
+                    extra={"key": key},
+                )
+                return False
+            placeholder = _revalidations[key] = futures.Future()
+
+        source = trace.get_current_span().get_span_context()
+        try:
+            future = _get_revalidate_pool().submit(
+                self._revalidate, key, compute, source
+            )
+        except RuntimeError:
+            with _revalidations_guard:
+                del _revalidations[key]
+            placeholder.set_result(None)
+            return False
+
+        # flush_for_tests() may already be waiting on the placeholder.
+        future.add_done_callback(lambda _future: placeholder.set_result(None))
+        with _revalidations_guard:
+            # The refresh may already be done and have removed the placeholder.
+            if _revalidations.get(key) is placeholder:
+                _revalidations[key] = future
+        return True
+
+    def _revalidate(
+        self, key: str, compute: Callable[[], T], source: SpanContext
+    ) -> None:
+        links = [Link(source)] if source.is_valid else []
+        attributes = {
+            "cache.layers": [name for name, _ttl in self.layers],
+            "cache.key": key,
+        }
+        # Like the ical cache writer this runs after the request, so link to it
+        # instead of extending the request trace.
+        with tracer.start_as_current_span(
+            "MULTI CACHE REVALIDATE", links=links, attributes=attributes
+        ) as span:
+            lease_key = f"lease:{key}"
+            token = uuid.uuid4().hex
+            try:
+                leased = self._add_lease(lease_key, token, LEASE_TIMEOUT)
+                span.set_attribute("cache.lease.acquired", leased)
+                if leased:
+                    try:
+                        self.set(key, compute())
+                    finally:
+                        self._release_lease(lease_key, token)
+            except Exception:
+                logger.exception(
+                    "MultiCache revalidation failed",
+                    extra={"key": key},
+                )
+            finally:
+                with _revalidations_guard:
+                    _revalidations.pop(key, None)
+                connections.close_all()
@@ -0,0 +1,208 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+import copy
+import itertools
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, replace
+
+from django.conf import settings
+
+from plan.common.cache import MultiCache
+from plan.common.lecture_data import CatalogLecture
+from plan.common.managers import StudentScheduleRows
+from plan.common.models import Course, Exam, Lecture, Semester, Subscription
+
+
+@dataclass(frozen=True, slots=True)
+class CourseCatalog:
+    """Course, exams and lectures shared by every subscriber of a course.
+
+    Cached values are shared between students and must not be modified;
+    per-student aliases go on copies.
+    """
+
+    course: Course
+    exams: tuple[Exam, ...]
+    lectures: tuple[CatalogLecture, ...]
+
+
+def course_catalog_cache_key(semester: Semester, course_id: int) -> str:
+    return f"catalog:v1:{semester.id}-{semester.version}:{course_id}"
+
+
+def _course_catalog_cache() -> MultiCache[CourseCatalog]:
+    return MultiCache[CourseCatalog](
+        default=settings.TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL
+    )
+
+
+def _load_course_catalogs(course_ids: list[int]) -> dict[int, CourseCatalog]:
+    courses = Course.objects.in_bulk(course_ids)
+    exams = {course_id: [] for course_id in courses}
+    for exam in (
+        Exam.objects.filter(course_id__in=list(courses))
+        .select_related("type")
+        .order_by("handout_date", "handout_time", "exam_date", "exam_time", "id")
+    ):
+        exam.course = courses[exam.course_id]
+        exams[exam.course_id].append(exam)
+    lectures = Lecture.objects.get_catalog_lectures(list(courses))
+
+    return {
+        course_id: CourseCatalog(
+            course=course,
+            exams=tuple(exams[course_id]),
+            lectures=tuple(lectures[course_id]),
+        )
+        for course_id, course in courses.items()
+    }
+
+
+def get_course_catalogs(
+    semester: Semester, course_ids: list[int]
+) -> dict[int, CourseCatalog]:
+    """Catalogs for ``course_ids``, loading all cache misses in one go.
+
+    Catalogs are keyed by the semester version, so they are shared by every
+    student until the next scrape of the semester.
+    """
+    cache = _course_catalog_cache()
+    keys = {
+        course_id: course_catalog_cache_key(semester, course_id)
+        for course_id in course_ids
+    }
+    results = cache.get_many(keys.values())
+    catalogs = {}
+    missing = []
+    for course_id, key in keys.items():
+        result = results[key]
+        if result.hit and result.value is not None:
+            catalogs[course_id] = result.value
+        else:
+            missing.append(course_id)
+
+    if missing:
+        loaded = _load_course_catalogs(missing)
+        cache.set_many(
+            {keys[course_id]: catalog for course_id, catalog in loaded.items()}
+        )
+        catalogs.update(loaded)
+
+    return catalogs
+
+
+def _exam_order(exam: Exam):
+    # Same order as the database gives, with missing values last.
+    values = (exam.handout_date, exam.handout_time, exam.exam_date, exam.exam_time)
+    return tuple((value is None, value) for value in values) + (exam.id,)
+
+
+def get_schedule_rows(semester: Semester, student_id: int) -> StudentScheduleRows:
+    """Schedule data for a student, joined from shared course catalogs.
+
+    Only the student's subscriptions, chosen groups and excluded lectures are
+    read from the database. Lectures without an alias or exclude are shared
+    with the catalog as-is. Falls back to a single query when
+    ``TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL`` is ``None``.
+    """
+    if settings.TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL is None:
+        return Lecture.objects.get_schedule_rows(semester.id, student_id)
+
+    subscriptions = Subscription.objects.get_schedule_subscriptions(
+        semester.id, student_id
+    )
+    catalogs = get_course_catalogs(
+        semester, [subscription["course_id"] for subscription in subscriptions]
+    )
+    return _join_schedule_rows(catalogs, subscriptions)
+
+
+def iter_schedule_rows(
+    semester: Semester, student_ids: Iterable[int], chunk_size: int = 500
+) -> Iterator[tuple[int, StudentScheduleRows]]:
+    """Yield ``(student_id, rows)`` for many students, ordered by student id.
+
+    Meant for batch jobs: subscriptions are streamed from one query and the
+    catalogs for each chunk of ``chunk_size`` students are looked up together,
+    so memory use does not grow with the number of students. Rows are the
+    same as :func:`get_schedule_rows` returns, including empty rows for
+    students without subscriptions.
+    """
+    student_ids = sorted(set(student_ids))
+    if settings.TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL is None:
+        yield from Lecture.objects.iter_schedule_rows(semester.id, student_ids)
+        return
+
+    remaining = iter(student_ids)
+    subscriptions = Subscription.objects.iter_schedule_subscriptions(
+        semester.id, student_ids
+    )
+    for chunk in itertools.batched(subscriptions, chunk_size):
+        catalogs = get_course_catalogs(
+            semester,
+            sorted(
+                {
+                    subscription["course_id"]
+                    for _student_id, student_subscriptions in chunk
+                    for subscription in student_subscriptions
+                }
+            ),
+        )
+        for student_id, student_subscriptions in chunk:
+            # Students without subscriptions are skipped by the query.
+            for other_id in remaining:
+                if other_id == student_id:
+                    break
+                yield other_id, _join_schedule_rows({}, [])
+            yield student_id, _join_schedule_rows(catalogs, student_subscriptions)
+
+    for student_id in remaining:
+        yield student_id, _join_schedule_rows({}, [])
+
+
+def _join_schedule_rows(
+    catalogs: dict[int, CourseCatalog], subscriptions
+) -> StudentScheduleRows:
+    courses = []
+    exams = []
+    lectures = []
+    groups = {}
+    rooms = {}
+    for subscription in subscriptions:
+        catalog = catalogs[subscription["course_id"]]
+        alias = subscription["alias"] or None
+        group_ids = frozenset(subscription["group_ids"])
+        exclude_ids = frozenset(subscription["exclude_ids"])
+
+        course = copy.copy(catalog.course)
+        course.alias = subscription["alias"]
+        courses.append(course)
+
+        for exam in catalog.exams:
+            exam = copy.copy(exam)
+            exam.alias = subscription["alias"]
+            exams.append(exam)
+
+        for entry in catalog.lectures:
+            if group_ids.isdisjoint(entry.group_ids):
+                continue
+
+            lecture = entry.lecture
+            exclude = lecture.lecture_id in exclude_ids
+            if alias or exclude:
+                lecture = replace(lecture, alias=alias, exclude=exclude)
+            lectures.append(lecture)
+
+            if entry.groups:
+                groups[lecture.lecture_id] = list(entry.groups)
+            if entry.rooms:
+                rooms[lecture.lecture_id] = list(entry.rooms)
+
+    exams.sort(key=_exam_order)
+    return StudentScheduleRows(
+        lectures=lectures,
+        courses=courses,
+        exams=exams,
+        groups=groups,
+        rooms=rooms,
+    )
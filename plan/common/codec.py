@@ -0,0 +1,460 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+"""Compact binary encoding of cached schedule data.
+
+Payloads are column oriented: every field of the encoded records is stored as
+one array of unsigned integers in the narrowest type that fits, so decoding is
+mostly ``array.frombytes``. Strings are interned in a table and referenced by
+index, times are seconds since midnight, dates are ordinals and week numbers
+are bitmasks. Optional values are stored as ``value + 1`` with ``0`` for
+``None``. Lecture ids go through :mod:`plan.common.encoding`'s delta-delta and
+zig-zag helpers, which keeps runs of related ids in a single byte each.
+
+Courses, exams and exam types only keep the fields schedules show, listed in
+``_ENCODED_FIELDS``. Import bookkeeping in ``_SKIPPED_FIELDS`` is left out and
+reading it from a decoded instance is a deferred query. New model fields have
+to be added to one of the two, and ``VERSION`` bumped when the payload changes.
+"""
+
+import datetime
+import struct
+import sys
+from array import array
+from decimal import Decimal
+
+from django.db import DEFAULT_DB_ALIAS
+
+from plan.common import encoding
+from plan.common.lecture_data import LectureData, ScheduleData, Weekday, week_mask
+from plan.common.models import Course, Exam, ExamType
+
+MAGIC = b"PLSD"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sB")
+_COLUMN = struct.Struct("<cI")
+_TYPECODES = [("B", 0xFF), ("H", 0xFFFF), ("I", 0xFFFFFFFF), ("Q", (1 << 64) - 1)]
+
+
+_ENCODED_FIELDS = {
+    Course: (
+        "id",
+        "code",
+        "semester_id",
+        "name",
+        "version",
+        "url",
+        "syllabus",
+        "points",
+    ),
+    Exam: (
+        "id",
+        "course_id",
+        "type_id",
+        "combination",
+        "exam_date",
+        "exam_time",
+        "handout_date",
+        "handout_time",
+        "duration",
+        "url",
+    ),
+    ExamType: ("id", "code", "name"),
+}
+_SKIPPED_FIELDS = frozenset({"last_import", "last_modified"})
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _seconds(value: datetime.time | None) -> int:
+    if value is None:
+        return 0
+    return value.hour * 3600 + value.minute * 60 + value.second + 1
+
+
+def _ordinal(value: datetime.date | None) -> int:
+    return 0 if value is None else value.toordinal() + 1
+
+
+def _optional(value: int | None) -> int:
+    return 0 if value is None else value + 1
+
+
+def _time(value: int) -> datetime.time | None:
+    if not value:
+        return None
+    minutes, seconds = divmod(value - 1, 60)
+    return datetime.time(minutes // 60, minutes % 60, seconds)
+
+
+def _date(value: int) -> datetime.date | None:
+    return datetime.date.fromordinal(value - 1) if value else None
+
+
+def _decimal(value: str | None) -> Decimal | None:
+    return None if value is None else Decimal(value)
+
+
+def _from_values(model, values: dict):
+    """Model instance with the encoded fields loaded, as if read from the database."""
+    names = _ENCODED_FIELDS[model]
+    return model.from_db(DEFAULT_DB_ALIAS, names, [values[name] for name in names])
+
+
+class _Writer:
+    def __init__(self) -> None:
+        self.columns: list[bytes] = []
+        self.strings: dict[str, int] = {}
+
+    def string(self, value: str | None) -> int:
+        if value is None:
+            return 0
+        try:
+            return self.strings[value]
+        except KeyError:
+            index = self.strings[value] = len(self.strings) + 1
+            return index
+
+    def ints(self, values: list[int]) -> None:
+        largest = max(values, default=0)
+        for typecode, limit in _TYPECODES:
+            if largest <= limit:
+                break
+        else:
+            raise CodecError(f"Value {largest} does not fit in a column")
+
+        column = array(typecode, values)
+        if sys.byteorder == "big":
+            column.byteswap()
+        self.columns.append(
+            _COLUMN.pack(typecode.encode(), len(values)) + column.tobytes()
+        )
+
+    def getvalue(self) -> bytes:
+        table = "\x00".join(self.strings).encode()
+        lengths = array("I", [len(value) for value in self.strings])
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        return b"".join(
+            [
+                _HEADER.pack(MAGIC, VERSION),
+                struct.pack("<II", len(lengths), len(table)),
+                lengths.tobytes(),
+                table,
+                *self.columns,
+            ]
+        )
+
+
+class _Reader:
+    def __init__(self, payload: bytes) -> None:
+        view = memoryview(payload)
+        try:
+            magic, version = _HEADER.unpack_from(view)
+        except struct.error as exc:
+            raise CodecError("Truncated schedule data payload") from exc
+        if magic != MAGIC or version != VERSION:
+            raise CodecError(f"Unsupported schedule data payload {magic!r}:{version}")
+
+        offset = _HEADER.size
+        count, size = struct.unpack_from("<II", view, offset)
+        offset += 8
+        lengths = array("I")
+        lengths.frombytes(view[offset : offset + count * 4])
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        offset += count * 4
+        text = bytes(view[offset : offset + size]).decode()
+        offset += size
+
+        self.strings: list[str | None] = [None]
+        start = 0
+        for length in lengths:
+            self.strings.append(text[start : start + length])
+            start += length + 1
+
+        self.view = view
+        self.offset = offset
+
+    def ints(self) -> array:
+        typecode, count = _COLUMN.unpack_from(self.view, self.offset)
+        self.offset += _COLUMN.size
+        column = array(typecode.decode())
+        size = count * column.itemsize
+        column.frombytes(self.view[self.offset : self.offset + size])
+        if sys.byteorder == "big":
+            column.byteswap()
+        self.offset += size
+        return column
+
+    def strs(self) -> list[str | None]:
+        strings = self.strings
+        return [strings[index] for index in self.ints()]
+
+
+def _write_mapping(writer: _Writer, mapping: dict[int, list], encode) -> None:
+    """Keys, value counts and the flattened values of a dict of lists."""
+    writer.ints(list(mapping))
+    writer.ints([len(values) for values in mapping.values()])
+    encode([value for values in mapping.values() for value in values])
+
+
+def _read_mapping(reader: _Reader, decode) -> dict[int, list]:
+    keys = reader.ints()
+    counts = reader.ints()
+    values = decode()
+    mapping = {}
+    start = 0
+    for key, count in zip(keys, counts):
+        mapping[key] = values[start : start + count]
+        start += count
+    return mapping
+
+
+def _write_lectures(writer: _Writer, lectures: list[LectureData]) -> None:
+    ids = encoding.DeltaDeltaEncoder()
+    string = writer.string
+    writer.ints([encoding.zig_zag_encode(ids.encode(l.lecture_id)) for l in lectures])
+    writer.ints([string(l.title) for l in lectures])
+    writer.ints([string(l.summary) for l in lectures])
+    writer.ints([string(l.stream) for l in lectures])
+    writer.ints([l.day for l in lectures])
+    writer.ints([_seconds(l.start) for l in lectures])
+    writer.ints([_seconds(l.end) for l in lectures])
+    writer.ints([week_mask(l.week_numbers) for l in lectures])
+    writer.ints([string(l.alias) for l in lectures])
+    writer.ints([l.exclude for l in lectures])
+    writer.ints([l.course_id for l in lectures])
+    writer.ints([string(l.course_code) for l in lectures])
+    writer.ints([string(l.course_name) for l in lectures])
+    writer.ints([_optional(l.type_id) for l in lectures])
+    writer.ints([string(l.type_code) for l in lectures])
+    writer.ints([string(l.type_name) for l in lectures])
+    writer.ints([l.type_optional for l in lectures])
+
+
+def _read_lectures(reader: _Reader) -> list[LectureData]:
+    ids = encoding.DeltaDeltaDecoder()
+    lecture_ids = [ids.decode(encoding.zig_zag_decode(i)) for i in reader.ints()]
+    titles = reader.strs()
+    summaries = reader.strs()
+    streams = reader.strs()
+    days = reader.ints()
+    starts = reader.ints()
+    ends = reader.ints()
+    masks = reader.ints()
+    aliases = reader.strs()
+    excludes = reader.ints()
+    course_ids = reader.ints()
+    course_codes = reader.strs()
+    course_names = reader.strs()
+    type_ids = reader.ints()
+    type_codes = reader.strs()
+    type_names = reader.strs()
+    type_optionals = reader.ints()
+
+    # Lectures share a handful of distinct days, times and week lists, so
+    # build each value once and pass the columns positionally.
+    weekdays = {day: Weekday(day) for day in set(days)}
+    times = {value: _time(value) for value in {*starts, *ends}}
+    weeks = {
+        mask: tuple(week for week in range(mask.bit_length()) if mask >> week & 1)
+        for mask in set(masks)
+    }
+
+    return list(
+        map(
+            LectureData,
+            lecture_ids,
+            titles,
+            summaries,
+            streams,
+            map(weekdays.__getitem__, days),
+            map(times.__getitem__, starts),
+            map(times.__getitem__, ends),
+            map(weeks.__getitem__, masks),
+            aliases,
+            map(bool, excludes),
+            course_ids,
+            course_codes,
+            course_names,
+            [type_id - 1 if type_id else None for type_id in type_ids],
+            type_codes,
+            type_names,
+            map(bool, type_optionals),
+        )
+    )
+
+
+def _write_rooms(writer: _Writer, rooms: list[dict]) -> None:
+    writer.ints([room["id"] for room in rooms])
+    writer.ints([writer.string(room["name"]) for room in rooms])
+    writer.ints([writer.string(room["url"]) for room in rooms])
+
+
+def _read_rooms(reader: _Reader) -> list[dict]:
+    ids = reader.ints()
+    names = reader.strs()
+    urls = reader.strs()
+    return [
+        {"id": room_id, "name": name, "url": url}
+        for room_id, name, url in zip(ids, names, urls)
+    ]
+
+
+def _write_courses(writer: _Writer, courses: list[Course]) -> None:
+    string = writer.string
+    writer.ints([course.id for course in courses])
+    writer.ints([string(course.code) for course in courses])
+    writer.ints([string(course.name) for course in courses])
+    writer.ints([string(course.url) for course in courses])
+    writer.ints([string(course.syllabus) for course in courses])
+    writer.ints([string(course.version) for course in courses])
+    writer.ints([course.semester_id for course in courses])
+    writer.ints([string(None if c.points is None else str(c.points)) for c in courses])
+    writer.ints([string(getattr(course, "alias", None)) for course in courses])
+
+
+def _read_courses(reader: _Reader) -> list[Course]:
+    ids = reader.ints()
+    codes = reader.strs()
+    names = reader.strs()
+    urls = reader.strs()
+    syllabuses = reader.strs()
+    versions = reader.strs()
+    semester_ids = reader.ints()
+    points = reader.strs()
+    aliases = reader.strs()
+
+    courses = []
+    for i, course_id in enumerate(ids):
+        course = _from_values(
+            Course,
+            {
+                "id": course_id,
+                "code": codes[i],
+                "name": names[i],
+                "url": urls[i],
+                "syllabus": syllabuses[i],
+                "version": versions[i],
+                "semester_id": semester_ids[i],
+                "points": _decimal(points[i]),
+            },
+        )
+        course.alias = aliases[i]
+        courses.append(course)
+    return courses
+
+
+def _write_exams(writer: _Writer, exams: list[Exam]) -> None:
+    string = writer.string
+    writer.ints([exam.id for exam in exams])
+    writer.ints([exam.course_id for exam in exams])
+    writer.ints([_optional(exam.type_id) for exam in exams])
+    writer.ints([string(exam.type.code if exam.type else None) for exam in exams])
+    writer.ints([string(exam.type.name if exam.type else None) for exam in exams])
+    writer.ints([string(exam.combination) for exam in exams])
+    writer.ints([_ordinal(exam.exam_date) for exam in exams])
+    writer.ints([_seconds(exam.exam_time) for exam in exams])
+    writer.ints([_ordinal(exam.handout_date) for exam in exams])
+    writer.ints([_seconds(exam.handout_time) for exam in exams])
+    writer.ints(
+        [string(None if e.duration is None else str(e.duration)) for e in exams]
+    )
+    writer.ints([string(exam.url) for exam in exams])
+    writer.ints([string(getattr(exam, "alias", None)) for exam in exams])
+
+
+def _read_exams(reader: _Reader, courses: dict[int, Course]) -> list[Exam]:
+    ids = reader.ints()
+    course_ids = reader.ints()
+    type_ids = reader.ints()
+    type_codes = reader.strs()
+    type_names = reader.strs()
+    combinations = reader.strs()
+    exam_dates = reader.ints()
+    exam_times = reader.ints()
+    handout_dates = reader.ints()
+    handout_times = reader.ints()
+    durations = reader.strs()
+    urls = reader.strs()
+    aliases = reader.strs()
+
+    exams = []
+    for i, exam_id in enumerate(ids):
+        type_id = type_ids[i] - 1 if type_ids[i] else None
+        exam = _from_values(
+            Exam,
+            {
+                "id": exam_id,
+                "course_id": course_ids[i],
+                "type_id": type_id,
+                "combination": combinations[i],
+                "exam_date": _date(exam_dates[i]),
+                "exam_time": _time(exam_times[i]),
+                "handout_date": _date(handout_dates[i]),
+                "handout_time": _time(handout_times[i]),
+                "duration": _decimal(durations[i]),
+                "url": urls[i],
+            },
+        )
+        exam.type = None
+        if type_id is not None:
+            exam.type = _from_values(
+                ExamType, {"id": type_id, "code": type_codes[i], "name": type_names[i]}
+            )
+        if exam.course_id in courses:
+            exam.course = courses[exam.course_id]
+        exam.alias = aliases[i]
+        exams.append(exam)
+    return exams
+
+
+def encode_lectures(lectures: list[LectureData]) -> bytes:
+    writer = _Writer()
+    _write_lectures(writer, lectures)
+    return writer.getvalue()
+
+
+def decode_lectures(payload: bytes) -> list[LectureData]:
+    return _read_lectures(_Reader(payload))
+
+
+def encode_schedule_data(data: ScheduleData) -> bytes:
+    if data.lecturers:
+        raise CodecError("Encoding lecturers is not supported")
+
+    writer = _Writer()
+    _write_lectures(writer, data.lectures)
+    _write_courses(writer, data.courses)
+    _write_mapping(writer, data.exams, lambda exams: _write_exams(writer, exams))
+    _write_mapping(
+        writer,
+        data.groups,
+        lambda groups: writer.ints([writer.string(group) for group in groups]),
+    )
+    _write_mapping(writer, data.rooms, lambda rooms: _write_rooms(writer, rooms))
+    writer.ints(data.weeks)
+    return writer.getvalue()
+
+
+def decode_schedule_data(payload: bytes) -> ScheduleData:
+    reader = _Reader(payload)
+    lectures = _read_lectures(reader)
+    courses = _read_courses(reader)
+    courses_by_id = {course.id: course for course in courses}
+    exams = _read_mapping(reader, lambda: _read_exams(reader, courses_by_id))
+    groups = _read_mapping(reader, reader.strs)
+    rooms = _read_mapping(reader, lambda: _read_rooms(reader))
+    weeks = list(reader.ints())
+    return ScheduleData(
+        lectures=lectures,
+        courses=courses,
+        exams=exams,
+        lecturers=[],
+        groups=groups,
+        rooms=rooms,
+        weeks=weeks,
+    )
@@ -1,12 +1,27 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
-from dataclasses import dataclass
+from collections.abc import Iterable
+from dataclasses import dataclass, field
 from datetime import time
 from enum import IntEnum
+from typing import TYPE_CHECKING
+
+from plan.common.slots import SlotRange, slot_range
+
+if TYPE_CHECKING:
+    from plan.common.models import Course, Exam
 
 type WeekNumber = int
 
 
+def week_mask(week_numbers: Iterable[WeekNumber]) -> int:
+    """Bitmask with bit ``n`` set for each ISO week number ``n``."""
+    mask = 0
+    for week in week_numbers:
+        mask |= 1 << week
+    return mask
+
+
 class Weekday(IntEnum):
     MONDAY = 0
     TUESDAY = 1
@@ -42,3 +57,34 @@ class LectureData:
     type_code: str | None
     type_name: str | None
     type_optional: bool
+
+    # Timetable slots covered by the lecture, None when it falls outside them.
+    slots: SlotRange | None = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "slots", slot_range(self.start, self.end))
+
+
+@dataclass(frozen=True, slots=True)
+class CatalogLecture:
+    """Lecture as every subscriber of its course sees it.
+
+    ``lecture`` has no alias and is not excluded. A subscription sees the
+    lecture when it has chosen one of ``group_ids``.
+    """
+
+    lecture: LectureData
+    group_ids: frozenset[int]
+    groups: tuple[str, ...]
+    rooms: tuple[dict[str, int | str | None], ...]
+
+
+@dataclass
+class ScheduleData:
+    lectures: list[LectureData]
+    courses: list["Course"]
+    exams: dict[int, list["Exam"]]
+    lecturers: list[object]
+    groups: dict[int, list[str]]
+    rooms: dict[int, list[dict[str, int | str | None]]]
+    weeks: list[int]
@@ -0,0 +1,35 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+import re
+
+from django.conf import settings
+from django.template.base import TextNode
+from django.template.loaders import cached
+
+RE_WHITESPACE = re.compile(r"(\s\s+|\n)")
+
+
+class MinifyingLoader(cached.Loader):
+    """Cached template loader that minifies templates once when compiled.
+
+    Whitespace is only collapsed in the literal text between template tags,
+    so translated strings keep matching their messages and rendered pages
+    need no further minification.
+    """
+
+    def get_template(self, template_name, skip=None):
+        template = super().get_template(template_name, skip)
+        if settings.COMPRESS_ENABLED and not getattr(template, "minified", False):
+            _minify(template.nodelist)
+            template.minified = True
+        return template
+
+
+def _minify(nodelist):
+    for node in nodelist:
+        if isinstance(node, TextNode):
+            node.s = RE_WHITESPACE.sub(" ", node.s)
+        elif type(node).__name__ != "CompressorNode":
+            # Compressed blocks are looked up by a hash of their content.
+            for name in node.child_nodelists:
+                _minify(getattr(node, name, None) or ())
@@ -0,0 +1,146 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+"""In-process LRU cache backend bounded by approximate size in bytes.
+
+Unlike ``LocMemCache`` values are kept as objects, so a hit costs neither a
+round trip nor an unpickle. Callers share the returned objects and must not
+modify them. Sizes are measured by pickling once on ``set``.
+
+Django creates a backend instance per thread, so like ``LocMemCache`` the
+entries live in module level stores shared by every instance with the same
+name.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from plan.telemetry.cache import record_evictions
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+@dataclass
+class _Store:
+    # key -> (value, expiry, size), least recently used first.
+    entries: OrderedDict[str, tuple[object, float | None, int]] = field(
+        default_factory=OrderedDict
+    )
+    size: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+_stores: dict[str, _Store] = {}
+_stores_guard = threading.Lock()
+
+
+class LocalLRUCache(BaseCache):
+    def __init__(self, name, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._max_bytes = int(options.get("MAX_BYTES", DEFAULT_MAX_BYTES))
+        with _stores_guard:
+            self._store = _stores.setdefault(name, _Store())
+        self._entries = self._store.entries
+        self._lock = self._store.lock
+
+    @property
+    def size(self) -> int:
+        return self._store.size
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        size = self._measure(key, value)
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            return self._set(key, value, timeout, size)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            entry = self._get(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        size = self._measure(key, value)
+        with self._lock:
+            self._set(key, value, timeout, size)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            entry = self._get(key)
+            if entry is None:
+                return False
+            value, _expiry, size = entry
+            self._entries[key] = (value, self.get_backend_timeout(timeout), size)
+            return True
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            entry = self._get(key)
+            if entry is None:
+                raise ValueError(f"Key '{key}' not found")
+            value, expiry, size = entry
+            self._entries[key] = (value + delta, expiry, size)
+            return value + delta
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            return self._get(key) is not None
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._lock:
+            return self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._store.size = 0
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            self._delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _measure(self, key, value) -> int:
+        # Pickled size is a rough but cheap stand-in for the memory used.
+        return len(key) + len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _set(self, key, value, timeout, size) -> bool:
+        self._delete(key)
+        if size > self._max_bytes:
+            return False
+
+        self._entries[key] = (value, self.get_backend_timeout(timeout), size)
+        self._store.size += size
+
+        evicted = 0
+        while self._store.size > self._max_bytes:
+            _key, (_value, _expiry, evicted_size) = self._entries.popitem(last=False)
+            self._store.size -= evicted_size
+            evicted += 1
+        if evicted:
+            record_evictions(self, evicted)
+        return True
+
+    def _delete(self, key) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._store.size -= entry[2]
+        return True
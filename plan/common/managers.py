@@ -1,13 +1,20 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
 import datetime
-from collections.abc import Iterator
-from collections.abc import Mapping
+import itertools
+import json
+import logging
+import operator
+from collections.abc import Iterable, Iterator, Mapping
+from dataclasses import dataclass
 from typing import Any
 
+from django.conf import settings
 from django.db import connection, models
 
-from plan.common.lecture_data import LectureData, Weekday
+from plan.common.lecture_data import CatalogLecture, LectureData, Weekday
+
+logger = logging.getLogger(__name__)
 
 
 def today():
@@ -20,18 +27,381 @@ def _iter_cursor_dicts(cursor) -> Iterator[Mapping[str, Any]]:
         yield {name: row[index] for name, index in column_index.items()}
 
 
+def _iter_chunked_dicts(cursor, size: int) -> Iterator[Mapping[str, Any]]:
+    # Server side cursors only have a description after the first fetch.
+    rows = cursor.fetchmany(size)
+    column_index = {column[0]: index for index, column in enumerate(cursor.description)}
+    while rows:
+        for row in rows:
+            yield {name: row[index] for name, index in column_index.items()}
+        rows = cursor.fetchmany(size)
+
+
+# Subscriptions and visible lectures of students in one semester, shared by the
+# lecture and schedule data queries.
+_STUDENT_LECTURES_SQL = """
+    student_subs AS (
+        SELECT s.id, s.student_id, s.course_id, s.alias
+        FROM common_subscription s
+        JOIN common_course c ON c.id = s.course_id
+        WHERE s.student_id = ANY(%(student_ids)s)
+          AND c.semester_id = %(semester_id)s
+    ),
+    student_lectures AS (
+        SELECT
+            ss.student_id,
+            l.id AS lecture_id,
+            l.title,
+            l.summary,
+            l.stream,
+            l.day,
+            l.start,
+            l."end",
+            COALESCE(w.week_numbers, '{}'::integer[]) AS week_numbers,
+            ss.alias,
+            EXISTS (
+                SELECT 1
+                FROM common_subscription_exclude se
+                WHERE se.subscription_id = ss.id
+                  AND se.lecture_id = l.id
+            ) AS exclude,
+            c.id AS course_id,
+            c.code AS course_code,
+            c.name AS course_name,
+            lt.id AS type_id,
+            lt.code AS type_code,
+            lt.name AS type_name,
+            COALESCE(lt.optional, FALSE) AS type_optional
+        FROM student_subs ss
+        JOIN common_course c ON c.id = ss.course_id
+        JOIN common_lecture l ON l.course_id = c.id
+        LEFT JOIN common_lecturetype lt ON lt.id = l.type_id
+        LEFT JOIN LATERAL (
+            SELECT ARRAY_AGG(DISTINCT w.number ORDER BY w.number) AS week_numbers
+            FROM common_week w
+            WHERE w.lecture_id = l.id
+        ) w ON TRUE
+        WHERE EXISTS (
+            SELECT 1
+            FROM common_subscription_groups sg
+            JOIN common_lecture_groups lg ON lg.group_id = sg.group_id
+            WHERE sg.subscription_id = ss.id
+              AND lg.lecture_id = l.id
+        )
+    )
+"""
+
+_STUDENT_LECTURES_ORDER_SQL = """
+    sl.course_code ASC,
+    sl.day ASC,
+    sl.start ASC,
+    sl.type_name ASC,
+    sl.type_code ASC,
+    sl.type_optional ASC,
+    sl.course_id ASC,
+    sl.type_id ASC,
+    sl.lecture_id ASC
+"""
+
+
+def _lecture_data(row: Mapping[str, Any]) -> LectureData:
+    return LectureData(
+        lecture_id=row["lecture_id"],
+        title=row["title"],
+        summary=row["summary"],
+        stream=row["stream"],
+        day=Weekday(row["day"]),
+        start=row["start"],
+        end=row["end"],
+        week_numbers=tuple(sorted(set(row["week_numbers"] or ()))),
+        alias=row["alias"] or None,
+        exclude=row["exclude"],
+        course_id=row["course_id"],
+        course_code=row["course_code"],
+        course_name=row["course_name"],
+        type_id=row["type_id"],
+        type_code=row["type_code"],
+        type_name=row["type_name"],
+        type_optional=row["type_optional"],
+    )
+
+
+def _warn_outside_slots(lectures: Iterable[LectureData]) -> None:
+    if settings.TIMETABLE_SLOT_MINUTES:
+        return
+
+    for lecture in lectures:
+        if lecture.slots is None:
+            logger.warning(
+                "Lecture %s at %s-%s is outside timetable slots",
+                lecture.lecture_id,
+                lecture.start,
+                lecture.end,
+            )
+
+
+def _load_json(value):
+    # Django registers jsonb loaders that hand back the raw text.
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def _from_json(model, values: Mapping[str, Any]):
+    """Model instance from a ``to_jsonb`` row, converting values per field."""
+    fields = [field for field in model._meta.concrete_fields if field.attname in values]
+    return model.from_db(
+        connection.alias,
+        [field.attname for field in fields],
+        [field.to_python(values[field.attname]) for field in fields],
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class StudentScheduleRows:
+    """Everything a schedule page shows for one student, from one query.
+
+    ``courses`` and ``exams`` carry the subscription alias as ``alias``, and
+    exams have their course and type attached. ``groups`` and ``rooms`` are
+    keyed by lecture id and only hold lectures that have any.
+    """
+
+    lectures: list[LectureData]
+    courses: list[Any]
+    exams: list[Any]
+    groups: dict[int, list[str]]
+    rooms: dict[int, list[dict[str, int | str | None]]]
+
+
+# Courses, exams and lectures of each student aggregated to JSON, so a student's
+# schedule data is a single row. Rows are ordered by student id and include
+# students without any subscriptions.
+_SCHEDULE_ROWS_SQL = f"""
+    WITH {_STUDENT_LECTURES_SQL}
+    SELECT
+        st.student_id,
+        COALESCE(sc.courses, '[]'::jsonb) AS courses,
+        COALESCE(se.exams, '[]'::jsonb) AS exams,
+        COALESCE(sls.lectures, '[]'::jsonb) AS lectures
+    FROM unnest(%(student_ids)s) AS st (student_id)
+    LEFT JOIN (
+        SELECT
+            ss.student_id,
+            jsonb_agg(
+                to_jsonb(c) || jsonb_build_object('alias', ss.alias)
+                ORDER BY c.code, c.id
+            ) AS courses
+        FROM student_subs ss
+        JOIN common_course c ON c.id = ss.course_id
+        GROUP BY ss.student_id
+    ) sc ON sc.student_id = st.student_id
+    LEFT JOIN (
+        SELECT
+            ss.student_id,
+            jsonb_agg(
+                to_jsonb(e) || jsonb_build_object('type', to_jsonb(et))
+                ORDER BY
+                    e.handout_date,
+                    e.handout_time,
+                    e.exam_date,
+                    e.exam_time,
+                    e.id
+            ) AS exams
+        FROM student_subs ss
+        JOIN common_exam e ON e.course_id = ss.course_id
+        LEFT JOIN common_examtype et ON et.id = e.type_id
+        GROUP BY ss.student_id
+    ) se ON se.student_id = st.student_id
+    LEFT JOIN (
+        SELECT
+            sl.student_id,
+            jsonb_agg(
+                to_jsonb(sl)
+                || jsonb_build_object('rooms', r.rooms, 'groups', g.groups)
+                ORDER BY {_STUDENT_LECTURES_ORDER_SQL}
+            ) AS lectures
+        FROM student_lectures sl
+        LEFT JOIN LATERAL (
+            SELECT jsonb_agg(
+                jsonb_build_object('id', r.id, 'name', r.name, 'url', r.url)
+                ORDER BY lr.id
+            ) AS rooms
+            FROM common_lecture_rooms lr
+            JOIN common_room r ON r.id = lr.room_id
+            WHERE lr.lecture_id = sl.lecture_id
+        ) r ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT ARRAY_AGG(g.code ORDER BY lg.id) AS groups
+            FROM common_lecture_groups lg
+            JOIN common_group g ON g.id = lg.group_id
+            WHERE lg.lecture_id = sl.lecture_id
+        ) g ON TRUE
+        GROUP BY sl.student_id
+    ) sls ON sls.student_id = st.student_id
+    ORDER BY st.student_id ASC
+"""
+
+
+def _schedule_rows(row: Mapping[str, Any]) -> StudentScheduleRows:
+    from plan.common.models import Course, Exam, ExamType
+
+    courses = []
+    for values in _load_json(row["courses"]):
+        course = _from_json(Course, values)
+        course.alias = values["alias"]
+        courses.append(course)
+    courses_by_id = {course.id: course for course in courses}
+
+    exams = []
+    for values in _load_json(row["exams"]):
+        exam = _from_json(Exam, values)
+        exam.course = courses_by_id[exam.course_id]
+        exam.alias = exam.course.alias
+        exam.type = None
+        if values["type"]:
+            exam.type = _from_json(ExamType, values["type"])
+        exams.append(exam)
+
+    lectures = []
+    groups = {}
+    rooms = {}
+    for values in _load_json(row["lectures"]):
+        lecture = _lecture_data(
+            {
+                **values,
+                "start": datetime.time.fromisoformat(values["start"]),
+                "end": datetime.time.fromisoformat(values["end"]),
+            }
+        )
+        lectures.append(lecture)
+        if values["groups"]:
+            groups[lecture.lecture_id] = values["groups"]
+        if values["rooms"]:
+            rooms[lecture.lecture_id] = values["rooms"]
+
+    _warn_outside_slots(lectures)
+    return StudentScheduleRows(
+        lectures=lectures,
+        courses=courses,
+        exams=exams,
+        groups=groups,
+        rooms=rooms,
+    )
+
+
 class LectureManager(models.Manager):
     def get_lectures_data(self, semester_id, student_id):
         cursor = connection.cursor()
         cursor.execute(
-            """
-            WITH student_subs AS (
-                SELECT s.id, s.course_id, s.alias
-                FROM common_subscription s
-                JOIN common_course c ON c.id = s.course_id
-                WHERE s.student_id = %(student_id)s
-                  AND c.semester_id = %(semester_id)s
+            f"""
+            WITH {_STUDENT_LECTURES_SQL}
+            SELECT sl.*
+            FROM student_lectures sl
+            ORDER BY {_STUDENT_LECTURES_ORDER_SQL}
+            """,
+            {
+                "student_ids": [student_id],
+                "semester_id": semester_id,
+            },
+        )
+
+        lectures = [_lecture_data(row) for row in _iter_cursor_dicts(cursor)]
+        _warn_outside_slots(lectures)
+        return lectures
+
+    def iter_lectures_data(
+        self, semester_id, student_ids, chunk_size=2000
+    ) -> Iterator[tuple[int, list[LectureData]]]:
+        """Yield ``(student_id, lectures)`` for many students from one query.
+
+        Rows are streamed from a server side cursor ordered by student, so
+        memory use is bounded by the largest schedule and not by the number of
+        students. Lectures are the same as :meth:`get_lectures_data` returns,
+        and students without any lectures are skipped.
+        """
+        student_ids = sorted(set(student_ids))
+        if not student_ids:
+            return
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH {_STUDENT_LECTURES_SQL}
+                SELECT sl.*
+                FROM student_lectures sl
+                ORDER BY sl.student_id ASC, {_STUDENT_LECTURES_ORDER_SQL}
+                """,
+                {
+                    "student_ids": student_ids,
+                    "semester_id": semester_id,
+                },
             )
+
+            current, lectures = None, []
+            for row in _iter_chunked_dicts(cursor, chunk_size):
+                if row["student_id"] != current:
+                    if lectures:
+                        _warn_outside_slots(lectures)
+                        yield current, lectures
+                    current, lectures = row["student_id"], []
+                lectures.append(_lecture_data(row))
+            if lectures:
+                _warn_outside_slots(lectures)
+                yield current, lectures
+
+    def get_schedule_rows(self, semester_id, student_id) -> StudentScheduleRows:
+        """Lectures, courses, exams, groups and rooms in one round trip.
+
+        Each part is aggregated to JSON in a single row, so a cold schedule
+        render costs one query instead of one per part.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            _SCHEDULE_ROWS_SQL,
+            {
+                "student_ids": [student_id],
+                "semester_id": semester_id,
+            },
+        )
+        return _schedule_rows(next(_iter_cursor_dicts(cursor)))
+
+    def iter_schedule_rows(
+        self, semester_id, student_ids, chunk_size=200
+    ) -> Iterator[tuple[int, StudentScheduleRows]]:
+        """Yield ``(student_id, rows)`` for many students from one query.
+
+        Rows are streamed from a server side cursor with one row per student,
+        ordered by student id. Rows are the same as :meth:`get_schedule_rows`
+        returns, including empty rows for students without subscriptions.
+        """
+        student_ids = sorted(set(student_ids))
+        if not student_ids:
+            return
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(
+                _SCHEDULE_ROWS_SQL,
+                {
+                    "student_ids": student_ids,
+                    "semester_id": semester_id,
+                },
+            )
+            for row in _iter_chunked_dicts(cursor, chunk_size):
+                yield row["student_id"], _schedule_rows(row)
+
+    def get_catalog_lectures(self, course_ids) -> dict[int, list[CatalogLecture]]:
+        """Lectures of ``course_ids`` as seen by every subscriber, by course.
+
+        Lectures of each course are in the same order as for
+        :meth:`get_lectures_data`.
+        """
+        catalog = {course_id: [] for course_id in course_ids}
+        if not catalog:
+            return catalog
+
+        cursor = connection.cursor()
+        cursor.execute(
+            """
             SELECT
                 l.id AS lecture_id,
                 l.title,
@@ -41,75 +411,70 @@ class LectureManager(models.Manager):
                 l.start,
                 l."end",
                 COALESCE(w.week_numbers, '{}'::integer[]) AS week_numbers,
-                ss.alias,
-                EXISTS (
-                    SELECT 1
-                    FROM common_subscription_exclude se
-                    WHERE se.subscription_id = ss.id
-                      AND se.lecture_id = l.id
-                ) AS exclude,
+                NULL AS alias,
+                FALSE AS exclude,
                 c.id AS course_id,
                 c.code AS course_code,
                 c.name AS course_name,
                 lt.id AS type_id,
                 lt.code AS type_code,
                 lt.name AS type_name,
-                COALESCE(lt.optional, FALSE) AS type_optional
-            FROM student_subs ss
-            JOIN common_course c ON c.id = ss.course_id
-            JOIN common_lecture l ON l.course_id = c.id
+                COALESCE(lt.optional, FALSE) AS type_optional,
+                COALESCE(g.group_ids, '{}'::integer[]) AS group_ids,
+                COALESCE(g.groups, '{}'::text[]) AS groups,
+                COALESCE(r.rooms, '[]'::jsonb) AS rooms
+            FROM common_lecture l
+            JOIN common_course c ON c.id = l.course_id
             LEFT JOIN common_lecturetype lt ON lt.id = l.type_id
             LEFT JOIN LATERAL (
                 SELECT ARRAY_AGG(DISTINCT w.number ORDER BY w.number) AS week_numbers
                 FROM common_week w
                 WHERE w.lecture_id = l.id
             ) w ON TRUE
-            WHERE EXISTS (
-                SELECT 1
-                FROM common_subscription_groups sg
-                JOIN common_lecture_groups lg ON lg.group_id = sg.group_id
-                WHERE sg.subscription_id = ss.id
-                  AND lg.lecture_id = l.id
-            )
+            LEFT JOIN LATERAL (
+                SELECT
+                    ARRAY_AGG(lg.group_id ORDER BY lg.id) AS group_ids,
+                    ARRAY_AGG(g.code ORDER BY lg.id) AS groups
+                FROM common_lecture_groups lg
+                JOIN common_group g ON g.id = lg.group_id
+                WHERE lg.lecture_id = l.id
+            ) g ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT jsonb_agg(
+                    jsonb_build_object('id', r.id, 'name', r.name, 'url', r.url)
+                    ORDER BY lr.id
+                ) AS rooms
+                FROM common_lecture_rooms lr
+                JOIN common_room r ON r.id = lr.room_id
+                WHERE lr.lecture_id = l.id
+            ) r ON TRUE
+            WHERE l.course_id = ANY(%(course_ids)s)
             ORDER BY
-                c.code ASC,
                 l.day ASC,
                 l.start ASC,
                 lt.name ASC,
                 lt.code ASC,
                 lt.optional ASC,
-                l.course_id ASC,
                 l.type_id ASC,
                 l.id ASC
             """,
-            {
-                "student_id": student_id,
-                "semester_id": semester_id,
-            },
+            {"course_ids": list(catalog)},
         )
 
-        return [
-            LectureData(
-                lecture_id=row["lecture_id"],
-                title=row["title"],
-                summary=row["summary"],
-                stream=row["stream"],
-                day=Weekday(row["day"]),
-                start=row["start"],
-                end=row["end"],
-                week_numbers=tuple(sorted(set(row["week_numbers"] or ()))),
-                alias=row["alias"] or None,
-                exclude=row["exclude"],
-                course_id=row["course_id"],
-                course_code=row["course_code"],
-                course_name=row["course_name"],
-                type_id=row["type_id"],
-                type_code=row["type_code"],
-                type_name=row["type_name"],
-                type_optional=row["type_optional"],
+        for row in _iter_cursor_dicts(cursor):
+            catalog[row["course_id"]].append(
+                CatalogLecture(
+                    lecture=_lecture_data(row),
+                    group_ids=frozenset(row["group_ids"]),
+                    groups=tuple(row["groups"]),
+                    rooms=tuple(_load_json(row["rooms"])),
+                )
             )
-            for row in _iter_cursor_dicts(cursor)
-        ]
+
+        _warn_outside_slots(
+            entry.lecture for entries in catalog.values() for entry in entries
+        )
+        return catalog
 
 
 class ExamManager(models.Manager):
@@ -218,6 +583,26 @@ class CourseManager(models.Manager):
         return rows[: max(0, limit)]
 
 
+_SCHEDULE_SUBSCRIPTIONS_SQL = """
+    SELECT
+        s.student_id,
+        s.course_id,
+        s.alias,
+        ARRAY(
+            SELECT sg.group_id
+            FROM common_subscription_groups sg
+            WHERE sg.subscription_id = s.id
+        ) AS group_ids,
+        ARRAY(
+            SELECT se.lecture_id
+            FROM common_subscription_exclude se
+            WHERE se.subscription_id = s.id
+        ) AS exclude_ids
+    FROM common_subscription s
+    JOIN common_course c ON c.id = s.course_id
+"""
+
+
 class SubscriptionManager(models.Manager):
     def get_subscriptions(self, year, semester_type, slug):
         return (
@@ -233,6 +618,59 @@ class SubscriptionManager(models.Manager):
             .order_by("student__slug", "course__code")
         )
 
+    def get_schedule_subscriptions(self, semester_id, student_id):
+        """Course, alias, chosen groups and excluded lectures per subscription.
+
+        Subscriptions are ordered by course code like the student's lectures.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            f"""
+            {_SCHEDULE_SUBSCRIPTIONS_SQL}
+            WHERE s.student_id = %(student_id)s
+              AND c.semester_id = %(semester_id)s
+            ORDER BY c.code ASC, c.id ASC
+            """,
+            {
+                "student_id": student_id,
+                "semester_id": semester_id,
+            },
+        )
+        return list(_iter_cursor_dicts(cursor))
+
+    def iter_schedule_subscriptions(
+        self, semester_id, student_ids, chunk_size=2000
+    ) -> Iterator[tuple[int, list[Mapping[str, Any]]]]:
+        """Yield ``(student_id, subscriptions)`` for many students from one query.
+
+        Subscriptions are the same as :meth:`get_schedule_subscriptions`
+        returns. Students are ordered by id, those without subscriptions in
+        the semester are skipped.
+        """
+        student_ids = sorted(set(student_ids))
+        if not student_ids:
+            return
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(
+                f"""
+                {_SCHEDULE_SUBSCRIPTIONS_SQL}
+                WHERE s.student_id = ANY(%(student_ids)s)
+                  AND c.semester_id = %(semester_id)s
+                ORDER BY s.student_id ASC, c.code ASC, c.id ASC
+                """,
+                {
+                    "student_ids": student_ids,
+                    "semester_id": semester_id,
+                },
+            )
+
+            rows = _iter_chunked_dicts(cursor, chunk_size)
+            for student_id, subscriptions in itertools.groupby(
+                rows, key=operator.itemgetter("student_id")
+            ):
+                yield student_id, list(subscriptions)
+
 
 class SemesterManager(models.Manager):
     def active(self):
@@ -4,6 +4,7 @@ import gzip
 import re
 import secrets
 from functools import wraps
+from types import MappingProxyType
 from urllib.parse import quote
 
 import brotli
@@ -20,7 +21,6 @@ from django.utils.translation import trans_real as trans_internals
 from plan.common.models import Semester
 from plan.common.utils import parse_accepts
 
-RE_WHITESPACE = re.compile(rb"(\s\s+|\n)")
 tracer = trace.get_tracer(__name__)
 SEMESTER_ALIASES = {
     "autum": Semester.FALL,
@@ -51,36 +51,143 @@ def traced_middleware(cls):
 
 
 @traced_middleware
-class HtmlMinifyMiddleware(MiddlewareMixin):
-    def should_minify(self, response):
-        return (
-            settings.COMPRESS_ENABLED
-            and response.status_code == 200
-            and "text/html" in response["Content-Type"]
-        )
-
+class ContentLengthMiddleware(MiddlewareMixin):
     def process_response(self, request, response):
-        if self.should_minify(response):
-            response.content = RE_WHITESPACE.sub(b" ", response.content)
-        response.headers["Content-Length"] = len(response.content)
+        if not response.streaming and "Content-Length" not in response:
+            response.headers["Content-Length"] = len(response.content)
         return response
 
 
+class NonceTemplateResponse(http.HttpResponse):
+    """Cacheable HTML response that gets fresh CSP nonces when served.
+
+    The page is rendered with nonce placeholders and every segment between
+    them is gzip compressed on its own. Concatenated gzip members are a valid
+    gzip stream, so serving with new nonces only compresses the nonces and
+    joins them with the stored segments at the recorded byte offsets.
+    """
+
+    PLACEHOLDERS = MappingProxyType(
+        {
+            "script": "csp-script-nonce-placeholder",
+            "style": "csp-style-nonce-placeholder",
+        }
+    )
+    RE_PLACEHOLDER = re.compile(rb"csp-(script|style)-nonce-placeholder")
+
+    @classmethod
+    def from_response(cls, response):
+        members = _NonceMembers()
+        members.add(response.content)
+        return members.response(response.status_code, response.headers)
+
+    def with_nonces(self, **nonces):
+        members = {
+            target: _gzip_member(nonce.encode()) for target, nonce in nonces.items()
+        }
+        content = memoryview(self.content)
+        chunks = []
+        position = 0
+        for start, end, target in self.nonce_offsets:
+            chunks.append(content[position:start])
+            chunks.append(members[target])
+            position = end
+        chunks.append(content[position:])
+
+        response = http.HttpResponse(
+            b"".join(chunks), status=self.status_code, headers=self.headers
+        )
+        response.headers["Content-Length"] = str(len(response.content))
+        return response
+
+
+class NonceTemplateStreamingResponse(http.StreamingHttpResponse):
+    """HTML page sent as gzip members while it is still being rendered.
+
+    Chunks are compressed as they arrive, with nonce placeholders swapped for
+    the nonces given to `with_nonces`. The members are kept, so once the last
+    chunk is sent the `tee` callback gets the same page as a
+    `NonceTemplateResponse` without rendering or compressing it again.
+    """
+
+    def __init__(self, chunks, *args, **kwargs):
+        self._nonces = {}
+        self._store = None
+        super().__init__(self._stream(chunks), *args, **kwargs)
+        self.headers["Content-Encoding"] = "gzip"
+        cache.patch_vary_headers(self, ("Accept-Encoding",))
+
+    def tee(self, store):
+        # Headers are copied now, before middleware adds per request headers.
+        self._store = store
+        self._store_headers = dict(self.headers)
+
+    def with_nonces(self, **nonces):
+        self._nonces = {
+            target: _gzip_member(nonce.encode()) for target, nonce in nonces.items()
+        }
+        return self
+
+    def _stream(self, chunks):
+        members = _NonceMembers()
+        for chunk in chunks:
+            for member, target in members.add(chunk):
+                yield self._nonces.get(target, member) if target else member
+
+        if self._store is not None:
+            self._store(members.response(self.status_code, self._store_headers))
+
+
+class _NonceMembers:
+    """Gzip members of a page with a member of its own for each placeholder."""
+
+    def __init__(self):
+        self.members = []
+        # (start, end, target) of each placeholder member in the body.
+        self.nonce_offsets = []
+        self.size = 0
+
+    def add(self, chunk):
+        """Compress ``chunk``, returning its members and their nonce targets."""
+        added = []
+        parts = NonceTemplateResponse.RE_PLACEHOLDER.split(chunk)
+        for i, part in enumerate(parts):
+            if i % 2:
+                target = part.decode()
+                placeholder = NonceTemplateResponse.PLACEHOLDERS[target]
+                member = _gzip_member(placeholder.encode())
+                self.nonce_offsets.append((self.size, self.size + len(member), target))
+            elif part:
+                target = None
+                member = _gzip_member(part, compresslevel=9)
+            else:
+                continue
+            added.append((member, target))
+            self.members.append(member)
+            self.size += len(member)
+        return added
+
+    def response(self, status, headers):
+        nonced = NonceTemplateResponse(
+            b"".join(self.members), status=status, headers=headers
+        )
+        nonced.nonce_offsets = self.nonce_offsets
+        nonced.headers["Content-Length"] = str(self.size)
+        nonced.headers["Content-Encoding"] = "gzip"
+        cache.patch_vary_headers(nonced, ("Accept-Encoding",))
+        return nonced
+
+
+def _gzip_member(data, compresslevel=1):
+    return gzip.compress(data, compresslevel=compresslevel, mtime=0)
+
+
 @traced_middleware
 class CspMiddleware(MiddlewareMixin):
-    SCRIPT_NONCE_HEADER = "X-CSP-Script-Nonce"
-    STYLE_NONCE_HEADER = "X-CSP-Style-Nonce"
-
     def process_request(self, request):
         request._csp_script_nonce = secrets.token_urlsafe(16)
         request._csp_style_nonce = secrets.token_urlsafe(16)
 
-    @staticmethod
-    def store_nonce_in_header(request, response):
-        # Hack to make sure caching responses with nonce works
-        response[CspMiddleware.SCRIPT_NONCE_HEADER] = request._csp_script_nonce
-        response[CspMiddleware.STYLE_NONCE_HEADER] = request._csp_style_nonce
-
     def process_response(self, request, response):
         if response.status_code in (404, 500) and settings.DEBUG:
             return response
@@ -88,17 +195,12 @@ class CspMiddleware(MiddlewareMixin):
         if "html" not in response.get("Content-Type", ""):
             return response
 
-        if CspMiddleware.SCRIPT_NONCE_HEADER in response:
-            script_nonce = response[CspMiddleware.SCRIPT_NONCE_HEADER]
-            del response[CspMiddleware.SCRIPT_NONCE_HEADER]
-        else:
-            script_nonce = request._csp_script_nonce
-
-        if CspMiddleware.STYLE_NONCE_HEADER in response:
-            style_nonce = response[CspMiddleware.STYLE_NONCE_HEADER]
-            del response[CspMiddleware.STYLE_NONCE_HEADER]
-        else:
-            style_nonce = request._csp_style_nonce
+        script_nonce = request._csp_script_nonce
+        style_nonce = request._csp_style_nonce
+        if isinstance(
+            response, (NonceTemplateResponse, NonceTemplateStreamingResponse)
+        ):
+            response = response.with_nonces(script=script_nonce, style=style_nonce)
 
         policy = [
             "default-src 'self'",
@@ -3,10 +3,10 @@
 import datetime
 
 from django.conf import settings
-from django.core.cache import cache
 from django.db import models
 from django.utils import dates, translation
 
+from plan.common.cache import MultiCache
 from plan.common.managers import (
     CourseManager,
     ExamManager,
@@ -222,11 +222,19 @@ class Course(models.Model):
             semester_id = semester
 
         key = "course-semester-stats-%d-%d" % (semester_id, limit)
-        result = cache.get(key)
-
-        if result and not bypass_cache:
+        stats_cache = MultiCache[dict](
+            default=settings.TIMETABLE_COURSE_STATS_CACHE_TTL
+        )
+        if bypass_cache:
+            result = Course._load_stats(semester_id, limit)
+            stats_cache.set(key, result)
             return result
+        return stats_cache.get_or_compute(
+            key, lambda: Course._load_stats(semester_id, limit)
+        )
 
+    @staticmethod
+    def _load_stats(semester_id, limit):
         try:
             summary = SemesterAnalytics.objects.get(semester_id=semester_id)
             slug_count = summary.num_unique_students
@@ -244,15 +252,13 @@ class Course(models.Model):
         except TopCourses.DoesNotExist:
             courses = []
 
-        result = {
+        return {
             "slug_count": slug_count,
             "course_count": course_count,
             "subscription_count": subscription_count,
             "stats": courses,
             "limit": limit,
         }
-        cache.set(key, result, settings.TIMETABLE_COURSE_STATS_CACHE_TTL)
-        return result
 
     @staticmethod
     def get_groups(year, semester_type, courses):
@@ -0,0 +1,34 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+import bisect
+import functools
+from datetime import time
+
+from django.conf import settings
+
+type SlotRange = tuple[int, int]
+
+SLOT_END_TIMES = [s[1] for s in settings.TIMETABLE_SLOTS]
+
+
+@functools.cache
+def slot_range(start: time, end: time) -> SlotRange | None:
+    """First and last of ``TIMETABLE_SLOTS`` covered by ``start`` to ``end``.
+
+    A lecture starts in the first slot that ends after it starts, and ends in
+    the first slot that ends at or after it ends, or the last slot when it runs
+    past all of them. Returns ``None`` for lectures that can't be placed in the
+    slots. Results are cached per distinct time pair.
+    """
+    if not SLOT_END_TIMES:
+        return None
+
+    first = bisect.bisect_right(SLOT_END_TIMES, start)
+    if first == len(SLOT_END_TIMES):
+        return None
+
+    last = min(bisect.bisect_left(SLOT_END_TIMES, end), len(SLOT_END_TIMES) - 1)
+    if last < first:
+        return None
+
+    return (first, last)
@@ -1,6 +1,7 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
 import logging
+from collections.abc import Iterator
 from datetime import timedelta
 from dataclasses import dataclass
 from django.conf import settings
@@ -9,7 +10,7 @@ from django.db.models import DateTimeField, ExpressionWrapper, F, Value
 from django.db.models.aggregates import Max
 from django.db.models.functions import Coalesce, Greatest, Now
 
-from plan.common.cache import MultiCache
+from plan.common.cache import CacheResult, MultiCache, get_many, local_layer
 from plan.common.models import (
     Schedule as ScheduleModel,
     Semester,
@@ -73,7 +74,7 @@ def delete_schedule_snapshot_cache(semester: Semester, student_slug: str) -> Non
 
 
 def delete_semester_freshness_cache(semester: Semester) -> None:
-    caches["default"].delete(semester_freshness_cache_key(semester))
+    _semester_freshness_cache().delete(semester_freshness_cache_key(semester))
 
 
 def next_http_last_modified(field: str):
@@ -90,20 +91,26 @@ def next_http_last_modified(field: str):
 def _schedule_snapshot_cache_for_config(
     default_ttl: int | None,
     disk_ttl: int | None,
+    revalidate_after: int | None = None,
 ) -> MultiCache[ScheduleSnapshot]:
     if default_ttl is None:
         raise ValueError("TIMETABLE_SNAPSHOT_CACHE_DEFAULT_TTL must not be None")
 
     if disk_ttl is not None:
-        return MultiCache[ScheduleSnapshot](default=default_ttl, disk=disk_ttl)
+        return MultiCache[ScheduleSnapshot](
+            revalidate_after=revalidate_after, default=default_ttl, disk=disk_ttl
+        )
 
-    return MultiCache[ScheduleSnapshot](default=default_ttl)
+    return MultiCache[ScheduleSnapshot](
+        revalidate_after=revalidate_after, default=default_ttl
+    )
 
 
 def _schedule_snapshot_cache() -> MultiCache[_ScheduleFreshness]:
     return _schedule_snapshot_cache_for_config(
         settings.TIMETABLE_SNAPSHOT_CACHE_DEFAULT_TTL,
         settings.TIMETABLE_SNAPSHOT_CACHE_DISK_TTL,
+        settings.TIMETABLE_SNAPSHOT_CACHE_REVALIDATE_AFTER,
     )
 
 
@@ -113,12 +120,17 @@ def _semester_freshness_cache() -> MultiCache[Semester]:
         raise ValueError(
             "TIMETABLE_SEMESTER_FRESHNESS_CACHE_DEFAULT_TTL must not be None"
         )
-    return MultiCache[Semester](default=ttl)
+    return MultiCache[Semester](
+        revalidate_after=settings.TIMETABLE_SEMESTER_FRESHNESS_CACHE_REVALIDATE_AFTER,
+        **local_layer(),
+        default=ttl,
+    )
 
 
 def get_schedule_snapshot(semester: Semester, student_slug: str) -> ScheduleSnapshot:
-    def get_cached_value(cache: MultiCache, key: str, cache_name: str):
-        result = cache.get(key)
+    def repair_cached_none(
+        cache: MultiCache, key: str, result: CacheResult, cache_name: str
+    ) -> CacheResult:
         if result.hit and result.value is None:
             logger.warning(
                 "Cached %s unexpectedly None for key %s; invalidating and rebuilding",
@@ -126,21 +138,32 @@ def get_schedule_snapshot(semester: Semester, student_slug: str) -> ScheduleSnap
                 key,
             )
             cache.delete(key)
-            return cache.get(key)
+            return CacheResult(hit=False)
         return result
 
     schedule_key = schedule_snapshot_cache_key(semester, student_slug)
     snapshot_cache = _schedule_snapshot_cache()
-    cached_schedule = get_cached_value(
-        snapshot_cache, schedule_key, "schedule snapshot"
-    )
-
     semester_key = semester_freshness_cache_key(semester)
     semester_cache = _semester_freshness_cache()
-    cached_semester = get_cached_value(
-        semester_cache, semester_key, "semester freshness"
+
+    cached_schedule, cached_semester = get_many(
+        [(snapshot_cache, schedule_key), (semester_cache, semester_key)]
+    )
+    cached_schedule = repair_cached_none(
+        snapshot_cache, schedule_key, cached_schedule, "schedule snapshot"
+    )
+    cached_semester = repair_cached_none(
+        semester_cache, semester_key, cached_semester, "semester freshness"
     )
 
+    # Stale entries are still served, refreshed off the request path.
+    if cached_schedule.stale:
+        snapshot_cache.revalidate(
+            schedule_key, lambda: _load_schedule_freshness(semester, student_slug)[1]
+        )
+    if cached_semester.stale:
+        semester_cache.revalidate(semester_key, lambda: _load_semester(semester))
+
     if (
         cached_semester.hit
         and cached_semester.value is not None
@@ -150,12 +173,28 @@ def get_schedule_snapshot(semester: Semester, student_slug: str) -> ScheduleSnap
         return _compose_snapshot(cached_semester.value, cached_schedule.value)
 
     if cached_schedule.hit and cached_schedule.value is not None:
-        cached_semester_value = Semester.objects.get(
-            year=semester.year, type=semester.type
-        )
+        cached_semester_value = _load_semester(semester)
         semester_cache.set(semester_key, cached_semester_value)
         return _compose_snapshot(cached_semester_value, cached_schedule.value)
 
+    cached_semester_value, cached_schedule_value = _load_schedule_freshness(
+        semester, student_slug
+    )
+
+    if not cached_semester.hit:
+        semester_cache.set(semester_key, cached_semester_value)
+    if not cached_schedule.hit:
+        snapshot_cache.set(schedule_key, cached_schedule_value)
+    return _compose_snapshot(cached_semester_value, cached_schedule_value)
+
+
+def _load_semester(semester: Semester) -> Semester:
+    return Semester.objects.get(year=semester.year, type=semester.type)
+
+
+def _load_schedule_freshness(
+    semester: Semester, student_slug: str
+) -> tuple[Semester, _ScheduleFreshness]:
     try:
         schedule_row = ScheduleModel.objects.select_related("semester", "student").get(
             semester__year=semester.year,
@@ -164,35 +203,47 @@ def get_schedule_snapshot(semester: Semester, student_slug: str) -> ScheduleSnap
         )
     except ScheduleModel.DoesNotExist:
         try:
-            cached_semester_value = Semester.objects.get(
-                year=semester.year, type=semester.type
-            )
+            semester = _load_semester(semester)
         except Semester.DoesNotExist:
             raise ScheduleSnapshotNotFound(
                 f"Could not find semester: year={semester.year} type={semester.type}"
             )
-        cached_schedule_value = _build_schedule_freshness_legacy_fallback(
-            semester=cached_semester_value,
+        return semester, _build_schedule_freshness_legacy_fallback(
+            semester=semester,
             student_slug=student_slug,
         )
-    else:
-        cached_semester_value = schedule_row.semester
-        cached_schedule_value = _ScheduleFreshness(
-            student=schedule_row.student,
-            last_modified=(
-                int(schedule_row.last_modified.timestamp())
-                if schedule_row.last_modified
-                else None
+    return schedule_row.semester, _schedule_freshness(schedule_row)
+
+
+def iter_schedule_snapshots(
+    semester: Semester, student_ids, chunk_size: int = 2000
+) -> Iterator[ScheduleSnapshot]:
+    """Yield snapshots of many students in ``semester``, ordered by student id.
+
+    Meant for batch jobs: schedules are streamed from one query instead of a
+    cache lookup and query per student, and the caches are left alone. Unknown
+    student ids are skipped.
+    """
+    semester = _load_semester(semester)
+    missing = set(student_ids)
+    rows = (
+        ScheduleModel.objects.filter(semester_id=semester.id, student_id__in=missing)
+        .select_related("student")
+        .order_by("student_id")
+    )
+    for row in rows.iterator(chunk_size=chunk_size):
+        missing.discard(row.student_id)
+        yield _compose_snapshot(semester, _schedule_freshness(row))
+
+    # Students without a schedule row predate freshness tracking.
+    for student in Student.objects.filter(id__in=missing).order_by("id"):
+        yield _compose_snapshot(
+            semester,
+            _build_schedule_freshness_legacy_fallback(
+                semester=semester, student_slug=student.slug
             ),
-            version=schedule_row.version,
         )
 
-    if not cached_semester.hit:
-        semester_cache.set(semester_key, cached_semester_value)
-    if not cached_schedule.hit:
-        snapshot_cache.set(schedule_key, cached_schedule_value)
-    return _compose_snapshot(cached_semester_value, cached_schedule_value)
-
 
 def bump_snapshot(snapshot: ScheduleSnapshot) -> None:
     if snapshot.student.id is None:
@@ -226,6 +277,16 @@ def _compose_snapshot(
     )
 
 
+def _schedule_freshness(row: ScheduleModel) -> _ScheduleFreshness:
+    return _ScheduleFreshness(
+        student=row.student,
+        last_modified=(
+            int(row.last_modified.timestamp()) if row.last_modified else None
+        ),
+        version=row.version,
+    )
+
+
 def _build_schedule_freshness_legacy_fallback(
     *,
     semester: Semester,
@@ -0,0 +1,327 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+"""Disk cache backend storing entries in sharded SQLite databases.
+
+``FileBasedCache`` keeps one file per entry and culls by listing the whole
+directory, which stalls writes for seconds at our entry counts. Here every
+shard is a WAL mode SQLite database with the key as primary key and indexes
+on expiry and last access, so lookups are single index probes and culling
+deletes the least recently used rows of one shard at a time. Reads go through
+SQLite's memory mapped I/O instead of a file open per entry.
+
+Keys are spread over ``SHARDS`` databases to keep writers from different
+processes from waiting on the same database lock. Integers are stored as
+SQLite integers instead of pickles, so ``incr`` is a single ``UPDATE``.
+"""
+
+import contextlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)
+    WHERE expires IS NOT NULL;
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+"""
+
+# Access times are only rewritten when older than this, so hot reads do not
+# turn into writes. LRU order is accurate to this many seconds.
+_ACCESS_RESOLUTION = 60
+
+# Shards drop expired entries every this many writes.
+_CULL_CHECK_INTERVAL = 64
+
+# Milliseconds writes wait for another connection's lock. Access time updates
+# on the read path do not wait at all.
+_BUSY_TIMEOUT = 5000
+
+_MIN_INTEGER = -(2**63)
+_MAX_INTEGER = 2**63 - 1
+
+
+@contextlib.contextmanager
+def _transaction(connection: sqlite3.Connection):
+    # Connections are in autocommit mode, so batches need explicit
+    # transactions to be written with a single lock and fsync.
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._dir = Path(location)
+        self._shards = int(options.get("SHARDS", 8))
+        self._mmap_size = int(options.get("MMAP_SIZE", 256 * 1024 * 1024))
+        self._shard_max_entries = max(1, self._max_entries // self._shards)
+        self._local = threading.local()
+        self._writes = [0] * self._shards
+        # Rows per shard as seen by this process, counted on first write and
+        # then kept up to date by our own writes. Replaced keys are counted
+        # as new rows, so the estimate errs towards culling early, when the
+        # real count is taken again.
+        self._counts: list[int | None] = [None] * self._shards
+
+    def _connection(self, shard: int) -> sqlite3.Connection:
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # Connections must not cross a fork, uWSGI forks after imports.
+            local.pid = os.getpid()
+            local.connections = {}
+
+        connection = local.connections.get(shard)
+        if connection is None:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                self._dir / f"cache-{shard}.sqlite3",
+                timeout=_BUSY_TIMEOUT / 1000,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={self._mmap_size}")
+            connection.executescript(_SCHEMA)
+            local.connections[shard] = connection
+        return connection
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % self._shards
+
+    def _expiry(self, timeout) -> float | None:
+        return self.get_backend_timeout(timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        shard = self._shard(key)
+        connection = self._connection(shard)
+        now = time.time()
+        connection.execute(
+            "DELETE FROM cache WHERE key = ? AND expires <= ?", (key, now)
+        )
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?)",
+            (key, self._dumps(value), self._expiry(timeout), int(now)),
+        )
+        self._wrote(shard, connection, cursor.rowcount)
+        return cursor.rowcount == 1
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection(self._shard(key))
+        now = time.time()
+        row = connection.execute(
+            "SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return default
+        self._accessed(connection, [(key, row[2])], now)
+        return self._loads(row[0])
+
+    def get_many(self, keys, version=None):
+        by_shard: dict[int, dict[str, str]] = {}
+        for key in keys:
+            made = self.make_and_validate_key(key, version=version)
+            by_shard.setdefault(self._shard(made), {})[made] = key
+
+        now = time.time()
+        result = {}
+        for shard, shard_keys in by_shard.items():
+            connection = self._connection(shard)
+            placeholders = ", ".join("?" * len(shard_keys))
+            rows = connection.execute(
+                "SELECT key, value, accessed FROM cache"
+                f" WHERE key IN ({placeholders})"
+                " AND (expires IS NULL OR expires > ?)",
+                [*shard_keys, now],
+            ).fetchall()
+            for made, value, _accessed in rows:
+                result[shard_keys[made]] = self._loads(value)
+            self._accessed(connection, [(row[0], row[2]) for row in rows], now)
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        shard = self._shard(key)
+        connection = self._connection(shard)
+        connection.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (key, self._dumps(value), self._expiry(timeout), int(time.time())),
+        )
+        self._wrote(shard, connection, 1)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self._expiry(timeout)
+        now = int(time.time())
+        by_shard: dict[int, list[tuple]] = {}
+        for key, value in data.items():
+            key = self.make_and_validate_key(key, version=version)
+            by_shard.setdefault(self._shard(key), []).append(
+                (key, self._dumps(value), expires, now)
+            )
+
+        for shard, rows in by_shard.items():
+            connection = self._connection(shard)
+            with _transaction(connection):
+                connection.executemany(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", rows
+                )
+            self._wrote(shard, connection, len(rows))
+        return []
+
+    def incr(self, key, delta=1, version=None):
+        made = self.make_and_validate_key(key, version=version)
+        row = (
+            self._connection(self._shard(made))
+            .execute(
+                "UPDATE cache SET value = value + ?"
+                " WHERE key = ? AND typeof(value) = 'integer'"
+                " AND (expires IS NULL OR expires > ?)"
+                " RETURNING value",
+                (delta, made, time.time()),
+            )
+            .fetchone()
+        )
+        if row is None:
+            # Missing keys raise, pickled numbers are updated the slow way.
+            return super().incr(key, delta, version=version)
+        return row[0]
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection(self._shard(key))
+        cursor = connection.execute(
+            "UPDATE cache SET expires = ? WHERE key = ?"
+            " AND (expires IS NULL OR expires > ?)",
+            (self._expiry(timeout), key, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        shard = self._shard(key)
+        cursor = self._connection(shard).execute(
+            "DELETE FROM cache WHERE key = ?", (key,)
+        )
+        self._removed(shard, cursor.rowcount)
+        return cursor.rowcount == 1
+
+    def delete_many(self, keys, version=None):
+        by_shard: dict[int, list[tuple[str]]] = {}
+        for key in keys:
+            key = self.make_and_validate_key(key, version=version)
+            by_shard.setdefault(self._shard(key), []).append((key,))
+
+        for shard, rows in by_shard.items():
+            connection = self._connection(shard)
+            with _transaction(connection):
+                cursor = connection.executemany("DELETE FROM cache WHERE key = ?", rows)
+            self._removed(shard, cursor.rowcount)
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection(self._shard(key))
+        row = connection.execute(
+            "SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return row is not None
+
+    def clear(self):
+        for shard in range(self._shards):
+            self._connection(shard).execute("DELETE FROM cache")
+            self._counts[shard] = 0
+
+    def _dumps(self, value) -> bytes | int:
+        if type(value) is int and _MIN_INTEGER <= value <= _MAX_INTEGER:
+            return value
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, value: bytes | int):
+        if isinstance(value, int):
+            return value
+        return pickle.loads(value)
+
+    def _accessed(self, connection, rows: list[tuple[str, int]], now: float) -> None:
+        stale = [key for key, accessed in rows if now - accessed > _ACCESS_RESOLUTION]
+        if not stale:
+            return
+        # Reads must not queue behind another process's write for an access
+        # time, so give up on the lock right away instead.
+        connection.execute("PRAGMA busy_timeout = 0")
+        try:
+            connection.executemany(
+                "UPDATE cache SET accessed = ? WHERE key = ?",
+                [(int(now), key) for key in stale],
+            )
+        except sqlite3.OperationalError:
+            # Another writer holds the lock, the access time is best effort.
+            pass
+        finally:
+            connection.execute(f"PRAGMA busy_timeout = {_BUSY_TIMEOUT}")
+
+    def _wrote(self, shard: int, connection: sqlite3.Connection, rows: int) -> None:
+        count = self._counts[shard]
+        if count is None:
+            (count,) = connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+        else:
+            count += rows
+        self._counts[shard] = count
+
+        writes = self._writes[shard]
+        self._writes[shard] += max(1, rows)
+        if (
+            writes // _CULL_CHECK_INTERVAL
+            != self._writes[shard] // _CULL_CHECK_INTERVAL
+        ):
+            cursor = connection.execute(
+                "DELETE FROM cache WHERE expires <= ?", (time.time(),)
+            )
+            self._removed(shard, cursor.rowcount)
+        if self._counts[shard] > self._shard_max_entries:
+            self._cull(shard, connection)
+
+    def _removed(self, shard: int, rows: int) -> None:
+        if self._counts[shard] is not None:
+            self._counts[shard] = max(0, self._counts[shard] - rows)
+
+    def _cull(self, shard: int, connection: sqlite3.Connection) -> None:
+        # Only now take the real count, the estimate may be off either way.
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        (count,) = connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+        self._counts[shard] = count
+        excess = count - self._shard_max_entries
+        if excess <= 0:
+            return
+        if not self._cull_frequency:
+            connection.execute("DELETE FROM cache")
+            self._counts[shard] = 0
+            return
+        # Like FileBasedCache drop a fraction of the shard and not just the
+        # excess, so the next write does not have to cull again.
+        cursor = connection.execute(
+            "DELETE FROM cache WHERE key IN ("
+            " SELECT key FROM cache ORDER BY accessed LIMIT ?"
+            ")",
+            (excess + count // self._cull_frequency,),
+        )
+        self._removed(shard, cursor.rowcount)
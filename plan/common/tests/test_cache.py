@@ -1,8 +1,14 @@
+import threading
+import time
+from unittest import mock
+
 import pytest
 
 from django.core.cache import caches
 from django.test import override_settings
 
+from plan.common import cache as cache_module
+from plan.common import snapshot
 from plan.common.cache import CacheResult, MultiCache
 
 
@@ -73,3 +79,256 @@ def test_get_can_distinguish_cached_none_from_miss(cache_settings):
 def test_init_requires_configured_cache_names(cache_settings):
     with pytest.raises(ValueError, match="could not find cache layer 'missing'"):
         MultiCache(l1=60, missing=300)
+
+
+def test_get_or_compute_stores_computed_value(cache: MultiCache[str]):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "value"
+
+    assert cache.get_or_compute("key", compute) == "value"
+    assert cache.get_or_compute("key", compute) == "value"
+    assert calls == [1]
+    assert caches["l2"].get("key") == "value"
+    assert caches["l1"].get("lease:key") is None
+
+
+def test_get_or_compute_runs_one_computation_per_key(cache: MultiCache[str]):
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return "value"
+
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_compute("key", compute))
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ["value"] * 8
+
+
+def test_get_or_compute_waits_for_lease_holder(cache: MultiCache[str], monkeypatch):
+    monkeypatch.setattr(cache_module, "LEASE_POLL", 0.01)
+    caches["l1"].add("lease:key", "other-worker", 30)
+    timer = threading.Timer(0.05, cache.set, ["key", "theirs"])
+    timer.start()
+
+    try:
+        assert cache.get_or_compute("key", lambda: "ours", wait=5) == "theirs"
+    finally:
+        timer.cancel()
+
+
+def test_get_or_compute_wait_is_bounded(cache: MultiCache[str], monkeypatch):
+    monkeypatch.setattr(cache_module, "LEASE_POLL", 0.01)
+    caches["l1"].add("lease:key", "stuck-worker", 30)
+
+    assert cache.get_or_compute("key", lambda: "ours", wait=0.05) == "ours"
+    assert caches["l1"].get("lease:key") == "stuck-worker"
+
+
+def test_get_or_compute_takes_lease_on_shared_layer(monkeypatch):
+    monkeypatch.setattr(cache_module, "LEASE_POLL", 0.01)
+    cache_configuration = {
+        "local": {"BACKEND": "plan.common.local_cache.LocalLRUCache"},
+        "l1": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "test-l1",
+        },
+    }
+    with override_settings(CACHES=cache_configuration):
+        caches["l1"].clear()
+        cache = MultiCache[str](local=60, l1=300)
+        caches["l1"].add("lease:key", "other-process", 30)
+        timer = threading.Timer(0.05, caches["l1"].set, ["key", "theirs"])
+        timer.start()
+
+        try:
+            assert cache.get_or_compute("key", lambda: "ours", wait=5) == "theirs"
+        finally:
+            timer.cancel()
+            caches["l1"].clear()
+            caches["local"].clear()
+
+
+def test_get_flags_entries_past_revalidate_after_as_stale(cache_settings):
+    cache = MultiCache[str](revalidate_after=60, l1=300)
+    cache.set("fresh", "value")
+    caches["l1"].set("stale", cache_module._Entry("value", 0), 300)
+
+    assert cache.get("fresh") == CacheResult(hit=True, value="value")
+    assert cache.get("stale") == CacheResult(hit=True, value="value", stale=True)
+
+
+def test_get_or_compute_serves_stale_value_while_revalidating(cache_settings):
+    cache = MultiCache[str](revalidate_after=60, l1=300)
+    caches["l1"].set("key", cache_module._Entry("old", 0), 300)
+
+    assert cache.get_or_compute("key", lambda: "new") == "old"
+    cache_module.flush_for_tests()
+
+    assert cache.get("key") == CacheResult(hit=True, value="new")
+
+
+def test_revalidate_queues_one_refresh_per_key(cache_settings):
+    cache = MultiCache[str](revalidate_after=60, l1=300)
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return "new"
+
+    assert cache.revalidate("key", compute)
+    started.wait(5)
+    assert not cache.revalidate("key", compute)
+    release.set()
+    cache_module.flush_for_tests()
+
+    assert cache.get("key").value == "new"
+    assert cache.revalidate("key", lambda: "newer")
+    cache_module.flush_for_tests()
+
+
+def test_semester_freshness_revalidation_leases_outside_the_process(
+    settings, cache_isolation
+):
+    settings.TIMETABLE_LOCAL_CACHE_TTL = 60
+    cache = snapshot._semester_freshness_cache()
+    caches["default"].add("lease:key", "other-process", 30)
+    calls = []
+
+    assert cache.layers[0][0] == "local"
+    assert cache.revalidate("key", lambda: calls.append(1))
+    cache_module.flush_for_tests()
+
+    assert calls == []
+
+
+def test_revalidate_resolves_placeholders_flush_for_tests_waits_on(cache_settings):
+    cache = MultiCache[str](revalidate_after=60, l1=300)
+    pool = cache_module._get_revalidate_pool()
+    real_submit = pool.submit
+    placeholders = []
+
+    def submit(*args):
+        # Like flush_for_tests() running before the real future is published.
+        placeholders.extend(cache_module._revalidations.values())
+        return real_submit(*args)
+
+    def shutdown(*args):
+        placeholders.extend(cache_module._revalidations.values())
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+    with mock.patch.object(pool, "submit", side_effect=submit):
+        assert cache.revalidate("key", lambda: "new")
+    with mock.patch.object(pool, "submit", side_effect=shutdown):
+        assert not cache.revalidate("other", lambda: "new")
+
+    _done, pending = cache_module.futures.wait(placeholders, timeout=5)
+    assert len(placeholders) >= 2
+    assert not pending
+
+
+def test_get_many_reads_each_layer_once_and_promotes_misses(cache: MultiCache[str]):
+    caches["l1"].set("a", "first", timeout=60)
+    caches["l2"].set("b", "second", timeout=300)
+
+    with (
+        mock.patch.object(caches["l1"], "get_many", wraps=caches["l1"].get_many) as a,
+        mock.patch.object(caches["l2"], "get_many", wraps=caches["l2"].get_many) as b,
+    ):
+        results = cache.get_many(["a", "b", "c"])
+
+    assert results == {
+        "a": CacheResult(hit=True, value="first"),
+        "b": CacheResult(hit=True, value="second"),
+        "c": CacheResult(hit=False),
+    }
+    assert a.call_count == 1
+    assert b.call_count == 1
+    assert caches["l1"].get("b") == "second"
+    assert caches["l1"].get("c") is None
+
+
+def test_get_many_shares_layers_between_caches(cache_settings):
+    first = MultiCache[str](l1=60, l2=300)
+    second = MultiCache[str](l1=60)
+    caches["l1"].set("a", "first", timeout=60)
+    caches["l1"].set("b", "second", timeout=60)
+
+    with mock.patch.object(
+        caches["l1"], "get_many", wraps=caches["l1"].get_many
+    ) as get_many:
+        results = cache_module.get_many([(first, "a"), (second, "b")])
+
+    assert results == [
+        CacheResult(hit=True, value="first"),
+        CacheResult(hit=True, value="second"),
+    ]
+    get_many.assert_called_once()
+
+
+def test_set_many_writes_to_all_layers(cache: MultiCache[str]):
+    cache.set_many({"a": "first", "b": "second"})
+
+    assert caches["l1"].get_many(["a", "b"]) == {"a": "first", "b": "second"}
+    assert caches["l2"].get_many(["a", "b"]) == {"a": "first", "b": "second"}
+
+
+def test_single_flight_shares_value_with_concurrent_callers():
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return "value"
+
+    leader = threading.Thread(
+        target=lambda: results.append(cache_module.single_flight("key", compute))
+    )
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(
+        target=lambda: results.append(
+            cache_module.single_flight("key", lambda: "follower", wait=5)
+        )
+    )
+    follower.start()
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert sorted(results) == [("value", False), ("value", True)]
+    assert cache_module.single_flight("key", lambda: "next") == ("next", True)
+
+
+def test_single_flight_computes_when_waiting_times_out():
+    release = threading.Event()
+    leader = threading.Thread(
+        target=cache_module.single_flight, args=("key", lambda: release.wait(5))
+    )
+    leader.start()
+    try:
+        assert cache_module.single_flight("key", lambda: "own", wait=0.01) == (
+            "own",
+            True,
+        )
+    finally:
+        release.set()
+        leader.join(5)
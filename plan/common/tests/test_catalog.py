@@ -0,0 +1,82 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+import pytest
+
+from plan.common import catalog
+from plan.common.models import Lecture, Semester, Student
+
+pytestmark = pytest.mark.django_db
+
+
+def _semester_and_student(student_slug):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student = Student.objects.get(slug=student_slug)
+    return semester, student
+
+
+@pytest.mark.parametrize("slug", ["adamcik", "foo", "bar"])
+def test_get_schedule_rows_matches_single_query(
+    serialized_schedule_data, cache_isolation, frozen_time, slug
+):
+    semester, student = _semester_and_student(slug)
+
+    expected = Lecture.objects.get_schedule_rows(semester.id, student.id)
+    rows = catalog.get_schedule_rows(semester, student.id)
+
+    assert rows.lectures == expected.lectures
+    assert [(c.id, c.alias) for c in rows.courses] == [
+        (c.id, c.alias) for c in expected.courses
+    ]
+    assert [(e.id, e.alias) for e in rows.exams] == [
+        (e.id, e.alias) for e in expected.exams
+    ]
+    assert rows.groups == expected.groups
+    assert rows.rooms == expected.rooms
+
+
+@pytest.mark.parametrize("ttl", [None, 60])
+def test_iter_schedule_rows_matches_single_queries(
+    serialized_schedule_data, cache_isolation, frozen_time, settings, ttl
+):
+    settings.TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL = ttl
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student_ids = list(Student.objects.order_by("id").values_list("id", flat=True))
+
+    batch = list(catalog.iter_schedule_rows(semester, student_ids, chunk_size=1))
+
+    assert [pk for pk, _rows in batch] == student_ids
+    for pk, rows in batch:
+        expected = Lecture.objects.get_schedule_rows(semester.id, pk)
+        assert rows.lectures == expected.lectures
+        assert [c.id for c in rows.courses] == [c.id for c in expected.courses]
+        assert [e.id for e in rows.exams] == [e.id for e in expected.exams]
+
+
+def test_students_share_cached_course_catalogs(
+    serialized_schedule_data, cache_isolation, frozen_time, django_assert_num_queries
+):
+    semester, adamcik = _semester_and_student("adamcik")
+    _semester, foo = _semester_and_student("foo")
+    first = catalog.get_schedule_rows(semester, adamcik.id)
+
+    # Only the subscriptions are read, courses 1 and 2 come from the cache.
+    with django_assert_num_queries(1):
+        second = catalog.get_schedule_rows(semester, foo.id)
+
+    assert {c.id for c in second.courses} <= {c.id for c in first.courses}
+    assert second.lectures == Lecture.objects.get_lectures_data(semester.id, foo.id)
+
+
+def test_course_catalogs_are_keyed_by_semester_version(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    semester, student = _semester_and_student("adamcik")
+    catalog.get_schedule_rows(semester, student.id)
+    Lecture.objects.filter(course_id=1).update(title="Changed")
+
+    cached = catalog.get_schedule_rows(semester, student.id)
+    assert "Changed" not in {lecture.title for lecture in cached.lectures}
+
+    semester.version += 1
+    fresh = catalog.get_schedule_rows(semester, student.id)
+    assert "Changed" in {lecture.title for lecture in fresh.lectures}
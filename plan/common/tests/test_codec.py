@@ -0,0 +1,70 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+import pickle
+
+import pytest
+
+from plan.common import codec, views
+from plan.common.models import Semester, Student
+from plan.common.snapshot import ScheduleSnapshot
+
+pytestmark = pytest.mark.django_db
+
+
+def _schedule_data(slug="adamcik"):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student = Student.objects.get(slug=slug)
+    snapshot = ScheduleSnapshot(semester=semester, student=student, last_modified=1)
+    return views._schedule_data(snapshot)
+
+
+def test_lectures_round_trip(serialized_schedule_data, cache_isolation, frozen_time):
+    lectures = _schedule_data().lectures
+    assert lectures
+
+    assert codec.decode_lectures(codec.encode_lectures(lectures)) == lectures
+
+
+@pytest.mark.parametrize("slug", ["adamcik", "foo", "bar"])
+def test_schedule_data_round_trip(
+    serialized_schedule_data, cache_isolation, frozen_time, slug
+):
+    data = _schedule_data(slug)
+
+    decoded = codec.decode_schedule_data(codec.encode_schedule_data(data))
+
+    assert decoded.lectures == data.lectures
+    assert decoded.groups == data.groups
+    assert decoded.rooms == data.rooms
+    assert decoded.weeks == list(data.weeks)
+    assert [(c.id, c.code, c.name, c.alias) for c in decoded.courses] == [
+        (c.id, c.code, c.name, c.alias) for c in data.courses
+    ]
+    assert {
+        course_id: [(e.id, e.exam_date, e.exam_time, e.type, e.alias) for e in exams]
+        for course_id, exams in decoded.exams.items()
+    } == {
+        course_id: [(e.id, e.exam_date, e.exam_time, e.type, e.alias) for e in exams]
+        for course_id, exams in data.exams.items()
+    }
+
+
+def test_schedule_data_is_smaller_than_pickle(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    data = _schedule_data()
+
+    assert len(codec.encode_schedule_data(data)) < len(pickle.dumps(data))
+
+
+def test_every_model_field_is_encoded_or_skipped():
+    for model, fields in codec._ENCODED_FIELDS.items():
+        concrete = {field.attname for field in model._meta.concrete_fields}
+        assert concrete - codec._SKIPPED_FIELDS == set(fields), model
+
+
+def test_decode_rejects_unknown_payloads():
+    with pytest.raises(codec.CodecError):
+        codec.decode_schedule_data(b"")
+    with pytest.raises(codec.CodecError):
+        codec.decode_schedule_data(b"PLSD\xff" + b"\x00" * 8)
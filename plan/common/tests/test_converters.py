@@ -74,9 +74,9 @@ def test_to_python_stores_split_freshness_entries_under_stable_keys(
     semester_key = semester_freshness_cache_key(semester)
 
     cached_schedule = caches["default"].get(schedule_key)
-    assert cached_schedule.student.slug == student.slug
-    assert cached_schedule.version == schedule.version
-    assert caches["default"].get(semester_key) == schedule.semester
+    assert cached_schedule.value.student.slug == student.slug
+    assert cached_schedule.value.version == schedule.version
+    assert caches["default"].get(semester_key).value == schedule.semester
     assert caches["disk"].get(schedule_key) == cached_schedule
 
 
@@ -118,6 +118,25 @@ def test_to_python_cache_hit_does_not_query_db(
     assert cached.semester.id == semester.id
 
 
+def test_cache_hit_reads_snapshot_and_semester_in_one_round_trip(
+    serialized_schedule_data, cache_isolation
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student = Student.objects.get(slug="adamcik")
+    get_schedule_snapshot(semester, student.slug)
+    default = caches["default"]
+
+    with mock.patch.object(default, "get_many", wraps=default.get_many) as get_many:
+        get_schedule_snapshot(semester, student.slug)
+
+    get_many.assert_called_once_with(
+        {
+            schedule_snapshot_cache_key(semester, student.slug),
+            semester_freshness_cache_key(semester),
+        }
+    )
+
+
 def test_semester_invalidation_refreshes_freshness_without_deleting_user_entry(
     serialized_schedule_data, cache_isolation
 ):
@@ -250,8 +269,8 @@ def test_to_python_fallback_without_schedule_row_sets_dto_and_cache_key(
     assert schedule.last_modified is not None
     assert schedule.last_modified >= int(ts.timestamp())
     assert schedule.last_modified >= int(semester.last_modified.timestamp())
-    assert caches["default"].get(key).student.slug == student.slug
-    assert caches["disk"].get(key).student.slug == student.slug
+    assert caches["default"].get(key).value.student.slug == student.slug
+    assert caches["disk"].get(key).value.student.slug == student.slug
 
 
 def test_to_python_disk_user_cache_hit_promotes_to_default(
@@ -269,7 +288,7 @@ def test_to_python_disk_user_cache_hit_promotes_to_default(
         result = get_schedule_snapshot(semester, student.slug)
 
     assert result == cached
-    assert caches["default"].get(key).student.slug == result.student.slug
+    assert caches["default"].get(key).value.student.slug == result.student.slug
 
 
 def test_to_python_does_not_write_disk_layer_when_disabled(
@@ -282,7 +301,7 @@ def test_to_python_does_not_write_disk_layer_when_disabled(
 
     schedule = get_schedule_snapshot(semester, student.slug)
 
-    assert caches["default"].get(key).student.slug == schedule.student.slug
+    assert caches["default"].get(key).value.student.slug == schedule.student.slug
     assert caches["disk"].get(key) is None
 
 
@@ -300,7 +319,7 @@ def test_cached_none_is_invalidated_and_rebuilt(
 
     assert key in caplog.text
     assert schedule is not None
-    assert caches["default"].get(key).student.slug == schedule.student.slug
+    assert caches["default"].get(key).value.student.slug == schedule.student.slug
 
 
 def test_delete_schedule_snapshot_cache_skips_missing_disk(
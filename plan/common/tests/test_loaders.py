@@ -0,0 +1,47 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+from django.template import Context, Engine
+
+TEMPLATES = {
+    "base.html": "<html>\n  <body>\n    {% block bd %}{% endblock %}\n  </body>\n</html>",
+    "page.html": (
+        '{% extends "base.html" %}{% load i18n %}'
+        "{% block bd %}\n    <p>{{ name }}</p>\n"
+        "    {% if name %}\n      <b>yes</b>\n    {% endif %}\n"
+        "    {% blocktrans %}Hello\n    world{% endblocktrans %}\n{% endblock %}"
+    ),
+}
+
+
+def _engine():
+    return Engine(
+        loaders=[
+            (
+                "plan.common.loaders.MinifyingLoader",
+                [("django.template.loaders.locmem.Loader", TEMPLATES)],
+            )
+        ],
+        libraries={"i18n": "django.templatetags.i18n"},
+    )
+
+
+def test_minifying_loader_collapses_whitespace_in_template_text(settings):
+    settings.COMPRESS_ENABLED = True
+
+    rendered = _engine().get_template("page.html").render(Context({"name": "a  b"}))
+
+    assert rendered.startswith("<html> <body> ")
+    assert rendered.endswith(" </body> </html>")
+    assert "<p>a  b</p>" in rendered
+    assert " <b>yes</b> " in rendered
+    # Translated strings keep their whitespace so they match the catalog.
+    assert "Hello\n    world" in rendered
+    assert rendered.count("\n") == 1
+
+
+def test_minifying_loader_is_disabled_without_compression(settings):
+    settings.COMPRESS_ENABLED = False
+
+    rendered = _engine().get_template("page.html").render(Context({"name": "a"}))
+
+    assert "<html>\n  <body>" in rendered
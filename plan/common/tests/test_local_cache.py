@@ -0,0 +1,81 @@
+import pickle
+import threading
+from collections.abc import Iterator
+from unittest import mock
+
+import pytest
+
+from plan.common.local_cache import LocalLRUCache
+
+
+def _size(key, value):
+    return len(f":1:{key}") + len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+@pytest.fixture
+def local() -> Iterator[LocalLRUCache]:
+    max_bytes = _size("a", "x" * 100) * 2
+    cache = LocalLRUCache("test-local", {"OPTIONS": {"MAX_BYTES": max_bytes}})
+    yield cache
+    cache.clear()
+
+
+def test_returns_stored_objects_without_copying(local: LocalLRUCache):
+    value = {"key": ["value"]}
+    local.set("key", value)
+
+    assert local.get("key") is value
+    assert local.get("missing", "default") == "default"
+
+
+def test_evicts_least_recently_used_entries_past_max_bytes(local: LocalLRUCache):
+    local.set("a", "x" * 100)
+    local.set("b", "y" * 100)
+    local.get("a")
+
+    with mock.patch("plan.common.local_cache.record_evictions") as evictions:
+        local.set("c", "z" * 100)
+
+    assert local.get("a") == "x" * 100
+    assert local.get("b") is None
+    assert local.get("c") == "z" * 100
+    assert local.size <= local._max_bytes
+    evictions.assert_called_once_with(local, 1)
+
+
+def test_skips_values_larger_than_max_bytes(local: LocalLRUCache):
+    assert not local.add("big", "x" * 1000)
+    assert local.get("big") is None
+    assert local.size == 0
+
+
+def test_entries_expire_after_their_timeout(local: LocalLRUCache):
+    local.set("key", "value", timeout=60)
+
+    with mock.patch("plan.common.local_cache.time.time", return_value=2**40):
+        assert local.get("key") is None
+
+    assert local.size == 0
+
+
+def test_keys_are_versioned(local: LocalLRUCache):
+    local.set("key", "old", version=1)
+    local.set("key", "new", version=2)
+
+    assert local.get("key", version=1) == "old"
+    assert local.get("key", version=2) == "new"
+    assert local.delete("key", version=1)
+    assert local.get("key", version=2) == "new"
+
+
+def test_instances_with_the_same_name_share_entries(local: LocalLRUCache):
+    local.set("key", "value")
+    instances = []
+    thread = threading.Thread(
+        target=lambda: instances.append(LocalLRUCache("test-local", {}))
+    )
+    thread.start()
+    thread.join()
+
+    assert instances[0].get("key") == "value"
+    assert instances[0].size == local.size
@@ -3,7 +3,9 @@
 from plan.common.models import (
     Course,
     Exam,
+    Group,
     Lecture,
+    Room,
     Semester,
     Student,
     Subscription,
@@ -51,3 +53,80 @@ def test_search(serialized_schedule_data, cache_isolation, frozen_time):
     courses = Course.objects.search(2009, Semester.SPRING, "COURSE1")
 
     assert set(control) == set(courses)
+
+
+def test_get_schedule_rows_matches_separate_queries(
+    serialized_schedule_data, cache_isolation, frozen_time, django_assert_num_queries
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student = Student.objects.get(slug="adamcik")
+    lectures = Lecture.objects.get_lectures_data(semester.id, student.id)
+    lecture_ids = [lecture.lecture_id for lecture in lectures]
+
+    with django_assert_num_queries(1):
+        rows = Lecture.objects.get_schedule_rows(semester.id, student.id)
+
+    assert rows.lectures == lectures
+    assert [(c.id, c.alias) for c in rows.courses] == [
+        (c.id, c.alias)
+        for c in Course.objects.get_courses(2009, Semester.SPRING, "adamcik")
+    ]
+    assert set(rows.exams) == set(
+        Exam.objects.get_exams(2009, Semester.SPRING, "adamcik")
+    )
+    assert all(exam.course in rows.courses for exam in rows.exams)
+    groups = Lecture.get_related(Group, lecture_ids, fields=["code"])
+    assert {k: sorted(v) for k, v in rows.groups.items()} == {
+        k: sorted(v) for k, v in groups.items()
+    }
+    rooms = Lecture.get_related(Room, lecture_ids, fields=["id", "name", "url"])
+    assert {k: sorted(v, key=str) for k, v in rows.rooms.items()} == {
+        k: sorted(v, key=str) for k, v in rooms.items()
+    }
+
+
+def test_iter_lectures_data_matches_per_student_queries(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    students = Student.objects.order_by("id")
+    expected = [
+        (student.id, Lecture.objects.get_lectures_data(semester.id, student.id))
+        for student in students
+    ]
+
+    batch = Lecture.objects.iter_lectures_data(
+        semester.id, [s.id for s in reversed(students)], chunk_size=2
+    )
+
+    assert list(batch) == [(pk, lectures) for pk, lectures in expected if lectures]
+
+
+def test_iter_schedule_rows_matches_per_student_queries(
+    serialized_schedule_data, cache_isolation, frozen_time, django_assert_num_queries
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    students = list(Student.objects.order_by("id"))
+    expected = [
+        Lecture.objects.get_schedule_rows(semester.id, student.id)
+        for student in students
+    ]
+
+    with django_assert_num_queries(1):
+        batch = list(
+            Lecture.objects.iter_schedule_rows(
+                semester.id, [s.id for s in reversed(students)], chunk_size=2
+            )
+        )
+
+    assert [pk for pk, _rows in batch] == [student.id for student in students]
+    for (_pk, rows), control in zip(batch, expected, strict=True):
+        assert rows.lectures == control.lectures
+        assert [(c.id, c.alias) for c in rows.courses] == [
+            (c.id, c.alias) for c in control.courses
+        ]
+        assert [(e.id, e.alias) for e in rows.exams] == [
+            (e.id, e.alias) for e in control.exams
+        ]
+        assert rows.groups == control.groups
+        assert rows.rooms == control.rooms
@@ -1,7 +1,19 @@
+import gzip
+import pickle
+
+import brotli
+
 from django.http import HttpResponse
 from django.urls import path
 
-from plan.common.middleware import AppendSlashMiddleware
+from plan.common.middleware import (
+    AppendSlashMiddleware,
+    ContentLengthMiddleware,
+    NonceTemplateResponse,
+    NonceTemplateStreamingResponse,
+    encoding_compatibility_middleware,
+)
+from plan.common.utils import compress_cacheable_response
 
 
 def _dummy_view(request):
@@ -24,3 +36,80 @@ def test_redirects_to_slash_appended_url(settings, rf):
 
     assert response.status_code == 301
     assert response["Location"] == "/foo/"
+
+
+def test_compressed_responses_are_decoded_for_clients_without_brotli(rf):
+    body = b"<html>" + b"<p>schedule</p>" * 100 + b"</html>"
+    compressed = compress_cacheable_response(HttpResponse(body))
+    middleware = encoding_compatibility_middleware(lambda req: compressed)
+
+    served = middleware(rf.get("/", HTTP_ACCEPT_ENCODING="gzip, br"))
+    assert served.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(served.content) == body
+
+    decoded = middleware(rf.get("/", HTTP_ACCEPT_ENCODING="gzip"))
+    assert "Content-Encoding" not in decoded
+    assert decoded.content == body
+    assert decoded.headers["Content-Length"] == str(len(body))
+
+
+def test_content_length_is_kept_for_compressed_responses(rf):
+    body = b"<html>" + b"<p>schedule</p>" * 100 + b"</html>"
+    compressed = compress_cacheable_response(
+        HttpResponse(body, content_type="text/html")
+    )
+    length = compressed.headers["Content-Length"]
+
+    response = ContentLengthMiddleware(lambda req: compressed).process_response(
+        rf.get("/"), compressed
+    )
+
+    assert response.headers["Content-Length"] == length
+    assert brotli.decompress(response.content) == body
+
+
+def test_nonce_template_response_splices_fresh_nonces():
+    placeholders = NonceTemplateResponse.PLACEHOLDERS
+    body = (
+        f'<style nonce="{placeholders["style"]}"></style>'
+        + "<p>schedule</p>" * 50
+        + f'<script nonce="{placeholders["script"]}"></script>'
+    ).encode()
+    cached = pickle.loads(
+        pickle.dumps(
+            NonceTemplateResponse.from_response(
+                HttpResponse(body, content_type="text/html")
+            )
+        )
+    )
+
+    assert cached.headers["Content-Encoding"] == "gzip"
+
+    for script, style in (("a1", "b1"), ("a2", "b2")):
+        response = cached.with_nonces(script=script, style=style)
+        expected = body.replace(placeholders["script"].encode(), script.encode())
+        expected = expected.replace(placeholders["style"].encode(), style.encode())
+        assert gzip.decompress(response.content) == expected
+        assert response.headers["Content-Length"] == str(len(response.content))
+
+
+def test_nonce_template_streaming_response_tees_cacheable_response():
+    placeholders = NonceTemplateResponse.PLACEHOLDERS
+    chunks = [
+        f'<script nonce="{placeholders["script"]}"></script>'.encode(),
+        b"<p>schedule</p>" * 50,
+    ]
+    stored = []
+    response = NonceTemplateStreamingResponse(iter(chunks))
+    response.tee(stored.append)
+    response.with_nonces(script="fresh", style="unused")
+
+    streamed = gzip.decompress(b"".join(response.streaming_content))
+
+    assert streamed == b'<script nonce="fresh"></script>' + chunks[1]
+    assert response.headers["Content-Encoding"] == "gzip"
+    [cached] = stored
+    assert isinstance(cached, NonceTemplateResponse)
+    assert gzip.decompress(cached.with_nonces(script="next").content) == (
+        b'<script nonce="next"></script>' + chunks[1]
+    )
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import time
+from unittest import mock
+
+import pytest
+
+from plan.common import sqlite_cache
+from plan.common.sqlite_cache import SQLiteCache
+
+
+@pytest.fixture
+def disk(tmp_path) -> SQLiteCache:
+    return SQLiteCache(str(tmp_path), {"OPTIONS": {"MAX_ENTRIES": 40, "SHARDS": 2}})
+
+
+def test_round_trips_values(disk: SQLiteCache):
+    disk.set("key", {"value": [1, 2, 3]})
+
+    assert disk.get("key") == {"value": [1, 2, 3]}
+    assert disk.get("missing", "default") == "default"
+    assert disk.has_key("key")
+    assert disk.delete("key")
+    assert not disk.has_key("key")
+
+
+def test_get_many_spans_shards(disk: SQLiteCache):
+    disk.set_many({f"key-{i}": i for i in range(10)})
+
+    assert disk.get_many([f"key-{i}" for i in range(12)]) == {
+        f"key-{i}": i for i in range(10)
+    }
+
+
+def test_add_only_writes_missing_or_expired_keys(disk: SQLiteCache):
+    assert disk.add("key", "first")
+    assert not disk.add("key", "second")
+    assert disk.get("key") == "first"
+
+    disk.set("expired", "old", timeout=-1)
+    assert disk.add("expired", "new")
+    assert disk.get("expired") == "new"
+
+
+def test_expired_entries_are_misses(disk: SQLiteCache):
+    disk.set("key", "value", timeout=60)
+
+    with mock.patch.object(sqlite_cache.time, "time", return_value=2**40):
+        assert disk.get("key") is None
+        assert disk.get_many(["key"]) == {}
+        assert not disk.touch("key")
+
+
+def test_culls_least_recently_used_entries(disk: SQLiteCache, monkeypatch):
+    monkeypatch.setattr(sqlite_cache, "_CULL_CHECK_INTERVAL", 1)
+    with mock.patch.object(sqlite_cache.time, "time", return_value=1000):
+        disk.set("old", "value")
+    for i in range(60):
+        disk.set(f"key-{i}", i)
+
+    assert disk.get("old") is None
+    assert sum(disk.has_key(f"key-{i}") for i in range(60)) <= 40
+    assert disk.has_key("key-59")
+
+
+def test_culls_full_shards_between_expiry_checks(disk: SQLiteCache):
+    for i in range(60):
+        disk.set(f"key-{i}", i)
+
+    assert sum(disk.has_key(f"key-{i}") for i in range(60)) <= 40
+
+
+def test_reads_do_not_wait_for_locked_shard(disk: SQLiteCache, tmp_path):
+    with mock.patch.object(sqlite_cache.time, "time", return_value=1000):
+        disk.set("key", "value", timeout=None)
+    shard = disk._shard(disk.make_and_validate_key("key"))
+    writer = sqlite3.connect(tmp_path / f"cache-{shard}.sqlite3")
+    writer.execute("BEGIN IMMEDIATE")
+
+    try:
+        started = time.monotonic()
+        assert disk.get("key") == "value"
+        assert disk.get_many(["key"]) == {"key": "value"}
+        assert time.monotonic() - started < 1
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def test_clear_empties_every_shard(disk: SQLiteCache, tmp_path):
+    disk.set_many({f"key-{i}": i for i in range(10)})
+
+    disk.clear()
+
+    assert disk.get_many([f"key-{i}" for i in range(10)]) == {}
+    assert {"cache-0.sqlite3", "cache-1.sqlite3"} <= set(os.listdir(tmp_path))
+
+
+def test_set_many_and_delete_many_write_each_shard_once(disk: SQLiteCache):
+    data = {f"key-{i}": i for i in range(10)}
+    statements = []
+    for shard in range(2):
+        disk._connection(shard).set_trace_callback(statements.append)
+
+    disk.set_many(data)
+    disk.delete_many(list(data)[:5])
+
+    assert statements.count("BEGIN IMMEDIATE") == 4
+    assert disk.get_many(list(data)) == {f"key-{i}": i for i in range(5, 10)}
+
+
+def test_incr_updates_stored_integers_in_place(disk: SQLiteCache, tmp_path):
+    disk.set("counter", 1)
+    disk.set("pickled", 2**70)
+
+    assert disk.incr("counter", 5) == 6
+    assert disk.decr("counter") == 5
+    assert disk.get("counter") == 5
+    assert disk.incr("pickled") == 2**70 + 1
+    with pytest.raises(ValueError):
+        disk.incr("missing")
+
+    key = disk.make_and_validate_key("counter")
+    with sqlite3.connect(tmp_path / f"cache-{disk._shard(key)}.sqlite3") as reader:
+        (kind,) = reader.execute(
+            "SELECT typeof(value) FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+    assert kind == "integer"
@@ -1,5 +1,7 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
+import datetime
+import pickle
 from copy import copy
 from dataclasses import replace
 from datetime import time
@@ -7,8 +9,16 @@ from datetime import time
 import pytest
 from django.utils import translation
 
+from plan.common.lecture_data import LectureData, Weekday
 from plan.common.models import Lecture, Semester, Student
-from plan.common.timetable import Timetable
+from plan.common.snapshot import ScheduleSnapshot
+from plan.common.timetable import (
+    MinuteTimetable,
+    Timetable,
+    WeekLayouts,
+    get_timetable,
+    week_mask,
+)
 
 
 pytestmark = pytest.mark.django_db
@@ -17,7 +27,6 @@ pytestmark = pytest.mark.django_db
 def test_timetable(serialized_schedule_data, cache_isolation, frozen_time):
     # FIXME test expansion
     # FIXME test instert times
-    # FIXME test map_to_slot
 
     # The shared fixture also loads lecture-event coverage not used by this legacy test.
     Lecture.objects.filter(pk=12).delete()
@@ -143,20 +152,289 @@ def test_insert_times_uses_24_hour_format_in_english_locale(
     assert timetable.table[0][0][0]["time"] == "08:15 - 09:00"
 
 
-def test_timetable_warns_about_unmappable_lectures(
+def test_lectures_outside_slots_are_flagged_when_loaded(
     serialized_schedule_data, cache_isolation, frozen_time, caplog
 ):
     semester = Semester.objects.get(year=2009, type=Semester.SPRING)
     student = Student.objects.get(slug="adamcik")
     lecture = Lecture.objects.get_lectures_data(semester.id, student.id)[0]
-    unmappable = replace(lecture, start=time(23, 45), end=time(23, 59, 59))
+    Lecture.objects.filter(pk=lecture.lecture_id).update(
+        start=time(23, 45), end=time(23, 59, 59)
+    )
 
-    timetable = Timetable([unmappable])
+    with caplog.at_level("WARNING", logger="plan.common.managers"):
+        lectures = Lecture.objects.get_lectures_data(semester.id, student.id)
+
+    unmappable = next(l for l in lectures if l.lecture_id == lecture.lecture_id)
+    assert unmappable.slots is None
+    assert caplog.messages == [
+        f"Lecture {lecture.lecture_id} at 23:45:00-23:59:59 is outside timetable slots"
+    ]
 
+    caplog.clear()
+    timetable = Timetable([unmappable])
     with caplog.at_level("WARNING", logger="plan.common.timetable"):
         timetable.place_lectures(week=None)
 
     assert timetable.lectures == []
-    assert caplog.messages == [
-        f"Skipping lecture {unmappable.lecture_id} outside timetable slots"
+    assert caplog.messages == []
+
+
+@pytest.mark.parametrize(
+    ("start", "end", "expected"),
+    [
+        (time(8, 15), time(9, 0), (0, 0)),
+        (time(8, 0), time(10, 0), (0, 1)),
+        (time(9, 0), time(9, 15), (1, 1)),
+        (time(8, 30), time(9, 30), (0, 1)),
+        (time(19, 15), time(23, 0), (11, 11)),
+        (time(20, 0), time(21, 0), None),
+        (time(10, 15), time(9, 0), None),
+    ],
+)
+def test_lecture_slots(start, end, expected):
+    lecture = _lecture(1, 0, start, end)
+
+    assert lecture.slots == expected
+    assert replace(lecture, start=time(8, 15), end=time(9, 0)).slots == (0, 0)
+
+
+def _lecture(lecture_id, day, start, end, **kwargs):
+    values = {
+        "lecture_id": lecture_id,
+        "title": None,
+        "summary": None,
+        "stream": None,
+        "day": Weekday(day),
+        "start": start,
+        "end": end,
+        "week_numbers": (1, 2),
+        "alias": None,
+        "exclude": False,
+        "course_id": 1,
+        "course_code": "COURSE1",
+        "course_name": "Course 1",
+        "type_id": None,
+        "type_code": None,
+        "type_name": None,
+        "type_optional": False,
+    }
+    values.update(kwargs)
+    return LectureData(**values)
+
+
+def test_timetable_expansion_claims_free_rows():
+    long = _lecture(1, 0, time(8, 15), time(10, 0))
+    short = _lecture(2, 0, time(8, 15), time(9, 0))
+    late = _lecture(3, 0, time(9, 15), time(10, 0))
+
+    timetable = Timetable([long, short, late])
+    timetable.place_lectures(week=None)
+    timetable.do_expansion()
+
+    assert timetable.span[0] == 2
+    assert [(l["l"].lecture_id, l["k"], l["width"]) for l in timetable.lectures] == [
+        (1, 0, 1),
+        (2, 1, 1),
+        (3, 1, 1),
+    ]
+    assert timetable.table[0][0][1] == {
+        "lecture": short,
+        "rowspan": 1,
+        "remove": False,
+        "bottom": False,
+        "colspan": 1,
+        "last": True,
+    }
+
+    timetable = Timetable([short, long])
+    timetable.place_lectures(week=None)
+    timetable.do_expansion()
+
+    assert timetable.span[0] == 2
+    assert timetable.table[0][0][0]["colspan"] == 1
+    assert timetable.table[1][0][0] == {}
+    assert timetable.table[0][0][1]["last"] is True
+
+
+def test_timetable_expansion_widens_lectures_into_empty_rows():
+    first = _lecture(1, 2, time(8, 15), time(9, 0))
+    second = _lecture(2, 2, time(8, 15), time(9, 0))
+    third = _lecture(3, 2, time(9, 15), time(11, 0))
+
+    timetable = Timetable([first, second, third])
+    timetable.place_lectures(week=2)
+    timetable.do_expansion()
+
+    assert [(l["k"], l["width"]) for l in timetable.lectures] == [
+        (0, 1),
+        (1, 1),
+        (0, 2),
     ]
+    assert timetable.table[1][2][0]["colspan"] == 2
+    assert timetable.table[1][2][0]["last"] is True
+    assert timetable.table[1][2][1] == {"remove": True}
+    assert timetable.table[2][2][1] == {"remove": True}
+
+
+def test_timetable_skips_excluded_lectures_and_other_weeks():
+    excluded = _lecture(1, 0, time(8, 15), time(9, 0), exclude=True)
+    other_week = _lecture(2, 0, time(8, 15), time(9, 0), week_numbers=(5,))
+
+    timetable = Timetable([excluded, other_week])
+    timetable.place_lectures(week=2)
+
+    assert timetable.lectures == []
+    assert timetable.table[0][0] == [{}]
+
+
+def test_minute_timetable_partitions_lectures_by_actual_times():
+    first = _lecture(1, 0, time(8, 15), time(9, 0))
+    overlapping = _lecture(2, 0, time(8, 30), time(9, 45))
+    after_first = _lecture(3, 0, time(9, 0), time(10, 0))
+    early = _lecture(4, 1, time(7, 0), time(7, 10))
+
+    timetable = MinuteTimetable([first, overlapping, after_first, early], 15)
+    timetable.place_lectures(week=None)
+    timetable.do_expansion()
+
+    assert timetable.origin == 7 * 60
+    assert timetable.slots == 52
+    assert timetable.span[:2] == [2, 1]
+    assert [
+        (l["l"].lecture_id, l["i"], l["j"], l["k"], l["height"], l["width"])
+        for l in timetable.lectures
+    ] == [
+        (1, 5, 0, 0, 3, 1),
+        (2, 6, 0, 1, 5, 1),
+        (3, 8, 0, 0, 4, 1),
+        (4, 0, 1, 0, 1, 1),
+    ]
+
+
+def test_minute_timetable_insert_times_and_layout_round_trip():
+    lecture = _lecture(1, 0, time(8, 20), time(20, 5))
+
+    timetable = MinuteTimetable([lecture], 30)
+    timetable.place_lectures(week=None)
+    timetable.do_expansion()
+    timetable.insert_times()
+    timetable.add_markers()
+
+    assert timetable.table[0][0][0]["time"] == "08:00 - 08:30"
+    assert timetable.table[-1][0][0]["time"] == "20:00 - 20:30"
+    assert timetable.lectures[0]["height"] == 25
+
+    rebuilt = MinuteTimetable.from_layout(timetable.to_layout(), [lecture])
+
+    assert rebuilt.table == timetable.table
+    assert rebuilt.occupied == timetable.occupied
+
+
+def test_week_mask():
+    assert week_mask(()) == 0
+    assert week_mask((1, 2, 53)) == (1 << 1) | (1 << 2) | (1 << 53)
+
+
+def test_week_layouts_share_layouts_for_weeks_with_the_same_lectures():
+    first = _lecture(1, 0, time(8, 15), time(9, 0), week_numbers=(1, 2, 3))
+    second = _lecture(2, 0, time(8, 15), time(10, 0), week_numbers=(2, 3))
+    excluded = _lecture(3, 1, time(8, 15), time(9, 0), exclude=True)
+
+    layouts = WeekLayouts([first, second, excluded])
+
+    assert layouts.layout(2) is layouts.layout(3)
+    assert layouts.layout(1) is not layouts.layout(2)
+    assert layouts.layout(None) is layouts.layout(2)
+    assert list(layouts.layouts()) == [None, 1, 2, 3]
+    assert [l["l"] for l in layouts.layout(1).lectures] == [first]
+    assert layouts.layout(4).lectures == []
+
+
+def test_week_layouts_match_single_week_placement(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student = Student.objects.get(slug="adamcik")
+    lectures = Lecture.objects.get_lectures_data(semester.id, student.id)
+    layouts = WeekLayouts(lectures)
+
+    for week in (None, 1, 2, 3, 10):
+        expected = Timetable(lectures)
+        expected.place_lectures(week)
+        expected.do_expansion()
+        expected.insert_times()
+        expected.add_markers()
+
+        timetable = layouts.timetable(semester.year, week)
+
+        assert timetable.table == expected.table
+        assert timetable.span == expected.span
+        assert timetable.lectures == expected.lectures
+
+
+def test_week_layouts_timetable_sets_dates_without_touching_shared_layout():
+    lecture = _lecture(1, 0, time(8, 15), time(9, 0), week_numbers=(2, 3))
+    layouts = WeekLayouts([lecture])
+
+    timetable = layouts.timetable(2009, 3)
+
+    assert timetable.date[0].date() == datetime.date(2009, 1, 12)
+    assert layouts.layout(3).date == [None] * 5
+    assert timetable.table is layouts.layout(3).table
+
+
+def test_timetable_layout_round_trips_through_pickle(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    student = Student.objects.get(slug="adamcik")
+    lectures = Lecture.objects.get_lectures_data(semester.id, student.id)
+    layouts = WeekLayouts(lectures)
+
+    for week in (None, 1, 2, 3, 10):
+        expected = layouts.layout(week)
+        layout = pickle.loads(pickle.dumps(expected.to_layout()))
+
+        timetable = Timetable.from_layout(layout, lectures)
+
+        assert timetable.table == expected.table
+        assert timetable.span == expected.span
+        assert timetable.lectures == expected.lectures
+        assert timetable.occupied == expected.occupied
+
+
+def test_get_timetable_reuses_cached_layout(cache_isolation, monkeypatch):
+    lecture = _lecture(1, 0, time(8, 15), time(9, 0), week_numbers=(2, 3))
+    snapshot = ScheduleSnapshot(
+        semester=Semester(year=2009, type=Semester.SPRING),
+        student=Student(slug="adamcik"),
+        last_modified=1,
+    )
+
+    first = get_timetable(snapshot, [lecture], 3)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("layout should come from the cache")
+
+    monkeypatch.setattr(WeekLayouts, "layout", fail)
+    second = get_timetable(snapshot, [lecture], 3)
+
+    assert second.table == first.table
+    assert second.lectures == first.lectures
+    assert second.date[0].date() == datetime.date(2009, 1, 12)
+
+
+def test_get_timetable_rebuilds_layout_with_unknown_lectures(cache_isolation):
+    lecture = _lecture(1, 0, time(8, 15), time(9, 0))
+    other = _lecture(2, 1, time(10, 15), time(11, 0))
+    snapshot = ScheduleSnapshot(
+        semester=Semester(year=2009, type=Semester.SPRING),
+        student=Student(slug="adamcik"),
+        last_modified=1,
+    )
+    get_timetable(snapshot, [lecture], None)
+
+    timetable = get_timetable(snapshot, [other], None)
+
+    assert [p["l"] for p in timetable.lectures] == [other]
@@ -2,6 +2,8 @@
 
 from unittest import mock
 
+import brotli
+
 from django.http import HttpResponse
 
 from django.conf import settings
@@ -127,7 +129,7 @@ def test_clear_cache_deletes_only_user_schedule_entry(
     assert caches["default"].get(resp_key) == "resp"
 
 
-def test_store_cached_response_rejects_unsupported_queued_aliases(
+def test_store_cached_response_rejects_unknown_queued_aliases(
     serialized_schedule_data, cache_isolation, frozen_time, settings
 ):
     settings.CACHES = {
@@ -139,10 +141,6 @@ def test_store_cached_response_rejects_unsupported_queued_aliases(
             "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
             "LOCATION": "disk-utils",
         },
-        "ical": {
-            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-            "LOCATION": "ical-utils",
-        },
     }
 
     with pytest.raises(ValueError, match="queued response caching"):
@@ -153,3 +151,42 @@ def test_store_cached_response_rejects_unsupported_queued_aliases(
             timeout=60,
             queued=True,
         )
+
+
+def test_store_cached_response_stores_brotli_body(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    body = b"BEGIN:VCALENDAR\r\n" * 100
+    response = store_cached_response(
+        cache_alias="default",
+        cache_key="compressed",
+        response=HttpResponse(body, content_type="text/calendar"),
+        timeout=60,
+    )
+
+    assert response.headers["Content-Encoding"] == "br"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert brotli.decompress(response.content) == body
+
+    cached = lookup_cached_response(
+        cache_alias="default", cache_key="compressed", headers={}
+    )
+
+    assert cached is not None
+    assert cached.headers["Content-Encoding"] == "br"
+    assert cached.headers["Content-Length"] == str(len(cached.content))
+    assert brotli.decompress(cached.content) == body
+
+
+def test_store_cached_response_keeps_small_bodies_uncompressed(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    response = store_cached_response(
+        cache_alias="default",
+        cache_key="small",
+        response=HttpResponse(b"ok"),
+        timeout=60,
+    )
+
+    assert "Content-Encoding" not in response
+    assert response.content == b"ok"
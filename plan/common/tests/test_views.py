@@ -1,4 +1,5 @@
 import datetime
+import gzip
 import subprocess
 import tempfile
 from pathlib import Path
@@ -26,6 +27,8 @@ from plan.common.models import (
 )
 from plan.common.snapshot import (
     ScheduleSnapshot,
+    get_schedule_snapshot,
+    iter_schedule_snapshots,
     schedule_snapshot_cache_key,
 )
 from plan.common.tests import strict_template_variables
@@ -203,16 +206,19 @@ def test_primary_cache_writes_use_configured_ttls(
     semester = Semester.objects.get(year=2009, type=Semester.SPRING)
     student = Student.objects.get(slug="adamcik")
     snapshot = ScheduleSnapshot(semester=semester, student=student, last_modified=1)
-    with mock.patch("plan.common.views.cache.set") as view_cache_set:
+    with mock.patch.object(caches["default"], "set") as cache_set:
         views._common_data()
         views._schedule_data(snapshot)
-    view_cache_set.assert_any_call("locations-next_semester:v2", mock.ANY, 123)
-    view_cache_set.assert_any_call(
-        f"data:schedule:v3:{snapshot.freshness_key()}", mock.ANY, timeout=456
-    )
-    with mock.patch("plan.common.models.cache.set") as model_cache_set:
         Course.get_stats(semester)
-    model_cache_set.assert_called_once_with(mock.ANY, mock.ANY, 789)
+    cache_set.assert_any_call("locations-next_semester:v2", mock.ANY, 123)
+    cache_set.assert_any_call(
+        f"data:schedule:v5:{snapshot.freshness_key()}", mock.ANY, 456
+    )
+    cache_set.assert_any_call(
+        f"course-semester-stats-{semester.id}-{settings.TIMETABLE_TOP_COURSE_COUNT}",
+        mock.ANY,
+        789,
+    )
 
 
 def test_schedule_renders_lecture_and_course_classes_and_room_links(
@@ -231,6 +237,64 @@ def test_schedule_renders_lecture_and_course_classes_and_room_links(
     assert f"course-{lecture.course_id}".encode() in response.content
 
 
+def test_schedule_pages_share_rendered_fragments(
+    client,
+    serialized_schedule_data,
+    cache_isolation,
+    frozen_time,
+    schedule_scenario,
+    settings,
+):
+    settings.TIMETABLE_FRAGMENT_CACHE_DEFAULT_TTL = 60
+    weeks = [
+        _schedule_reverse(schedule_scenario, "schedule-week", 1),
+        _schedule_reverse(schedule_scenario, "schedule-week", 2),
+    ]
+    with (
+        mock.patch.object(
+            views, "render_lectures_table", wraps=views.render_lectures_table
+        ) as render_lectures,
+        mock.patch.object(
+            views, "render_schedule_table", wraps=views.render_schedule_table
+        ) as render_timetable,
+    ):
+        responses = [client.get(url) for url in weeks]
+        # Bypassing the response cache still reuses the rendered fragments.
+        repeated = client.get(weeks[0] + "?no-cache")
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert repeated.status_code == 200
+    assert render_lectures.call_count == 1
+    assert render_timetable.call_count == 2
+    assert b"lecture-" in responses[1].content
+
+
+def test_schedule_streams_to_gzip_clients_and_caches_the_stream(
+    client,
+    serialized_schedule_data,
+    cache_isolation,
+    frozen_time,
+    schedule_scenario,
+    settings,
+):
+    settings.TIMETABLE_SCHEDULE_CACHE_DURATION = datetime.timedelta(seconds=60)
+    url = _schedule_reverse(schedule_scenario, "schedule")
+
+    streamed = client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+    assert streamed.streaming
+    assert "miss" in streamed.headers["X-Cache"]
+    body = gzip.decompress(b"".join(streamed.streaming_content))
+    assert f"lecture-{FIXTURE_LECTURE_ID}".encode() in body
+    assert b"<!--fragment:" not in body
+
+    cached = client.get(url)
+    assert "hit" in cached.headers["X-Cache"]
+    policy = cached.headers["Content-Security-Policy"]
+    document = html.fromstring(cached.content)
+    for nonce in document.xpath("//script[@nonce]/@nonce"):
+        assert f"'nonce-{nonce}'" in policy
+
+
 @strict_template_variables()
 def test_schedule_renders_without_missing_template_variables(
     client, serialized_schedule_data, cache_isolation, frozen_time, schedule_scenario
@@ -732,6 +796,20 @@ def test_change_course_invalidates_disk_backed_snapshot_metadata(
     assert response.status_code == 200
 
 
+def test_iter_schedule_snapshots_matches_get_schedule_snapshot(
+    serialized_schedule_data, cache_isolation, frozen_time
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    students = list(Student.objects.order_by("id"))
+    Schedule.objects.filter(student=students[0]).delete()
+
+    snapshots = iter_schedule_snapshots(semester, [s.id for s in students] + [-1])
+
+    assert sorted(snapshots, key=lambda s: s.student.id) == [
+        get_schedule_snapshot(semester, student.slug) for student in students
+    ]
+
+
 def test_schedule_with_warm_cache_force_reload_makes_no_queries(
     client,
     serialized_schedule_data,
@@ -788,6 +866,8 @@ def test_schedule_cache_hit_preserves_csp_nonces(
     style_nonces = set(document.xpath("//style[@nonce]/@nonce"))
     assert script_nonce in script_nonces
     assert style_nonce in style_nonces
+    first_policy = first.headers["Content-Security-Policy"]
+    assert csp_nonce(first_policy, "script-src") != script_nonce
 
 
 def test_schedule_week_with_warm_cache_force_reload_makes_no_queries(
@@ -1,28 +1,98 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
+import copy
 import datetime
+import heapq
 import logging
+from collections.abc import Iterable, MutableMapping, Sequence
+from dataclasses import dataclass
 
 from django.conf import settings
-from django.utils import formats
 
 from plan.common import utils
+from plan.common.cache import MultiCache
+from plan.common.lecture_data import LectureData, week_mask
 from plan.common.models import Lecture
+from plan.common.snapshot import ScheduleSnapshot
 
-SLOT_END_TIMES = [s[1] for s in settings.TIMETABLE_SLOTS]
+SLOT_LABELS = [
+    f"{start.hour:02d}:{start.minute:02d} - {end.hour:02d}:{end.minute:02d}"
+    for start, end in settings.TIMETABLE_SLOTS
+]
 
 logger = logging.getLogger(__name__)
 
 
+class Cell(MutableMapping):
+    """Single timetable cell that behaves like the legacy cell dicts.
+
+    Only keys that have been assigned are present, so ``cell.get(...)``,
+    ``key in cell`` and comparisons against plain dicts keep working for the
+    renderers, while the ``__slots__`` storage avoids a dict per grid position.
+    """
+
+    __slots__ = ("bottom", "colspan", "last", "lecture", "remove", "rowspan", "time")
+
+    def __getitem__(self, key):
+        if key not in Cell.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in Cell.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in Cell.__slots__:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return (key for key in Cell.__slots__ if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def get(self, key, default=None):
+        if key not in Cell.__slots__:
+            return default
+        return getattr(self, key, default)
+
+
+def _lowest_free_row(taken):
+    """Index of the lowest zero bit in a row bitmask."""
+    return (~taken & (taken + 1)).bit_length() - 1
+
+
 class Timetable:
+    """Lay out lectures in a ``slots x days x rows`` grid of cells.
+
+    Occupancy is tracked per day and slot as an integer bitmask with one bit
+    per row, so finding the leftmost free row for a lecture and checking how
+    far it can expand sideways are bit operations over the lecture's slots. The
+    cell grid in ``table`` is only built once the rows each day needs are known.
+    """
+
     slots = len(settings.TIMETABLE_SLOTS)
+    labels = SLOT_LABELS
 
     def __init__(self, lectures):
         self.lecture_queryset = lectures
         self.lectures = []
-        self.table = [[[{}] for a in Lecture.DAYS] for b in range(self.slots)]
         self.span = [1] * len(Lecture.DAYS)
         self.date = [None] * len(Lecture.DAYS)
+        self.occupied = [[0] * self.slots for _day in Lecture.DAYS]
+        self.table = self._build_table()
 
     def header(self):
         for i, name in Lecture.DAYS:
@@ -37,70 +107,61 @@ class Timetable:
     def place_lectures(self, week):
         """Add basics to datastructure"""
 
-        for i, lecture in enumerate(self.lecture_queryset):
+        for lecture in self.lecture_queryset:
             if lecture.exclude or (week and week not in lecture.week_numbers):
                 continue
 
-            start, end = self.map_to_slot(lecture)
-            if start is None or end is None:
-                logger.warning(
-                    "Skipping lecture %s outside timetable slots", lecture.lecture_id
-                )
+            # Lectures outside the slots are reported when they are loaded.
+            if lecture.slots is None:
                 continue
+            start, end = lecture.slots
 
-            rowspan = end - start + 1
-
-            first = start
-
-            # Try to find leftmost row that can fit our lecture, if we run out of
-            # rows to test, ie IndexError, we append a fresh one to work with
-            try:
-                row = 0
-                while start <= end:
-                    if self.table[start][lecture.day][row]:
-                        # One of our time slots is taken, bump the row number and
-                        # restart our search
-                        row += 1
-                        start = first
-                    else:
-                        start += 1
-
-            except IndexError:
-                # We ran out of rows to check, simply append a new row
-                for j in range(self.slots):
-                    self.table[j][lecture.day].append({})
+            # Find the leftmost row that has all of our slots free, this is
+            # one past the existing rows when none of them fit.
+            taken = self.occupied[lecture.day]
+            used = 0
+            for slot in range(start, end + 1):
+                used |= taken[slot]
 
+            row = _lowest_free_row(used)
+            if row == self.span[lecture.day]:
                 # Update the header colspan
                 self.span[lecture.day] += 1
 
-            start = first
-            remove = False
-
-            while start <= end:
-                # Replace the cell we found with a base containing info about our
-                # lecture
-                self.table[start][lecture.day][row] = {
-                    "lecture": lecture,
-                    "rowspan": rowspan,
-                    "remove": remove,
-                    "bottom": start + rowspan == len(self.table),
+            for slot in range(start, end + 1):
+                taken[slot] |= 1 << row
+            self.lectures.append(
+                {
+                    "height": end - start + 1,
+                    "i": start,
+                    "j": lecture.day,
+                    "k": row,
+                    "l": lecture,
                 }
+            )
 
-                # Add lecture to our supplementary data structure and set the
-                # remove flag.
-                if not remove:
-                    remove = True
-                    self.lectures.append(
-                        {
-                            "height": rowspan,
-                            "i": start,
-                            "j": lecture.day,
-                            "k": row,
-                            "l": lecture,
-                        }
-                    )
-
-                start += 1
+        self.table = self._build_table()
+
+    def _build_table(self):
+        table = [
+            [[Cell() for _row in range(rows)] for rows in self.span]
+            for _slot in range(self.slots)
+        ]
+
+        for placement in self.lectures:
+            start = placement["i"]
+            day = placement["j"]
+            row = placement["k"]
+            rowspan = placement["height"]
+
+            for slot in range(start, start + rowspan):
+                cell = table[slot][day][row]
+                cell.lecture = placement["l"]
+                cell.rowspan = rowspan
+                cell.remove = slot != start
+                cell.bottom = slot + rowspan == self.slots
+
+        return table
 
     def do_expansion(self):
         for lecture in self.lectures:
@@ -111,58 +172,318 @@ class Timetable:
             k = lecture["k"]
 
             height = lecture["height"]
+            taken = self.occupied[j]
+            used = 0
+            for slot in range(i, i + height):
+                used |= taken[slot]
 
+            # Find safe expansion of colspan
             expand_by = 1
+            while k + expand_by < self.span[j] and not used >> (k + expand_by) & 1:
+                expand_by += 1
 
-            # Find safe expansion of colspan
-            safe = True
-            for l in range(k + 1, len(self.table[i][j])):
-                for m in range(i, i + height):
-                    if self.table[m][j][l]:
-                        safe = False
-                        break
-                if safe:
-                    expand_by += 1
-                else:
-                    break
+            # Claim the cells we expand into so later lectures can't use them.
+            claimed = ((1 << (expand_by - 1)) - 1) << (k + 1)
+            for slot in range(i, i + height):
+                taken[slot] |= claimed
 
-            self.table[i][j][k]["colspan"] = expand_by
             lecture["width"] = expand_by
+            self._mark_expansion(lecture)
+
+    def _mark_expansion(self, lecture):
+        i = lecture["i"]
+        j = lecture["j"]
+        k = lecture["k"]
+        height = lecture["height"]
+        width = lecture["width"]
 
-            if k + expand_by == len(self.table[i][j]):
-                self.table[i][j][k]["last"] = True
+        self.table[i][j][k].colspan = width
+        if k + width == self.span[j]:
+            self.table[i][j][k].last = True
 
-            # Remove cells that will get replaced by colspan
-            for l in range(k + 1, k + expand_by):
-                for m in range(i, i + height):
-                    self.table[m][j][l]["remove"] = True
+        # Remove cells that will get replaced by colspan
+        for l in range(k + 1, k + width):
+            for m in range(i, i + height):
+                self.table[m][j][l].remove = True
 
     def add_markers(self):
         for row in self.table:
             for day in row:
-                day[-1]["last"] = True
+                day[-1].last = True
         for day in self.table[-1]:
             for cell in day:
                 # only bother with cells that will be shown.
-                cell["bottom"] = not cell.get("remove", False)
+                cell.bottom = not cell.get("remove", False)
 
     def insert_times(self):
-        for i, slot in enumerate(settings.TIMETABLE_SLOTS):
-            start = formats.time_format(slot[0], "H:i")
-            end = formats.time_format(slot[1], "H:i")
-            self.table[i].insert(0, [{"time": f"{start} - {end}"}])
+        for row, label in zip(self.table, self.labels):
+            cell = Cell()
+            cell.time = label
+            row.insert(0, [cell])
+
+    def to_layout(self) -> "TimetableLayout":
+        """Compact copy of the placements made by an expanded timetable."""
+        return TimetableLayout(
+            span=tuple(self.span),
+            placements=tuple(
+                (p["l"].lecture_id, p["i"], p["j"], p["k"], p["height"], p["width"])
+                for p in self.lectures
+            ),
+        )
+
+    @classmethod
+    def from_layout(
+        cls, layout: "TimetableLayout", lectures: Iterable[LectureData]
+    ) -> "Timetable":
+        """Rebuild a finished timetable from a layout without placing lectures.
+
+        Raises ``KeyError`` if the layout refers to a lecture not in
+        ``lectures``.
+        """
+        by_id = {lecture.lecture_id: lecture for lecture in lectures}
+        placed = [by_id[placement[0]] for placement in layout.placements]
+
+        timetable = cls(placed)
+        timetable.span = list(layout.span)
+        for lecture, (_id, i, j, k, height, width) in zip(placed, layout.placements):
+            timetable.lectures.append(
+                {"height": height, "i": i, "j": j, "k": k, "l": lecture, "width": width}
+            )
+            claimed = ((1 << width) - 1) << k
+            taken = timetable.occupied[j]
+            for slot in range(i, i + height):
+                taken[slot] |= claimed
+
+        timetable.table = timetable._build_table()
+        for lecture in timetable.lectures:
+            timetable._mark_expansion(lecture)
+        timetable.insert_times()
+        timetable.add_markers()
+        return timetable
+
+
+def _minutes(value: datetime.time) -> int:
+    return value.hour * 60 + value.minute
+
+
+def _clock(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class MinuteTimetable(Timetable):
+    """Lay out lectures in rows of ``resolution`` minutes by their actual times.
+
+    Rows run from the start of the first timetable slot to the end of the last
+    one, widened to cover any lecture outside them, so no lecture is dropped.
+    Columns are assigned per day by interval partitioning: lectures are swept
+    by start row while a min-heap of column end rows returns the lowest column
+    that is free again, which takes ``O(n log n)`` for ``n`` lectures.
+
+    The result has the same ``table`` and ``lectures`` structure as
+    :class:`Timetable`, so expansion and the renderers work unchanged.
+    """
+
+    def __init__(self, lectures, resolution=None):
+        lectures = list(lectures)
+        self.resolution = resolution or settings.TIMETABLE_SLOT_MINUTES
+
+        first = [_minutes(start) for start, _end in settings.TIMETABLE_SLOTS[:1]]
+        last = [_minutes(end) for _start, end in settings.TIMETABLE_SLOTS[-1:]]
+        first += [_minutes(lecture.start) for lecture in lectures]
+        last += [_minutes(lecture.end) for lecture in lectures]
+
+        self.origin = min(first, default=0)
+        self.origin -= self.origin % self.resolution
+        rows = -((self.origin - max(last, default=0)) // self.resolution)
+        self.slots = max(1, rows)
+        self.labels = [
+            f"{_clock(minute)} - {_clock(minute + self.resolution)}"
+            for minute in range(
+                self.origin,
+                self.origin + self.slots * self.resolution,
+                self.resolution,
+            )
+        ]
+
+        super().__init__(lectures)
 
-    def map_to_slot(self, lecture):
-        start, end = None, None
+    def rows(self, lecture) -> tuple[int, int]:
+        """First and last row covered by ``lecture``."""
+        start = (_minutes(lecture.start) - self.origin) // self.resolution
+        end = -((self.origin - _minutes(lecture.end)) // self.resolution) - 1
+        return start, max(start, end)
+
+    def place_lectures(self, week):
+        days = [[] for _day in Lecture.DAYS]
+        for index, lecture in enumerate(self.lecture_queryset):
+            if lecture.exclude or (week and week not in lecture.week_numbers):
+                continue
+            start, end = self.rows(lecture)
+            days[lecture.day].append((start, end, index, lecture))
+
+        for day, placements in enumerate(days):
+            taken = self.occupied[day]
+            in_use = []  # (end row, column) of the last lecture in each column
+            free = []
+            columns = 0
+
+            for start, end, _index, lecture in sorted(placements):
+                while in_use and in_use[0][0] < start:
+                    heapq.heappush(free, heapq.heappop(in_use)[1])
+
+                if free:
+                    column = heapq.heappop(free)
+                else:
+                    column = columns
+                    columns += 1
+                heapq.heappush(in_use, (end, column))
+
+                for slot in range(start, end + 1):
+                    taken[slot] |= 1 << column
+                self.lectures.append(
+                    {
+                        "height": end - start + 1,
+                        "i": start,
+                        "j": day,
+                        "k": column,
+                        "l": lecture,
+                    }
+                )
 
-        for i, time in enumerate(SLOT_END_TIMES):
-            if start is None and lecture.start < time:
-                start = i
+            self.span[day] = max(1, columns)
 
-            if end is None and lecture.end <= time:
-                end = i
+        self.table = self._build_table()
 
-        if end is None and lecture.end > time:
-            end = i
 
-        return (start, end)
+def timetable_class() -> type[Timetable]:
+    """Timetable layout selected by ``TIMETABLE_SLOT_MINUTES``."""
+    if settings.TIMETABLE_SLOT_MINUTES:
+        return MinuteTimetable
+    return Timetable
+
+
+@dataclass(frozen=True, slots=True)
+class TimetableLayout:
+    """Picklable result of laying out a timetable.
+
+    Each placement is ``(lecture_id, slot, day, row, height, width)``, which
+    together with the rows per day in ``span`` is enough for
+    :meth:`Timetable.from_layout` to rebuild the cell grid.
+    """
+
+    span: tuple[int, ...]
+    placements: tuple[tuple[int, int, int, int, int, int], ...]
+
+
+class WeekLayouts:
+    """Finished timetable layouts for every week of a schedule.
+
+    Week numbers are turned into bitmasks once, and a single sweep over the
+    lectures works out which lectures are active each week. Weeks with the
+    same active lectures share one layout, which is only built the first time
+    one of them is asked for.
+    """
+
+    def __init__(self, lectures):
+        self.lecture_queryset = tuple(lectures)
+        self.masks = [week_mask(lecture.week_numbers) for lecture in lectures]
+
+        # Sets of active lectures are bitmasks over the lecture indexes.
+        self.all_weeks = 0
+        self.active = {}
+        for index, (lecture, mask) in enumerate(zip(self.lecture_queryset, self.masks)):
+            if lecture.exclude:
+                continue
+
+            self.all_weeks |= 1 << index
+            while mask:
+                lowest = mask & -mask
+                week = lowest.bit_length() - 1
+                self.active[week] = self.active.get(week, 0) | 1 << index
+                mask ^= lowest
+
+        self._layouts = {}
+
+    def layout(self, week=None):
+        """Shared layout for ``week``, or for all weeks when ``week`` is falsy.
+
+        The returned timetable has had expansion, times and markers applied,
+        and must not be modified. Use :meth:`timetable` to get one with the
+        dates of a week filled in.
+        """
+        key = self.active.get(week, 0) if week else self.all_weeks
+        try:
+            return self._layouts[key]
+        except KeyError:
+            pass
+
+        lectures = [
+            lecture
+            for index, lecture in enumerate(self.lecture_queryset)
+            if key >> index & 1
+        ]
+        layout = timetable_class()(lectures)
+        if lectures:
+            layout.place_lectures(None)
+            layout.do_expansion()
+        layout.insert_times()
+        layout.add_markers()
+
+        self._layouts[key] = layout
+        return layout
+
+    def layouts(self):
+        """Layouts for all weeks and for each week with lectures, keyed by week."""
+        result = {None: self.layout()}
+        for week in sorted(self.active):
+            result[week] = self.layout(week)
+        return result
+
+    def timetable(self, year, week=None):
+        """Layout for ``week`` with the dates of that week in its header."""
+        timetable = copy.copy(self.layout(week))
+        if week:
+            timetable.set_week(year, week)
+        return timetable
+
+
+def layout_cache_key(snapshot: ScheduleSnapshot, week: int | None = None) -> str:
+    minutes = settings.TIMETABLE_SLOT_MINUTES or 0
+    return f"layout:v2:{snapshot.freshness_key()}:{minutes}:{week or 0}"
+
+
+def _layout_cache() -> MultiCache[TimetableLayout]:
+    ttl = settings.TIMETABLE_LAYOUT_CACHE_DEFAULT_TTL
+    if ttl is None:
+        raise ValueError("TIMETABLE_LAYOUT_CACHE_DEFAULT_TTL must not be None")
+    return MultiCache[TimetableLayout](default=ttl)
+
+
+def get_timetable(
+    snapshot: ScheduleSnapshot,
+    lectures: Sequence[LectureData],
+    week: int | None = None,
+) -> Timetable:
+    """Timetable for ``week`` of a schedule, reusing cached layouts.
+
+    Layouts are cached by schedule freshness and week, so every renderer of the
+    same schedule shares a single layout until the schedule changes.
+    """
+    key = layout_cache_key(snapshot, week)
+    cache = _layout_cache()
+
+    timetable = None
+    result = cache.get(key)
+    if result.hit and result.value is not None:
+        try:
+            timetable = timetable_class().from_layout(result.value, lectures)
+        except KeyError:
+            logger.warning("Cached layout %s refers to unknown lectures", key)
+
+    if timetable is None:
+        timetable = copy.copy(WeekLayouts(lectures).layout(week))
+        cache.set(key, timetable.to_layout())
+
+    if week:
+        timetable.set_week(snapshot.semester.year, week)
+    return timetable
@@ -30,7 +30,6 @@ from plan.common.snapshot import ScheduleSnapshot, delete_schedule_snapshot_cach
 from plan.ical.queue import enqueue_cache_set
 
 _ = translation.gettext
-QUEUED_CACHE_ALIASES = frozenset({"disk"})
 MAX_FUTURE_LAST_MODIFIED_SECONDS = 60
 logger = logging.getLogger(__name__)
 
@@ -60,22 +59,36 @@ def parse_accepts(request):
 
 
 def compress_response(request, response, min_size=200):
+    accepts = parse_accepts(request)
+    if "br" in accepts:
+        return _compress(response, "br", min_size)
+    elif "gzip" in accepts:
+        return _compress(response, "gzip", min_size)
+    return response
+
+
+def compress_cacheable_response(response, min_size=200):
+    """Brotli compress a response regardless of what the current client accepts.
+
+    Cached responses are shared by all clients, so they are compressed once
+    when stored and `encoding_compatibility_middleware` decompresses them for
+    the odd client without brotli support.
+    """
+    return _compress(response, "br", min_size)
+
+
+def _compress(response, encoding, min_size):
     if "Content-Encoding" in response or len(response.content) < min_size:
         return response
 
-    accepts = parse_accepts(request)
-    if "br" in accepts:
+    if encoding == "br":
         content = brotli.compress(response.content, brotli.MODE_TEXT)
-        encoding = "br"
-    elif "gzip" in accepts:
+    else:
         content = gzip.compress(
             response.content,
             compresslevel=6,
             mtime=0,
         )
-        encoding = "gzip"
-    else:
-        return response
 
     if len(content) > len(response.content):
         return response
@@ -240,20 +253,31 @@ def store_cached_response(
 ) -> http.HttpResponse:
     """Store a rendered response in a configured cache backend.
 
-    Queued writes require a cache alias listed in `QUEUED_CACHE_ALIASES`.
+    Queued writes are handed to the write-behind queue in `plan.ical.queue`.
+    Streaming responses must provide ``tee(store)`` to hand over the complete
+    response when streaming ends.
     """
     if timeout is None:
         response["X-Cache"] = f"miss; disabled; key={cache_key}"
         return response
 
-    if queued:
-        if cache_alias not in QUEUED_CACHE_ALIASES:
-            raise ValueError(
-                f"queued response caching is not supported for cache alias {cache_alias!r}"
-            )
-        enqueue_cache_set(cache_alias, cache_key, response, timeout)
+    if queued and cache_alias not in settings.CACHES:
+        raise ValueError(
+            f"queued response caching is not supported for cache alias {cache_alias!r}"
+        )
+
+    def store(value: http.HttpResponse) -> None:
+        if queued:
+            enqueue_cache_set(cache_alias, cache_key, value, timeout)
+        else:
+            caches[cache_alias].set(cache_key, value, timeout=timeout)
+
+    if response.streaming:
+        # Streamed pages are stored once their last chunk has been sent.
+        response.tee(store)
     else:
-        caches[cache_alias].set(cache_key, response, timeout=timeout)
+        response = compress_cacheable_response(response)
+        store(response)
 
     if bypass:
         response["X-Cache"] = f"miss; bypass; key={cache_key}"
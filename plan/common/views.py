@@ -1,26 +1,39 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
 import datetime
+import functools
 import json
+import re
+from collections.abc import Callable, Iterator
 from dataclasses import dataclass
 
 from django import http, shortcuts
 from django.conf import settings
-from django.core.cache import cache
 from django.db import transaction
-from django.db.models import QuerySet
+from django.template import loader
 from django.utils import html, text, translation
 from django.utils.cache import patch_vary_headers
 from django.utils.http import http_date
+from django.utils.safestring import SafeString, mark_safe
 from opentelemetry import trace
 
-from plan.common import context_processors, encoding, forms, timetable, utils
-from plan.common.lecture_data import LectureData
-from plan.common.middleware import CspMiddleware
+from plan.common import (
+    catalog,
+    codec,
+    context_processors,
+    encoding,
+    forms,
+    timetable,
+    utils,
+)
+from plan.common.cache import MultiCache, local_layer
+from plan.common.lecture_data import ScheduleData
+from plan.common.middleware import (
+    NonceTemplateResponse,
+    NonceTemplateStreamingResponse,
+)
 from plan.common.models import (
     Course,
-    Exam,
-    Group,
     Lecture,
     Location,
     Room,
@@ -36,6 +49,7 @@ from plan.common.snapshot import (
     bump_snapshot,
     get_schedule_snapshot,
 )
+from plan.common.table_render import render_lectures_table, render_schedule_table
 from plan.materialized.models import SubscriptionsCount
 
 # FIXME split into frontpage/semester, course, schedule files
@@ -46,6 +60,7 @@ from plan.materialized.models import SubscriptionsCount
 now = datetime.datetime.now
 today = datetime.date.today
 tracer = trace.get_tracer(__name__)
+RE_FRAGMENT_MARKER = re.compile(r"<!--fragment:(\w+)-->")
 
 # Setup common alias for translation
 _ = translation.gettext_lazy
@@ -53,21 +68,10 @@ _ = translation.gettext_lazy
 
 @dataclass
 class CommonData:
-    locations: QuerySet[Location]
+    locations: list[Location]
     next_semester: Semester | None
 
 
-@dataclass
-class ScheduleData:
-    lectures: list[LectureData]
-    courses: list[Course]
-    exams: dict[int, list[Exam]]
-    lecturers: list[object]
-    groups: dict[int, list[str]]
-    rooms: dict[int, list[dict[str, int | str | None]]]
-    weeks: list[int]
-
-
 def robots_txt(request):
     content = "\n".join(
         [
@@ -229,59 +233,83 @@ def schedule_current(request, semester: Semester, slug: str):
 
 
 def _common_data() -> CommonData:
-    key = "locations-next_semester:v2"
-    result = cache.get(key)
-    if result:
-        return result
+    data_cache = MultiCache[CommonData](
+        **local_layer(), default=settings.TIMETABLE_LOCATION_CACHE_TTL
+    )
+    return data_cache.get_or_compute("locations-next_semester:v2", _load_common_data)
+
 
-    locations = Location.objects.distinct()  # .filter(course__semester=semester)
+def _load_common_data() -> CommonData:
+    # Evaluated here, the local layer shares the value between threads.
+    locations = list(Location.objects.distinct())  # .filter(course__semester=semester)
     try:
         next_semester = next(Semester.objects)
     except Semester.DoesNotExist:
         next_semester = None
-    result = CommonData(locations=locations, next_semester=next_semester)
-    cache.set(key, result, settings.TIMETABLE_LOCATION_CACHE_TTL)
-    return result
+    return CommonData(locations=locations, next_semester=next_semester)
 
 
 def _schedule_data(s: Schedule) -> ScheduleData:
     if s.last_modified is None:
         return ScheduleData([], [], {}, [], {}, {}, [])
 
-    key = f"data:schedule:v3:{s.freshness_key()}"
-    result = cache.get(key)
-    if result:
+    key = f"data:schedule:v5:{s.freshness_key()}"
+    data_cache = MultiCache[bytes](default=settings.TIMETABLE_SCHEDULE_DATA_CACHE_TTL)
+    built = []
+
+    def compute() -> bytes:
+        built.append(_load_schedule_data(s))
+        return codec.encode_schedule_data(built[0])
+
+    payload = data_cache.get_or_compute(key, compute)
+    if built:
+        return built[0]
+
+    try:
+        return codec.decode_schedule_data(payload)
+    except codec.CodecError:
+        # Payload from an older codec, rebuild and overwrite it.
+        result = _load_schedule_data(s)
+        data_cache.set(key, codec.encode_schedule_data(result))
         return result
 
-    courses = list(
-        Course.objects.filter(
-            subscription__student=s.student.id,
-            subscription__course__semester=s.semester,
-        )
-        .extra(select={"alias": "common_subscription.alias"})
-        .distinct()
-        .order_by("code")
-    )
 
-    lectures = Lecture.objects.get_lectures_data(
-        s.semester.id,
-        s.student.id,
-    )
+def _fragment(key: str, render: Callable[[], str]) -> SafeString:
+    """Rendered page fragment, shared by every page showing the same data."""
+    ttl = settings.TIMETABLE_FRAGMENT_CACHE_DEFAULT_TTL
+    if ttl is None:
+        return mark_safe(render())
+    fragment_cache = MultiCache[str](disk=ttl)
+    return mark_safe(fragment_cache.get_or_compute(f"fragment:v1:{key}", render))
+
+
+def _stream_schedule(
+    request, context: dict, fragments: dict[str, Callable[[], SafeString]]
+) -> NonceTemplateStreamingResponse:
+    """Schedule page that sends the page chrome before rendering fragments."""
+    markers = {name: mark_safe(f"<!--fragment:{name}-->") for name in fragments}
+    chrome = loader.render_to_string("schedule.html", context | markers, request)
+    language = translation.get_language()
+
+    def chunks() -> Iterator[bytes]:
+        # Chunks are rendered after the view and middleware have returned.
+        with translation.override(language):
+            for i, part in enumerate(RE_FRAGMENT_MARKER.split(chrome)):
+                html = fragments[part]() if i % 2 else part
+                yield html.encode()
+
+    return NonceTemplateStreamingResponse(chunks())
+
+
+def _load_schedule_data(s: Schedule) -> ScheduleData:
+    rows = catalog.get_schedule_rows(s.semester, s.student.id)
+    lectures = rows.lectures
 
-    # Most of these could be built into get_lectures_data with ARRAY_AGG..
     exams = {}
-    for exam in (
-        Exam.objects.filter(course__in=courses)
-        .select_related("course", "type")
-        .order_by("handout_date", "handout_time", "exam_date", "exam_time")
-    ):
+    for exam in rows.exams:
         exams.setdefault(exam.course_id, []).append(exam)
 
-    # Use get_related to cut query counts
     lecturers = []  # Lecture.get_related(Lecturer, lectures)
-    lecture_ids = [lecture.lecture_id for lecture in lectures]
-    groups = Lecture.get_related(Group, lecture_ids, fields=["code"])
-    rooms = Lecture.get_related(Room, lecture_ids, fields=["id", "name", "url"])
 
     schedule_weeks = set()
     for l in lectures:
@@ -295,17 +323,15 @@ def _schedule_data(s: Schedule) -> ScheduleData:
     # TODO: get_related duplicates data, perhaps the exams dict should just
     # be {lecture_id: exam_id} and then there is a {exam_id: exam} mapping?
 
-    result = ScheduleData(
+    return ScheduleData(
         lectures=lectures,
-        courses=courses,
+        courses=rows.courses,
         exams=exams,
         lecturers=lecturers,
-        groups=groups,
-        rooms=rooms,
+        groups=rows.groups,
+        rooms=rows.rooms,
         weeks=schedule_weeks,
     )
-    cache.set(key, result, timeout=settings.TIMETABLE_SCHEDULE_DATA_CACHE_TTL)
-    return result
 
 
 def schedule(
@@ -335,7 +361,7 @@ def schedule(
     next_semester = common_data.next_semester
     if next_semester == snapshot.semester:
         next_semester = None
-    cache_key_parts = [path]
+    cache_key_parts = ["nonce", path]
     if notice_cache_key := context_processors.active_notice_cache_key():
         cache_key_parts.append(notice_cache_key)
     cache_key = utils.response_cache_key(
@@ -397,17 +423,6 @@ def schedule(
     for c in courses:
         color_map[c.id]
 
-    # Keep layout work separate from data loading and template rendering.
-    with tracer.start_as_current_span("TIMETABLE BUILD"):
-        table = timetable.Timetable(lectures)
-        if week:
-            table.set_week(snapshot.semester.year, week)
-        if lectures:
-            table.place_lectures(week)
-            table.do_expansion()
-        table.insert_times()
-        table.add_markers()
-
     if advanced:
         # Set up and course name forms
         for course in courses:
@@ -421,46 +436,89 @@ def schedule(
 
     week_is_current = snapshot.semester.year == today().year and week == current_week
 
-    # TODO: Natural sort course code? Why is this needed here?
-    lectures.sort(
-        key=lambda l: (
-            l.course_code,
-            min(l.week_numbers) if l.week_numbers else None,
+    def render_timetable() -> str:
+        # Keep layout work separate from data loading and template rendering.
+        with tracer.start_as_current_span("TIMETABLE BUILD"):
+            table = timetable.get_timetable(snapshot, lectures, week)
+        with tracer.start_as_current_span("TABLE schedule"):
+            return render_schedule_table(table, rooms, snapshot, prev_week, next_week)
+
+    def render_lectures() -> str:
+        # TODO: Natural sort course code? Why is this needed here?
+        lectures.sort(
+            key=lambda l: (
+                l.course_code,
+                min(l.week_numbers) if l.week_numbers else None,
+            )
         )
-    )
+        with tracer.start_as_current_span("TABLE lectures"):
+            return render_lectures_table(
+                lectures, groups, rooms, snapshot, advanced, 30
+            )
 
-    response = shortcuts.render(
-        request,
-        "schedule.html",
-        {
-            "advanced": advanced,
-            "all": all,
-            "color_map": color_map,
-            "courses": courses,
-            "current": (week == current_week),
-            "current_week": current_week,
-            "exams": exams,
-            "lectures": lectures,
-            "semester": snapshot.semester,
-            "week_is_current": week_is_current,
-            "next_semester": next_semester,
-            "slug": snapshot.student.slug,
-            "timetable": table,
-            "week": week,
-            "next_week": next_week,
-            "prev_week": prev_week,
-            "rooms": rooms,
-            "groups": groups,
-            "lecturers": lecturers,
-            "locations": locations,
-            "weeks": schedule_weeks,
-            "schedule": snapshot,
-            "next_semester": next_semester,
-        },
-    )
+    def render_courses() -> str:
+        return loader.render_to_string(
+            "courses.html",
+            {
+                "advanced": advanced,
+                "courses": courses,
+                "exams": exams,
+                "schedule": snapshot,
+                "tabindex": 10 if advanced else None,
+            },
+            request,
+        )
+
+    language = translation.get_language()
+    fragment_key = f"{snapshot.freshness_key()}:{language}"
+    # In page order, the timetable layout must be built before lectures.sort().
+    fragments = {
+        "schedule_table": functools.partial(
+            _fragment,
+            f"{language}:{timetable.layout_cache_key(snapshot, week)}",
+            render_timetable,
+        ),
+        "courses_table": functools.partial(
+            _fragment, f"courses:{fragment_key}:{int(advanced)}", render_courses
+        ),
+        "lectures_table": functools.partial(
+            _fragment, f"lectures:{fragment_key}:{int(advanced)}", render_lectures
+        ),
+    }
+    context = {
+        "advanced": advanced,
+        "all": all,
+        "color_map": color_map,
+        "courses": courses,
+        "current": (week == current_week),
+        "current_week": current_week,
+        "semester": snapshot.semester,
+        "week_is_current": week_is_current,
+        "next_semester": next_semester,
+        "slug": snapshot.student.slug,
+        "week": week,
+        "next_week": next_week,
+        "prev_week": prev_week,
+        "groups": groups,
+        "lecturers": lecturers,
+        "locations": locations,
+        "weeks": schedule_weeks,
+        "schedule": snapshot,
+        "next_semester": next_semester,
+        # CspMiddleware fills in fresh nonces for every request, including hits.
+        "CSP_SCRIPT_NONCE": NonceTemplateResponse.PLACEHOLDERS["script"],
+        "CSP_STYLE_NONCE": NonceTemplateResponse.PLACEHOLDERS["style"],
+    }
+
+    if "gzip" in utils.parse_accepts(request):
+        response = _stream_schedule(request, context, fragments)
+    else:
+        for name, fragment in fragments.items():
+            context[name] = fragment()
+        response = shortcuts.render(request, "schedule.html", context)
+        response = NonceTemplateResponse.from_response(response)
 
     utils.apply_response_headers(response, headers)
-    CspMiddleware.store_nonce_in_header(request, response)
     timeout = None
     if settings.TIMETABLE_SCHEDULE_CACHE_DURATION is not None:
         timeout = settings.TIMETABLE_SCHEDULE_CACHE_DURATION.total_seconds()
@@ -0,0 +1,247 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+import functools
+import itertools
+import multiprocessing
+import os
+import time
+from collections.abc import Sequence
+from concurrent import futures
+
+from opentelemetry import metrics, trace
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import base as management
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils import translation
+
+from plan.common import utils
+from plan.common.catalog import iter_schedule_rows
+from plan.common.models import Schedule as ScheduleModel
+from plan.common.models import Semester
+from plan.common.snapshot import ScheduleSnapshot, iter_schedule_snapshots
+from plan.ical import views
+from plan.scrape.progress import progress
+
+tracer = trace.get_tracer("plan.ical")
+_meter = metrics.get_meter("plan.ical")
+_feeds = _meter.create_counter("ical.pregenerate.feeds", unit="{feed}")
+_size = _meter.create_counter("ical.pregenerate.size", unit="By")
+_batch_duration = _meter.create_histogram("ical.pregenerate.batch.duration", unit="s")
+
+
+class Command(management.BaseCommand):
+    help = (
+        "Write the iCal feeds of every schedule in a semester to the disk cache. "
+        "Run after a scrape, which makes every cached feed stale."
+    )
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--year", action="store", dest="year", type=int, required=True
+        )
+        parser.add_argument(
+            "--type",
+            action="store",
+            dest="type",
+            choices=list(dict(Semester.SEMESTER_TYPES).keys()),
+            required=True,
+        )
+        parser.add_argument(
+            "--workers",
+            action="store",
+            dest="workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="worker processes, 0 generates in this process",
+        )
+        parser.add_argument(
+            "--batch-size",
+            action="store",
+            dest="batch_size",
+            type=int,
+            default=200,
+            help="schedules loaded and written together",
+        )
+        parser.add_argument(
+            "--language",
+            action="append",
+            dest="languages",
+            choices=[language for language, _name in settings.LANGUAGES],
+            help="feed language to generate, default: all",
+        )
+        parser.add_argument(
+            "--host",
+            action="store",
+            dest="host",
+            default=settings.TIMETABLE_HOSTNAME,
+            help="host feeds are served from, default: TIMETABLE_HOSTNAME",
+        )
+        parser.add_argument(
+            "--http",
+            action="store_true",
+            dest="http",
+            help="build links with http instead of https",
+        )
+
+    def handle(self, **options):
+        timeout = settings.TIMETABLE_ICAL_CACHE_DURATION.total_seconds()
+        if timeout <= 0:
+            raise management.CommandError("iCal response caching is disabled")
+        if not options["host"]:
+            raise management.CommandError(
+                "--host is required when TIMETABLE_HOSTNAME is not set"
+            )
+        if options["batch_size"] < 1:
+            raise management.CommandError("--batch-size must be at least 1")
+
+        semester = self._load_semester(options["year"], options["type"])
+        languages = options["languages"] or [
+            language for language, _name in settings.LANGUAGES
+        ]
+
+        with tracer.start_as_current_span("ICAL PREGENERATE"):
+            started = time.perf_counter()
+            students, feeds, size = self._run_for_semester(
+                semester,
+                languages=languages,
+                host=options["host"],
+                secure=not options["http"],
+                timeout=timeout,
+                workers=options["workers"],
+                batch_size=options["batch_size"],
+            )
+            elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"semester={semester.year}/{semester.type}")
+        self.stdout.write(f"students={students}")
+        self.stdout.write(f"feeds={feeds}")
+        self.stdout.write(f"bytes={size}")
+        self.stdout.write(f"seconds={elapsed:.2f}")
+        self.stdout.write(f"feeds_per_second={feeds / elapsed if elapsed else 0:.1f}")
+
+    def _load_semester(self, year: int, semester_type: str) -> Semester:
+        try:
+            return Semester.objects.get(year=year, type=semester_type)
+        except Semester.DoesNotExist as e:
+            raise management.CommandError(
+                f"Semester not found: year={year} type={semester_type}"
+            ) from e
+
+    def _run_for_semester(
+        self, semester, *, languages, host, secure, timeout, workers, batch_size
+    ) -> tuple[int, int, int]:
+        student_ids = list(
+            ScheduleModel.objects.filter(semester_id=semester.id).values_list(
+                "student_id", flat=True
+            )
+        )
+        batches = itertools.batched(
+            iter_schedule_snapshots(semester, student_ids), batch_size
+        )
+        generate = functools.partial(
+            _generate_batch,
+            languages=languages,
+            host=host,
+            secure=secure,
+            timeout=timeout,
+        )
+
+        totals = (0, 0, 0)
+        with progress(total=len(student_ids), unit="students") as bar:
+            if workers == 0:
+                for batch in batches:
+                    totals = self._record(bar, generate(batch), totals)
+                return totals
+
+            # Snapshots are streamed from the connection of this process while
+            # batches are generated, so workers must not be forked from it.
+            with futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_init_worker,
+            ) as pool:
+                pending = set()
+                for batch in batches:
+                    if len(pending) >= workers * 2:
+                        done, pending = futures.wait(
+                            pending, return_when=futures.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            totals = self._record(bar, future.result(), totals)
+                    pending.add(pool.submit(generate, batch))
+                for future in futures.as_completed(pending):
+                    totals = self._record(bar, future.result(), totals)
+        return totals
+
+    def _record(self, bar, result, totals) -> tuple[int, int, int]:
+        students, batch_feeds, batch_size, duration = result
+        _feeds.add(batch_feeds)
+        _size.add(batch_size)
+        _batch_duration.record(duration)
+        bar.update(students)
+        return (
+            totals[0] + students,
+            totals[1] + batch_feeds,
+            totals[2] + batch_size,
+        )
+
+
+def _init_worker() -> None:
+    # Workers started with spawn or forkserver import Django from scratch.
+    django.setup()
+
+
+def _generate_batch(
+    snapshots: Sequence[ScheduleSnapshot],
+    languages: list[str],
+    host: str,
+    secure: bool,
+    timeout: float,
+) -> tuple[int, int, int, float]:
+    """Render the feeds of ``snapshots`` and write them with one ``set_many``.
+
+    Feeds are rendered like ``views.ical`` does for a request without query
+    parameters, and stored under the key the view looks up.
+    """
+    started = time.perf_counter()
+    factory = RequestFactory(HTTP_HOST=host)
+    rows = dict(
+        iter_schedule_rows(
+            snapshots[0].semester, [snapshot.student.id for snapshot in snapshots]
+        )
+    )
+
+    values = {}
+    size = 0
+    for language in languages:
+        with translation.override(language):
+            lectures = translation.gettext("lectures")
+            exams = translation.gettext("exams")
+            feeds = [
+                ("schedule-ical", [], [lectures, exams]),
+                ("schedule-ical-type", [lectures], [lectures]),
+                ("schedule-ical-type", [exams], [exams]),
+            ]
+            for snapshot in snapshots:
+                for route, args, resources in feeds:
+                    path = reverse(
+                        route, args=[snapshot.semester, snapshot.student.slug, *args]
+                    )
+                    cache_key = views.ical_cache_key(route, snapshot, path)
+                    response = views.render_ical(
+                        factory.get(path, secure=secure),
+                        snapshot,
+                        resources,
+                        rows[snapshot.student.id],
+                        views.ical_headers(snapshot, cache_key),
+                    )
+                    size += len(response.content)
+                    values[cache_key] = utils.compress_cacheable_response(response)
+
+    caches["disk"].set_many(values, timeout=timeout)
+    return len(snapshots), len(values), size, time.perf_counter() - started
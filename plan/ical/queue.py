@@ -1,19 +1,50 @@
+"""Write-behind queue for cache writes that should not delay the response.
+
+Entries are coalesced by cache alias and key, so a key that is queued again
+before it was written is only written once, with the latest value. Workers
+take what is pending and write it with one ``set_many`` per alias and
+timeout. When the queue is full ``TIMETABLE_CACHE_WRITE_QUEUE_POLICY``
+decides what gives.
+"""
+
+import atexit
 import logging
-import queue
+import os
 import threading
-from dataclasses import dataclass
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass, field
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from opentelemetry.metrics import CallbackOptions, Observation
 from opentelemetry.trace import Link, SpanContext
 
+from django.conf import settings
 from django.core.cache import caches
 from django.http.response import HttpResponseBase
 
 logger = logging.getLogger(__name__)
 tracer = trace.get_tracer(__name__)
 
-_MAX_QUEUE_SIZE = 32
-_WORKER_GET_TIMEOUT_SECONDS = 0.5
+# Drop the entry being queued, keeping what is already waiting.
+DROP_NEW = "drop_new"
+# Drop the entry that has waited longest, it is the most likely to be stale.
+DROP_OLDEST = "drop_oldest"
+# Write the entry on the calling thread, slowing the request down instead.
+WRITE_THROUGH = "write_through"
+POLICIES = (DROP_NEW, DROP_OLDEST, WRITE_THROUGH)
+
+# Most entries a worker writes in one go.
+_MAX_BATCH_SIZE = 64
+# How long exiting processes wait for pending writes.
+_SHUTDOWN_TIMEOUT_SECONDS = 5.0
+
+_meter = metrics.get_meter(__name__)
+_dropped = _meter.create_counter("cache.write_behind.dropped", unit="{entry}")
+_coalesced = _meter.create_counter("cache.write_behind.coalesced", unit="{entry}")
+_written = _meter.create_counter("cache.write_behind.written", unit="{entry}")
+_latency = _meter.create_histogram("cache.write_behind.latency", unit="s")
 
 
 @dataclass(frozen=True)
@@ -23,67 +54,103 @@ class QueuedCacheSet:
     value: object
     timeout: float | None
     source_span_context: SpanContext
+    queued_at: float = field(default_factory=time.monotonic)
+
 
+_condition = threading.Condition()
+_pending: OrderedDict[tuple[str, str], QueuedCacheSet] = OrderedDict()
+_writing = 0
+_workers: list[threading.Thread] = []
+_stopping = False
 
-_lock = threading.Lock()
-_tasks: queue.Queue[QueuedCacheSet] = queue.Queue(maxsize=_MAX_QUEUE_SIZE)
-_worker_thread: threading.Thread | None = None
+
+def _observe_depth(options: CallbackOptions) -> Iterable[Observation]:
+    yield Observation(len(_pending))
+
+
+_meter.create_observable_gauge(
+    "cache.write_behind.depth", callbacks=[_observe_depth], unit="{entry}"
+)
 
 
 def _cacheable_value(value):
     if isinstance(value, HttpResponseBase):
-        return value.__class__(
+        copy = value.__class__(
             value.content,
             status=value.status_code,
             headers=value.headers,
         )
+        # NonceTemplateResponse needs these to splice in nonces when served.
+        if hasattr(value, "nonce_offsets"):
+            copy.nonce_offsets = value.nonce_offsets
+        return copy
     return value
 
 
 def _worker() -> None:
+    global _writing
     while True:
-        try:
-            task = _tasks.get(timeout=_WORKER_GET_TIMEOUT_SECONDS)
-        except queue.Empty:
-            continue
+        with _condition:
+            _condition.wait_for(lambda: _pending or _stopping)
+            if not _pending:
+                return
+            batch = [
+                _pending.popitem(last=False)[1]
+                for _ in range(min(len(_pending), _MAX_BATCH_SIZE))
+            ]
+            _writing += len(batch)
 
         try:
-            _write_task(task)
+            _write_batch(batch)
         finally:
-            _tasks.task_done()
+            with _condition:
+                _writing -= len(batch)
+                _condition.notify_all()
 
 
-def _write_task(task: QueuedCacheSet) -> None:
-    links = (
-        [Link(task.source_span_context)] if task.source_span_context.is_valid else []
-    )
-    # The writer runs after the request ends, so link its independent trace to the
-    # request span rather than incorrectly extending that request's critical path.
-    with tracer.start_as_current_span("ICAL CACHE WRITE", links=links):
-        try:
-            caches[task.cache_alias].set(task.key, task.value, timeout=task.timeout)
-        except Exception:
-            logger.exception(
-                "failed to persist queued cache entry",
-                extra={"cache_alias": task.cache_alias, "key": task.key},
-            )
-
+def _write_batch(batch: list[QueuedCacheSet]) -> None:
+    links = []
+    groups: dict[tuple[str, float | None], dict[str, object]] = {}
+    for task in batch:
+        if task.source_span_context.is_valid:
+            links.append(Link(task.source_span_context))
+        groups.setdefault((task.cache_alias, task.timeout), {})[task.key] = task.value
 
-def _ensure_worker_started() -> None:
-    global _worker_thread
-    if _worker_thread and _worker_thread.is_alive():
+    # The writer runs after the request ends, so link its independent trace to the
+    # request spans rather than incorrectly extending their critical path.
+    with tracer.start_as_current_span("CACHE WRITE BEHIND", links=links):
+        for (cache_alias, timeout), values in groups.items():
+            try:
+                caches[cache_alias].set_many(values, timeout=timeout)
+            except Exception:
+                logger.exception(
+                    "failed to persist queued cache entries",
+                    extra={"cache_alias": cache_alias, "keys": list(values)},
+                )
+                continue
+            _written.add(len(values), {"cache.alias": cache_alias})
+
+    now = time.monotonic()
+    for task in batch:
+        _latency.record(now - task.queued_at, {"cache.alias": task.cache_alias})
+
+
+def _ensure_workers_started() -> None:
+    if len(_workers) >= settings.TIMETABLE_CACHE_WRITE_WORKERS and all(
+        worker.is_alive() for worker in _workers
+    ):
         return
 
-    with _lock:
-        if _worker_thread and _worker_thread.is_alive():
-            return
-
-        _worker_thread = threading.Thread(
-            target=_worker,
-            name="ical-cache-writer",
-            daemon=True,
-        )
-        _worker_thread.start()
+    with _condition:
+        _workers[:] = [worker for worker in _workers if worker.is_alive()]
+        while len(_workers) < settings.TIMETABLE_CACHE_WRITE_WORKERS:
+            worker = threading.Thread(
+                target=_worker,
+                name=f"cache-writer-{len(_workers)}",
+                daemon=True,
+            )
+            worker.start()
+            _workers.append(worker)
 
 
 def enqueue_cache_set(
@@ -92,7 +159,8 @@ def enqueue_cache_set(
     value,
     timeout: float | None,
 ) -> bool:
-    _ensure_worker_started()
+    """Queue ``value`` to be written to ``key``, False when it was dropped."""
+    _ensure_workers_started()
     task = QueuedCacheSet(
         cache_alias=cache_alias,
         key=key,
@@ -100,16 +168,80 @@ def enqueue_cache_set(
         timeout=timeout,
         source_span_context=trace.get_current_span().get_span_context(),
     )
-    try:
-        _tasks.put_nowait(task)
-    except queue.Full:
-        logger.warning(
-            "dropping queued cache entry due to full queue",
-            extra={"cache_alias": cache_alias, "key": key},
-        )
-        return False
+    policy = settings.TIMETABLE_CACHE_WRITE_QUEUE_POLICY
+    attributes = {"cache.alias": cache_alias}
+
+    with _condition:
+        if (cache_alias, key) in _pending:
+            # Keep the place in the queue, but write the latest value.
+            _pending[cache_alias, key] = task
+            _coalesced.add(1, attributes)
+            return True
+
+        full = len(_pending) >= settings.TIMETABLE_CACHE_WRITE_QUEUE_SIZE
+        if full and policy == DROP_NEW:
+            _dropped.add(1, attributes | {"policy": policy})
+            logger.warning(
+                "dropping queued cache entry due to full queue",
+                extra={"cache_alias": cache_alias, "key": key},
+            )
+            return False
+        elif full and policy == DROP_OLDEST and _pending:
+            _key, oldest = _pending.popitem(last=False)
+            _dropped.add(1, {"cache.alias": oldest.cache_alias, "policy": policy})
+            logger.warning(
+                "dropping oldest queued cache entry due to full queue",
+                extra={"cache_alias": oldest.cache_alias, "key": oldest.key},
+            )
+
+        if not full or policy != WRITE_THROUGH:
+            _pending[cache_alias, key] = task
+            # Workers and flush() wait on the same condition, so wake everyone
+            # or the wakeup can go to a flush() waiter and leave workers asleep.
+            _condition.notify_all()
+            return True
+
+    _write_batch([task])
     return True
 
 
+def flush(timeout: float | None = None) -> bool:
+    """Wait for queued entries to be written, False if ``timeout`` ran out."""
+    with _condition:
+        return _condition.wait_for(lambda: not _pending and not _writing, timeout)
+
+
 def flush_for_tests() -> None:
-    _tasks.join()
+    flush()
+
+
+@atexit.register
+def shutdown() -> None:
+    """Write what is still queued and stop the workers."""
+    global _stopping
+    with _condition:
+        _stopping = True
+        _condition.notify_all()
+
+    deadline = time.monotonic() + _SHUTDOWN_TIMEOUT_SECONDS
+    for worker in _workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
+    if _pending:
+        logger.warning(
+            "exiting with unwritten queued cache entries",
+            extra={"count": len(_pending)},
+        )
+
+
+def _reset_after_fork() -> None:
+    # Threads do not survive a fork, and entries queued before it belong to
+    # the parent.
+    global _condition, _writing, _stopping
+    _condition = threading.Condition()
+    _pending.clear()
+    _workers.clear()
+    _writing = 0
+    _stopping = False
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,17 +1,28 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
+import dataclasses
 import datetime
+import gzip
+import io
+import threading
 from contextlib import nullcontext
 from unittest import mock
 
 import pytest
+import vobject
+from django.core.cache import caches
+from django.core.management import call_command
+from django.http import HttpResponse
 from django.utils import http as http_utils
 from opentelemetry.trace import INVALID_SPAN_CONTEXT
 
 from plan.common import utils
-from plan.common.models import Exam, Lecture
+from plan.common.catalog import get_schedule_rows
+from plan.common.lecture_data import LectureData, Weekday
+from plan.common.middleware import NonceTemplateResponse
+from plan.common.models import Exam, Lecture, Semester
 from plan.common.snapshot import get_schedule_snapshot
-from plan.ical import queue, views
+from plan.ical import queue, throttle, views, writer
 
 FIXTURE_LECTURE_ID = 12
 
@@ -74,6 +85,7 @@ def test_ical_instruments_generation_phases(
 
     assert response.status_code == 200
     assert [call.args[0] for call in start_span.call_args_list] == [
+        "ICAL DATA",
         "ICAL LECTURES",
         "ICAL EXAMS",
         "ICAL SERIALIZE",
@@ -89,10 +101,85 @@ def test_ical_cache_writer_instruments_background_write():
             queue.tracer, "start_as_current_span", return_value=nullcontext()
         ) as start_span,
     ):
-        queue._write_task(task)
+        queue._write_batch([task])
 
-    start_span.assert_called_once_with("ICAL CACHE WRITE", links=[])
-    cache.set.assert_called_once_with("test", "value", timeout=60)
+    start_span.assert_called_once_with("CACHE WRITE BEHIND", links=[])
+    cache.set_many.assert_called_once_with({"test": "value"}, timeout=60)
+
+
+@pytest.fixture
+def paused_queue():
+    """Queue entries without starting the writers, dropped after the test."""
+    with mock.patch.object(queue, "_ensure_workers_started"):
+        yield queue._pending
+    queue._pending.clear()
+
+
+def test_cache_write_queue_coalesces_keys_and_batches_writes(paused_queue):
+    queue.enqueue_cache_set("disk", "a", "old", 60)
+    queue.enqueue_cache_set("disk", "b", "value", 60)
+    queue.enqueue_cache_set("disk", "a", "new", 60)
+    queue.enqueue_cache_set("default", "c", "value", None)
+
+    assert [task.value for task in paused_queue.values()] == ["new", "value", "value"]
+
+    backends = {"disk": mock.Mock(), "default": mock.Mock()}
+    with mock.patch.object(queue, "caches", backends):
+        queue._write_batch(list(paused_queue.values()))
+
+    backends["disk"].set_many.assert_called_once_with(
+        {"a": "new", "b": "value"}, timeout=60
+    )
+    backends["default"].set_many.assert_called_once_with({"c": "value"}, timeout=None)
+
+
+def test_cache_write_queue_keeps_nonce_offsets(paused_queue):
+    placeholder = NonceTemplateResponse.PLACEHOLDERS["script"]
+    response = NonceTemplateResponse.from_response(
+        HttpResponse(f'<script nonce="{placeholder}"></script>')
+    )
+
+    queue.enqueue_cache_set("disk", "page", response, 60)
+
+    (task,) = paused_queue.values()
+    assert task.value is not response
+    assert task.value.nonce_offsets == response.nonce_offsets
+    served = task.value.with_nonces(script="abc", style="def")
+    assert gzip.decompress(served.content) == b'<script nonce="abc"></script>'
+
+
+@pytest.mark.parametrize(
+    ("policy", "queued", "kept"),
+    [
+        (queue.DROP_NEW, False, ["a"]),
+        (queue.DROP_OLDEST, True, ["b"]),
+        (queue.WRITE_THROUGH, True, ["a"]),
+    ],
+)
+def test_cache_write_queue_full_policies(paused_queue, settings, policy, queued, kept):
+    settings.TIMETABLE_CACHE_WRITE_QUEUE_SIZE = 1
+    settings.TIMETABLE_CACHE_WRITE_QUEUE_POLICY = policy
+    cache = mock.Mock()
+
+    with mock.patch.object(queue, "caches", {"disk": cache}):
+        assert queue.enqueue_cache_set("disk", "a", "value", 60)
+        assert queue.enqueue_cache_set("disk", "b", "value", 60) is queued
+
+    assert [key for _alias, key in paused_queue] == kept
+    if policy == queue.WRITE_THROUGH:
+        cache.set_many.assert_called_once_with({"b": "value"}, timeout=60)
+    else:
+        cache.set_many.assert_not_called()
+
+
+def test_cache_write_queue_drop_oldest_without_room(paused_queue, settings):
+    settings.TIMETABLE_CACHE_WRITE_QUEUE_SIZE = 0
+    settings.TIMETABLE_CACHE_WRITE_QUEUE_POLICY = queue.DROP_OLDEST
+
+    with mock.patch.object(queue, "caches", {"disk": mock.Mock()}):
+        assert queue.enqueue_cache_set("disk", "a", "value", 60)
+
+    assert [key for _alias, key in paused_queue] == ["a"]
 
 
 def test_ical_not_modified_returns_304_with_validator_headers(
@@ -236,9 +323,9 @@ def test_ical_uses_last_modified_for_dtstamp(
     assert response.status_code == 200
     assert "Last-Modified" in response.headers
     timestamp = http_utils.parse_http_date(response.headers["Last-Modified"])
-    dtstamp = datetime.datetime.fromtimestamp(
-        timestamp, tz=datetime.timezone.utc
-    ).strftime("%Y%m%dT%H%M%SZ")
+    dtstamp = datetime.datetime.fromtimestamp(timestamp, tz=datetime.UTC).strftime(
+        "%Y%m%dT%H%M%SZ"
+    )
     assert f"DTSTAMP:{dtstamp}" in response.content.decode()
 
 
@@ -261,7 +348,7 @@ def test_ical_exam_event_timestamps_are_stable(
     )[0]
     expected_start = datetime.datetime.combine(
         exam.exam_date, exam.exam_time, tzinfo=views.TZ
-    ).astimezone(datetime.timezone.utc)
+    ).astimezone(datetime.UTC)
     body = response.content.decode()
     event_start = body.index(f"UID:exam-{exam.id}@")
     event = body[event_start : body.index("END:VEVENT", event_start)]
@@ -346,3 +433,250 @@ def test_ical_type_without_trailing_slash_redirects_to_canonical_url(
     response = client.get(url.rstrip("/"), follow=False)
     assert response.status_code == 301
     assert response["Location"] == url
+
+
+def test_ical_writer_escapes_and_folds_text():
+    line = writer.text("DESCRIPTION", "a, b; c\\d\r\n" + "é" * 60)
+
+    lines = line.split(b"\r\n")
+    assert lines[-1] == b""
+    assert all(len(folded) <= writer.LINE_LIMIT for folded in lines)
+    assert lines[0].startswith(rb"DESCRIPTION:a\, b\; c\\d\n")
+    unfolded = line.replace(b"\r\n ", b"").decode()
+    assert unfolded == r"DESCRIPTION:a\, b\; c\\d\n" + "é" * 60 + "\r\n"
+
+
+def test_ical_writer_output_parses_with_vobject():
+    dtstamp = datetime.datetime(2009, 1, 1, tzinfo=datetime.UTC)
+    start = datetime.datetime(2009, 1, 5, 8, 15, tzinfo=views.TZ)
+    body = b"".join(
+        writer.calendar(
+            [writer.text("X-WR-CALNAME", "2009/spring/adamcik")],
+            [
+                writer.event(
+                    writer.text("UID", "lecture-1-20090105@example.com"),
+                    writer.when("DTSTART", start),
+                    writer.when("DTEND", start + datetime.timedelta(hours=2)),
+                    writer.text("DESCRIPTION", "Course (Lecture)\n - Room, url"),
+                    writer.when("DTSTAMP", dtstamp),
+                    writer.text("SUMMARY", "TDT4100\nTitle"),
+                ),
+                writer.event(
+                    writer.text("UID", "exam-1@example.com"),
+                    writer.when("DTSTART", datetime.date(2009, 5, 20)),
+                    writer.when("DTEND", datetime.date(2009, 5, 20)),
+                ),
+            ],
+        )
+    )
+
+    cal = vobject.readOne(body.decode())
+    lecture, exam = cal.vevent_list
+    assert lecture.uid.value == "lecture-1-20090105@example.com"
+    assert lecture.dtstart.value == start
+    assert lecture.dtstamp.value == dtstamp
+    assert lecture.description.value == "Course (Lecture)\n - Room, url"
+    assert lecture.summary.value == "TDT4100\nTitle"
+    assert exam.dtstart.value == datetime.date(2009, 5, 20)
+
+
+def test_ical_compact_lectures_expand_to_the_same_occurrences(
+    client, serialized_schedule_data, cache_isolation, frozen_time, ical_url
+):
+    url = ical_url("schedule-ical-type", "lectures")
+    full = client.get(f"{url}?no-cache=1", HTTP_ACCEPT_ENCODING="")
+    compact = client.get(f"{url}?compact&no-cache=1", HTTP_ACCEPT_ENCODING="")
+    assert full.status_code == 200
+    assert compact.status_code == 200
+    assert full.headers["ETag"] != compact.headers["ETag"]
+
+    def occurrences(body, expand):
+        result = set()
+        for vevent in vobject.readOne(body.decode()).vevent_list:
+            lecture_id = int(vevent.uid.value.split("-")[1])
+            for start in expand(vevent):
+                result.add((lecture_id, start))
+        return result
+
+    full_cal = occurrences(full.content, lambda vevent: [vevent.dtstart.value])
+    compact_cal = occurrences(
+        compact.content,
+        lambda vevent: vevent.getrruleset(addRDate=True) or [vevent.dtstart.value],
+    )
+    assert compact.content.count(b"BEGIN:VEVENT") < full.content.count(b"BEGIN:VEVENT")
+    assert compact_cal == full_cal
+
+
+def test_ical_compact_uids_do_not_shift_when_runs_are_added():
+    def uids(week_numbers):
+        lecture = LectureData(
+            lecture_id=1,
+            title=None,
+            summary=None,
+            stream=None,
+            day=Weekday.MONDAY,
+            start=datetime.time(8, 15),
+            end=datetime.time(10, 0),
+            week_numbers=week_numbers,
+            alias=None,
+            exclude=False,
+            course_id=1,
+            course_code="TDT4100",
+            course_name="Course",
+            type_id=None,
+            type_code=None,
+            type_name=None,
+            type_optional=False,
+        )
+        fragment = views._lecture_fragment(
+            lecture, {}, 2009, None, "example.com", compact=True
+        )
+        return [
+            line.split(b":", 1)[1]
+            for event in fragment
+            for line in event.split(b"\r\n")
+            if line.startswith(b"UID:")
+        ]
+
+    # Daylight saving time starts in week 13 of 2009, splitting the runs.
+    later = uids((20, 21, 22))
+    assert later == [b"lecture-1-20090511-weekly@example.com"]
+    assert uids((2, 3, 20, 21, 22))[-1:] == later
+
+
+def test_ical_lecture_fragments_are_shared_between_aliases(
+    rf, serialized_schedule_data, cache_isolation, schedule_scenario
+):
+    snapshot = get_schedule_snapshot(
+        schedule_scenario.semester, schedule_scenario.student.slug
+    )
+    rows = get_schedule_rows(snapshot.semester, snapshot.student.id)
+    aliased = [dataclasses.replace(l, alias="Alias") for l in rows.lectures]
+    dtstamp = datetime.datetime(2009, 1, 1, tzinfo=datetime.UTC)
+
+    def feed(lectures):
+        events = views.add_lectutures(
+            lectures, rows.rooms, snapshot.semester, rf.get("/"), "example.com", dtstamp
+        )
+        return b"".join(events)
+
+    with mock.patch.object(
+        views, "_lecture_fragment", wraps=views._lecture_fragment
+    ) as render:
+        plain = feed(rows.lectures)
+        rendered = render.call_count
+        alias = feed(aliased)
+
+    assert rendered > 0
+    assert render.call_count == rendered
+    assert b"SUMMARY:Alias" in alias
+    assert b"SUMMARY:Alias" not in plain
+    assert alias.count(b"BEGIN:VEVENT") == plain.count(b"BEGIN:VEVENT")
+    assert alias.count(b"END:VEVENT") == plain.count(b"END:VEVENT")
+
+
+def test_pregenerate_ical_writes_feeds_served_as_cache_hits(
+    client, serialized_schedule_data, cache_isolation, frozen_time, ical_url
+):
+    semester = Semester.objects.get(year=2009, type=Semester.SPRING)
+    call_command(
+        "pregenerate_ical",
+        year=semester.year,
+        type=semester.type,
+        workers=0,
+        host="testserver",
+        http=True,
+        stdout=io.StringIO(),
+    )
+
+    for url in (
+        ical_url("schedule-ical"),
+        ical_url("schedule-ical-type", "lectures"),
+        ical_url("schedule-ical-type", "exams"),
+    ):
+        cached = client.get(url, HTTP_ACCEPT_ENCODING="")
+        rendered = client.get(f"{url}?no-cache=1", HTTP_ACCEPT_ENCODING="")
+        assert "hit" in cached.headers["X-Cache"]
+        assert cached.headers["ETag"] == rendered.headers["ETag"]
+        assert cached.content == rendered.content
+
+
+def test_ical_throttles_clients_polling_a_feed_too_often(
+    client, serialized_schedule_data, cache_isolation, frozen_time, ical_url, settings
+):
+    settings.TIMETABLE_ICAL_RATE_LIMIT_BURST = 2
+    settings.TIMETABLE_ICAL_RATE_LIMIT_INTERVAL = 60
+    url = ical_url("schedule-ical")
+    first = client.get(url)
+    assert first.status_code == 200
+    assert client.get(f"{url}?no-cache=1").status_code == 200
+
+    throttled = client.get(f"{url}?no-cache=1")
+    assert throttled.status_code == 429
+    assert 0 < int(throttled.headers["Retry-After"]) <= 60
+
+    # Clients with an older copy must not be told it is current.
+    older = client.get(f"{url}?no-cache=1", HTTP_IF_NONE_MATCH='"older"')
+    assert older.status_code == 429
+    assert "Retry-After" in older.headers
+
+    current = client.get(url, HTTP_IF_NONE_MATCH=first.headers["ETag"])
+    assert current.status_code == 304
+    assert current.headers["ETag"] == first.headers["ETag"]
+
+    # Cache hits are cheap, so they are served to throttled clients too.
+    queue.flush_for_tests()
+    cached = client.get(url)
+    assert cached.status_code == 200
+    assert "hit" in cached.headers["X-Cache"]
+
+    other = client.get(ical_url("schedule-ical-type", "exams"))
+    assert other.status_code == 200
+
+
+def test_ical_throttle_counts_polls_in_shared_cache(rf, cache_isolation, settings):
+    settings.TIMETABLE_ICAL_RATE_LIMIT_BURST = 2
+    settings.TIMETABLE_ICAL_RATE_LIMIT_INTERVAL = 60
+    settings.TIMETABLE_ICAL_RATE_LIMIT_CACHE = "default"
+    request = rf.get("/feed/")
+
+    with mock.patch.object(throttle, "time", mock.Mock(time=lambda: 1200.0)):
+        assert throttle.retry_after(request, "/feed/") is None
+        assert throttle.retry_after(request, "/feed/") is None
+        # Another worker process has its own, still full, local buckets.
+        caches["local"].clear()
+        assert throttle.retry_after(request, "/feed/") == 120
+
+
+def test_ical_throttle_buckets_are_shared_by_threads(rf, cache_isolation, settings):
+    settings.TIMETABLE_ICAL_RATE_LIMIT_BURST = 20
+    settings.TIMETABLE_ICAL_RATE_LIMIT_INTERVAL = 3600
+    request = rf.get("/feed/")
+    allowed = []
+
+    def poll():
+        for _ in range(10):
+            allowed.append(throttle.retry_after(request, "/feed/") is None)
+
+    threads = [threading.Thread(target=poll) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(allowed) == 20
+
+
+def test_ical_concurrent_misses_share_one_render(
+    client, serialized_schedule_data, cache_isolation, frozen_time, ical_url
+):
+    url = ical_url("schedule-ical")
+    with mock.patch.object(
+        views, "single_flight", return_value=(views.http.HttpResponse(b"shared"), False)
+    ) as single_flight:
+        response = client.get(url)
+
+    assert single_flight.call_count == 1
+    assert response.status_code == 200
+    assert response.content == b"shared"
+    assert "coalesced" in response.headers["X-Cache"]
@@ -0,0 +1,76 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+"""Token buckets limiting how often a client polls the same iCal feed.
+
+Each client and feed path gets ``TIMETABLE_ICAL_RATE_LIMIT_BURST`` polls
+right away, and one more for every ``TIMETABLE_ICAL_RATE_LIMIT_INTERVAL``
+seconds after that. The view only takes from the bucket on cache misses,
+as cached feeds are cheap to serve. Buckets live in the in-process ``local``
+cache. With ``TIMETABLE_ICAL_RATE_LIMIT_CACHE`` set, polls the local bucket
+allows are also counted in that shared cache, so clients spread over several
+worker processes are held to about the same rate.
+"""
+
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Threads of this process share the local buckets.
+_local_lock = threading.Lock()
+
+
+def retry_after(request, path: str) -> int | None:
+    """Seconds until the client may poll ``path`` again, None if it may now."""
+    burst = settings.TIMETABLE_ICAL_RATE_LIMIT_BURST
+    if burst is None:
+        return None
+
+    interval = settings.TIMETABLE_ICAL_RATE_LIMIT_INTERVAL
+    key = f"ical:throttle:v1:{request.META.get('REMOTE_ADDR')}:{path}"
+    now = time.time()
+    wait = _take_local(key, burst, interval, now)
+    if wait is None and settings.TIMETABLE_ICAL_RATE_LIMIT_CACHE is not None:
+        wait = _take_shared(key, burst, interval, now)
+    return None if wait is None else max(1, math.ceil(wait))
+
+
+def _take_local(key: str, burst: int, interval: float, now: float) -> float | None:
+    cache = caches["local"]
+    with _local_lock:
+        tokens, updated = cache.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) / interval)
+        if tokens >= 1:
+            tokens, wait = tokens - 1, None
+        else:
+            wait = (1 - tokens) * interval
+        # A full bucket is the same as no bucket, so it can expire then.
+        cache.set(key, (tokens, now), timeout=(burst - tokens) * interval + 1)
+    return wait
+
+
+def _take_shared(key: str, burst: int, interval: float, now: float) -> float | None:
+    # Shared buckets would need a lock, a counter per window long enough for
+    # ``burst`` polls is close enough. Racing workers can lose a count, which
+    # only ever lets an extra poll through.
+    window = burst * interval
+    window_end = (math.floor(now / window) + 1) * window
+    window_key = f"{key}:{window_end:.0f}"
+    cache = caches[settings.TIMETABLE_ICAL_RATE_LIMIT_CACHE]
+    try:
+        count = cache.get(window_key, 0) + 1
+        cache.set(window_key, count, timeout=math.ceil(window_end - now))
+    except Exception:
+        # The limiter must never fail polls, let them through instead.
+        logger.warning(
+            "failed to count iCal poll in shared cache",
+            exc_info=True,
+            extra={"cache_alias": settings.TIMETABLE_ICAL_RATE_LIMIT_CACHE},
+        )
+        return None
+    return window_end - now if count > burst else None
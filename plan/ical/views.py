@@ -1,11 +1,11 @@
 # This file is part of the plan timetable generator, see LICENSE for details.
 
 import datetime
+import functools
 import math
 import socket
 import zoneinfo
 
-import vobject
 from dateutil import rrule
 from opentelemetry import trace
 
@@ -17,13 +17,10 @@ from django.utils import http as http_utils
 from django.utils import translation
 
 from plan.common import utils
-from plan.common.models import (
-    Exam,
-    Lecture,
-    Room,
-    Week,
-)
+from plan.common.cache import MultiCache, single_flight
+from plan.common.catalog import get_schedule_rows
 from plan.common.snapshot import ScheduleSnapshotNotFound, get_schedule_snapshot
+from plan.ical import throttle, writer
 
 _ = translation.gettext
 tracer = trace.get_tracer(__name__)
@@ -31,6 +28,9 @@ tracer = trace.get_tracer(__name__)
 TZ = zoneinfo.ZoneInfo(settings.TIME_ZONE)
 UTC = zoneinfo.ZoneInfo("UTC")
 
+# How long requests wait for a render of the same feed by another request.
+COALESCE_WAIT = 10.0
+
 
 def _to_utc(dt: datetime.datetime) -> datetime.datetime:
     if dt.tzinfo is None:
@@ -58,14 +58,12 @@ def ical(request, semester, slug, ical_type=None):
         internal_cache_timeout = None
 
     bypass_cache = utils.should_bypass_cache(request)
-    route = str(request.resolver_match.url_name)
-    path = request.path_info
-    cache_key = utils.response_cache_key(route, snapshot.freshness_key(), path)
-    headers = utils.build_validator_headers(
-        cache_key=cache_key,
-        last_modified=snapshot.last_modified,
-        extra_headers={"X-Robots-Tag": "noindex, nofollow"},
+    # Opt-in, one recurring VEVENT per run of weeks instead of one per week.
+    compact = "compact" in request.GET
+    cache_key = ical_cache_key(
+        str(request.resolver_match.url_name), snapshot, request.path_info, compact
     )
+    headers = ical_headers(snapshot, cache_key)
     response = utils.check_not_modified(request, snapshot.last_modified, headers)
     if response:
         # This may return 304 before internal cache lookup/bypass.
@@ -81,6 +79,56 @@ def ical(request, semester, slug, ical_type=None):
     if response:
         return response
 
+    # Only renders are expensive, so cache hits are not limited.
+    retry_after = throttle.retry_after(request, request.path_info)
+    if retry_after is not None:
+        response = http.HttpResponse(status=429)
+        response["Retry-After"] = str(retry_after)
+        return response
+
+    def render():
+        with tracer.start_as_current_span("ICAL DATA"):
+            rows = get_schedule_rows(snapshot.semester, snapshot.student.id)
+        return render_ical(request, snapshot, resources, rows, headers, compact)
+
+    # Concurrent misses of the same feed share one render, which nobody may
+    # modify, so everyone gets their own copy.
+    shared, rendered = single_flight(cache_key, render, COALESCE_WAIT)
+    response = http.HttpResponse(
+        shared.content, status=shared.status_code, headers=shared.headers
+    )
+    if not rendered:
+        response["X-Cache"] = f"miss; coalesced; key={cache_key}"
+        return response
+
+    return utils.store_cached_response(
+        cache_alias="disk",
+        cache_key=cache_key,
+        response=response,
+        timeout=internal_cache_timeout,
+        bypass=bypass_cache,
+        queued=True,
+    )
+
+
+def ical_cache_key(route, snapshot, path, compact=False):
+    """Response cache key of the feed at ``path``, also used to pre-generate."""
+    cache_key_parts = [path]
+    if compact:
+        cache_key_parts.append("compact")
+    return utils.response_cache_key(route, snapshot.freshness_key(), *cache_key_parts)
+
+
+def ical_headers(snapshot, cache_key):
+    return utils.build_validator_headers(
+        cache_key=cache_key,
+        last_modified=snapshot.last_modified,
+        extra_headers={"X-Robots-Tag": "noindex, nofollow"},
+    )
+
+
+def render_ical(request, snapshot, resources, rows, headers, compact=False):
+    """Calendar response with ``resources`` of the student's schedule ``rows``."""
     filename = utils.ical_filename(snapshot, resources)
 
     title = urls.reverse("schedule", args=[snapshot.semester, snapshot.student.slug])
@@ -88,70 +136,60 @@ def ical(request, semester, slug, ical_type=None):
         "Host", socket.getfqdn()
     )
 
-    cal = vobject.iCalendar()
-    cal.add("method").value = "PUBLISH"  # IE/Outlook needs this
-
     # TODO(adamcik): use same logic as in common.templatetags.title
     if snapshot.student.slug.lower().endswith("s"):
         description = _("%(slug)s' %(semester)s %(year)s schedule for %(resources)s")
     else:
         description = _("%(slug)s's %(semester)s %(year)s schedule for %(resources)s")
 
-    cal.add("X-WR-CALNAME").value = title.strip("/")
-    cal.add("X-WR-CALDESC").value = description % {
-        "slug": snapshot.student.slug,
-        "semester": snapshot.semester.get_type_display(),
-        "year": snapshot.semester.year,
-        "resources": ", ".join(resources),
-    }
+    properties = [
+        writer.text("METHOD", "PUBLISH"),  # IE/Outlook needs this
+        writer.text("X-WR-CALNAME", title.strip("/")),
+        writer.text(
+            "X-WR-CALDESC",
+            description
+            % {
+                "slug": snapshot.student.slug,
+                "semester": snapshot.semester.get_type_display(),
+                "year": snapshot.semester.year,
+                "resources": ", ".join(resources),
+            },
+        ),
+    ]
 
     if snapshot.last_modified is not None:
         dtstamp = datetime.datetime.fromtimestamp(snapshot.last_modified, tz=UTC)
     else:
         dtstamp = datetime.datetime.now(tz=UTC)
 
+    events = []
     if _("lectures") in resources:
         with tracer.start_as_current_span("ICAL LECTURES"):
-            lectures = Lecture.objects.get_lectures_data(
-                snapshot.semester.id,
-                snapshot.student.id,
-            )
-            add_lectutures(
-                lectures,
-                snapshot.semester.year,
-                cal,
-                request,
-                hostname,
-                dtstamp,
+            events.extend(
+                add_lectutures(
+                    rows.lectures,
+                    rows.rooms,
+                    snapshot.semester,
+                    request,
+                    hostname,
+                    dtstamp,
+                    compact=compact,
+                )
             )
 
     if _("exams") in resources:
         with tracer.start_as_current_span("ICAL EXAMS"):
-            exams = Exam.objects.get_exams(
-                snapshot.semester.year,
-                snapshot.semester.type,
-                snapshot.student.slug,
-            )
-            add_exams(exams, cal, hostname, dtstamp)
+            events.extend(add_exams(rows.exams, hostname, dtstamp))
 
     with tracer.start_as_current_span("ICAL SERIALIZE"):
         response = http.HttpResponse(
-            cal.serialize(),
+            b"".join(writer.calendar(properties, events)),
             content_type="text/calendar; charset=utf-8",
         )
     utils.apply_response_headers(response, headers)
     response["Filename"] = filename  # IE needs this
     response["Content-Disposition"] = "attachment; filename=%s" % filename
-
-    # TODO(adamcik): Rate limit remote hosts?
-    return utils.store_cached_response(
-        cache_alias="disk",
-        cache_key=cache_key,
-        response=response,
-        timeout=internal_cache_timeout,
-        bypass=bypass_cache,
-        queued=True,
-    )
+    return response
 
 
 # TODO: Consider adding redirect/url-shortner for rooms?
@@ -168,78 +206,198 @@ Stream: {{ lecture.stream }}
 )
 
 
-def add_lectutures(lectures, year, cal, request, hostname, dtstamp):
-    """Adds lectures to cal object for current semester"""
+def add_lectutures(
+    lectures, all_rooms, semester, request, hostname, dtstamp, compact=False
+):
+    """VEVENTs for every occurrence of lectures in the current semester
+
+    With ``compact`` each lecture is written as a few recurring VEVENTs
+    instead of one VEVENT per week. Yields the events of one lecture at a
+    time, assembled from fragments shared by every subscriber.
+    """
 
-    lecture_ids = [lecture.lecture_id for lecture in lectures]
-    all_rooms = Lecture.get_related(Room, lecture_ids, fields=["id", "name", "url"])
-    all_weeks = Lecture.get_related(
-        Week,
-        lecture_ids,
-        fields=["number"],
-        use_extra=False,
+    lectures = [l for l in lectures if not l.exclude and l.week_numbers]
+    fragments = _lecture_fragments(
+        semester,
+        lectures,
+        f"{int(compact)}:{hostname}:{request.build_absolute_uri('/')}",
+        functools.partial(
+            _lecture_fragment,
+            all_rooms=all_rooms,
+            year=semester.year,
+            request=request,
+            hostname=hostname,
+            compact=compact,
+        ),
     )
 
+    stamp = writer.when("DTSTAMP", dtstamp)
     for l in lectures:
-        if l.exclude:  # Skip excluded
-            continue
+        summary = l.alias or l.course_code
+        if l.title:
+            summary += "\n" + l.title
 
-        if l.lecture_id not in all_weeks:
-            continue
+        # Only these lines differ between subscribers of the same lecture.
+        tail = writer.text("SUMMARY", summary) + stamp + writer.EVENT_END
+        yield tail.join(fragments[l.lecture_id]) + tail
 
-        weeks = all_weeks[l.lecture_id]
 
-        rrule_kwargs = {
-            "byweekno": weeks,
-            "count": len(weeks),
-            "byweekday": l.day,
-            "dtstart": datetime.datetime(int(year), 1, 1),
-        }
+def ical_fragment_cache_key(semester, lecture_id, variant):
+    return f"ical:fragment:v2:{semester.id}-{semester.version}:{lecture_id}:{variant}"
 
-        summary = l.alias or l.course_code
-        if l.title:
-            summary += "\n" + l.title
 
-        rooms = []
-        for r in all_rooms.get(l.lecture_id, []):
-            if r["url"]:
-                tmp = reverse("redirect_room", args=(r["id"],))
-                r["url"] = request.build_absolute_uri(tmp)
-            rooms.append(r)
+def _lecture_fragments(semester, lectures, variant, render):
+    """Cached fragments of ``lectures`` by lecture id, rendering misses.
 
-        context = template.Context(
-            {"lecture": l, "rooms": all_rooms.get(l.lecture_id, [])}
-        )
-        desc = DESCRIPTION_TEXT.render(context)
+    Fragments are keyed by the semester version like the course catalogs, so
+    they are shared by every student until the next scrape. ``variant`` covers
+    what depends on the request instead of the lecture.
+    """
+    ttl = settings.TIMETABLE_ICAL_FRAGMENT_CACHE_DEFAULT_TTL
+    if ttl is None:
+        return {l.lecture_id: render(l) for l in lectures}
+
+    cache = MultiCache[tuple[bytes, ...]](default=ttl)
+    keys = {
+        l.lecture_id: ical_fragment_cache_key(semester, l.lecture_id, variant)
+        for l in lectures
+    }
+    results = cache.get_many(keys.values())
+    fragments = {}
+    missing = {}
+    for l in lectures:
+        result = results[keys[l.lecture_id]]
+        if result.hit and result.value is not None:
+            fragments[l.lecture_id] = result.value
+        else:
+            missing[l.lecture_id] = render(l)
 
-        for d in rrule.rrule(rrule.WEEKLY, **rrule_kwargs):
-            vevent = cal.add("vevent")
-            vevent.add("summary").value = summary
-            vevent.add("location").value = ", ".join(r["name"] for r in rooms)
-            vevent.add("description").value = desc
+    cache.set_many(
+        {keys[lecture_id]: fragment for lecture_id, fragment in missing.items()}
+    )
+    fragments.update(missing)
+    return fragments
 
-            vevent.add("dtstart").value = _to_utc(
-                d.replace(hour=l.start.hour, minute=l.start.minute)
-            )
-            vevent.add("dtend").value = _to_utc(
-                d.replace(hour=l.end.hour, minute=l.end.minute)
-            )
-            vevent.add("dtstamp").value = dtstamp
 
-            vevent.add("uid").value = "lecture-%d-%s@%s" % (
-                l.lecture_id,
-                d.strftime("%Y%m%d"),
-                hostname,
+def _lecture_fragment(l, all_rooms, year, request, hostname, compact):
+    """Starts of the lecture's VEVENTs, without the per-subscriber lines.
+
+    Each event still needs SUMMARY, DTSTAMP and ``writer.EVENT_END``.
+    """
+    weeks = list(l.week_numbers)
+
+    rrule_kwargs = {
+        "byweekno": weeks,
+        "count": len(weeks),
+        "byweekday": l.day,
+        "dtstart": datetime.datetime(int(year), 1, 1),
+    }
+
+    # Room dicts are shared with cached schedule data, so don't modify them.
+    rooms = []
+    for r in all_rooms.get(l.lecture_id, []):
+        if r["url"]:
+            tmp = reverse("redirect_room", args=(r["id"],))
+            r = {**r, "url": request.build_absolute_uri(tmp)}
+        rooms.append(r)
+
+    context = template.Context({"lecture": l, "rooms": rooms})
+    desc = DESCRIPTION_TEXT.render(context)
+
+    # Everything but the times and UID is the same for each occurrence.
+    shared = [
+        writer.text("DESCRIPTION", desc),
+        writer.text("LOCATION", ", ".join(r["name"] for r in rooms)),
+    ]
+    if l.type_optional:
+        shared.append(writer.text("TRANSP", "TRANSPARENT"))
+
+    dates = list(rrule.rrule(rrule.WEEKLY, **rrule_kwargs))
+    occurrences = [
+        (
+            _to_utc(d.replace(hour=l.start.hour, minute=l.start.minute)),
+            _to_utc(d.replace(hour=l.end.hour, minute=l.end.minute)),
+        )
+        for d in dates
+    ]
+
+    if compact:
+        return tuple(
+            writer.event_start(
+                # Named by the first occurrence and not the position of the run,
+                # so adding an earlier run does not change the UIDs after it.
+                writer.text(
+                    "UID",
+                    f"lecture-{l.lecture_id}-{run[0][0]:%Y%m%d}-weekly@{hostname}",
+                ),
+                *_recurrence(run),
+                *shared,
             )
+            for run in _weekly_runs(occurrences)
+        )
 
-            if l.type_optional:
-                vevent.add("transp").value = "TRANSPARENT"
+    return tuple(
+        writer.event_start(
+            writer.text(
+                "UID",
+                "lecture-%d-%s@%s" % (l.lecture_id, d.strftime("%Y%m%d"), hostname),
+            ),
+            writer.when("DTSTART", start),
+            writer.when("DTEND", end),
+            *shared,
+        )
+        for d, (start, end) in zip(dates, occurrences)
+    )
 
 
-def add_exams(exams, cal, hostname, dtstamp):
-    for e in exams:
-        vevent = cal.add("vevent")
+def _weekly_runs(occurrences):
+    """Split occurrences into runs that one weekly RRULE in UTC can describe.
 
+    Times are written in UTC, so a run ends where daylight saving time moves
+    the lecture to another UTC time of day.
+    """
+    runs = []
+    for start, end in occurrences:
+        if runs:
+            previous_start, previous_end = runs[-1][-1]
+            if (
+                start.time() == previous_start.time()
+                and end - start == previous_end - previous_start
+            ):
+                runs[-1].append((start, end))
+                continue
+        runs.append([(start, end)])
+    return runs
+
+
+def _recurrence(run):
+    """DTSTART, DTEND, RRULE and EXDATE lines for one run of weekly occurrences.
+
+    Skipped weeks inside the run are listed as exceptions.
+    """
+    first_start, first_end = run[0]
+    lines = [writer.when("DTSTART", first_start), writer.when("DTEND", first_end)]
+    if len(run) == 1:
+        return lines
+
+    last_start = run[-1][0]
+    lines.append(writer.line("RRULE", f"FREQ=WEEKLY;UNTIL={writer.utc(last_start)}"))
+
+    starts = {start for start, _end in run}
+    week = datetime.timedelta(weeks=1)
+    skipped = []
+    current = first_start + week
+    while current < last_start:
+        if current not in starts:
+            skipped.append(writer.utc(current))
+        current += week
+    if skipped:
+        lines.append(writer.line("EXDATE", ",".join(skipped)))
+    return lines
+
+
+def add_exams(exams, hostname, dtstamp):
+    for e in exams:
         if e.type and e.type.name:
             summary = f"{e.type.name} - {e.alias or e.course.name}"
             desc = "{} ({}) - {} ({})".format(
@@ -254,39 +412,36 @@ def add_exams(exams, cal, hostname, dtstamp):
             summary = _("Exam") + " %s" % (e.alias or e.course.code)
             desc = _("Exam") + f" {e.course.name} ({e.course.code})"
 
-        vevent.add("summary").value = summary
-        vevent.add("description").value = desc
-        vevent.add("dtstamp").value = dtstamp
-
-        vevent.add("uid").value = "exam-%d@%s" % (e.id, hostname)
-
         if e.handout_date:
             if e.handout_time:
-                vevent.add("dtstart").value = _to_utc(
+                start = _to_utc(
                     datetime.datetime.combine(e.handout_date, e.handout_time)
                 )
             else:
-                vevent.add("dtstart").value = e.handout_date
+                start = e.handout_date
 
             if e.exam_time:
-                vevent.add("dtend").value = _to_utc(
-                    datetime.datetime.combine(e.exam_date, e.exam_time)
-                )
+                end = _to_utc(datetime.datetime.combine(e.exam_date, e.exam_time))
             else:
-                vevent.add("dtend").value = e.exam_date
+                end = e.exam_date
         else:
             if e.exam_time:
                 start = _to_utc(datetime.datetime.combine(e.exam_date, e.exam_time))
             else:
                 start = e.exam_date
 
-            vevent.add("dtstart").value = start
-
             if e.duration and e.exam_time:
                 hours = int(math.floor(e.duration))
                 minutes = int((e.duration % 1) * 60)
-                vevent.add("dtend").value = start + datetime.timedelta(
-                    hours=hours, minutes=minutes
-                )
+                end = start + datetime.timedelta(hours=hours, minutes=minutes)
             else:
-                vevent.add("dtend").value = start
+                end = start
+
+        yield writer.event(
+            writer.text("UID", "exam-%d@%s" % (e.id, hostname)),
+            writer.when("DTSTART", start),
+            writer.when("DTEND", end),
+            writer.text("DESCRIPTION", desc),
+            writer.when("DTSTAMP", dtstamp),
+            writer.text("SUMMARY", summary),
+        )
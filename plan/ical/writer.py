@@ -0,0 +1,98 @@
+# This file is part of the plan timetable generator, see LICENSE for details.
+
+"""Minimal RFC 5545 writer for the calendars served by the ical views.
+
+Content lines are written straight to bytes instead of going through a
+``vobject`` component tree. Properties shared by many events, such as the
+description of a weekly lecture, can be written once and reused for every
+occurrence.
+"""
+
+import datetime
+from collections.abc import Iterable, Iterator
+
+PRODID = "-//plan//NONSGML timetable//EN"
+
+# Content lines longer than this many octets must be folded.
+LINE_LIMIT = 75
+
+_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", ";": "\\;", ",": "\\,", "\n": "\\n"})
+
+
+def escape(value: str) -> str:
+    """Escape a TEXT value, normalizing line breaks to ``\\n``."""
+    if "\r" in value:
+        value = value.replace("\r\n", "\n").replace("\r", "\n")
+    return value.translate(_TEXT_ESCAPES)
+
+
+def fold(line: str) -> bytes:
+    """Encode one content line, folded at ``LINE_LIMIT`` octets."""
+    data = line.encode()
+    if len(data) <= LINE_LIMIT:
+        return data + b"\r\n"
+
+    chunks = []
+    start = 0
+    limit = LINE_LIMIT
+    while start < len(data):
+        end = min(start + limit, len(data))
+        # Never fold inside a multi-byte UTF-8 sequence.
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(data[start:end])
+        start = end
+        # Continuation lines start with a space that counts towards the limit.
+        limit = LINE_LIMIT - 1
+    return b"\r\n ".join(chunks) + b"\r\n"
+
+
+def text(name: str, value: str) -> bytes:
+    """Content line for a TEXT property."""
+    return fold(f"{name}:{escape(value)}")
+
+
+def line(name: str, value: str) -> bytes:
+    """Content line for a value that is already formatted, such as a RECUR."""
+    return fold(f"{name}:{value}")
+
+
+def utc(value: datetime.datetime) -> str:
+    """DATE-TIME value in UTC, naive values are taken to be UTC already."""
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.UTC)
+    return (
+        f"{value.year:04d}{value.month:02d}{value.day:02d}"
+        f"T{value.hour:02d}{value.minute:02d}{value.second:02d}Z"
+    )
+
+
+def when(name: str, value: datetime.date) -> bytes:
+    """Content line for a DATE, or for a DATE-TIME written in UTC."""
+    if isinstance(value, datetime.datetime):
+        return f"{name}:{utc(value)}\r\n".encode()
+    return (
+        f"{name};VALUE=DATE:{value.year:04d}{value.month:02d}{value.day:02d}\r\n"
+    ).encode()
+
+
+EVENT_END = b"END:VEVENT\r\n"
+
+
+def event(*lines: bytes) -> bytes:
+    """VEVENT component made of already written content lines."""
+    return b"".join((b"BEGIN:VEVENT\r\n", *lines, EVENT_END))
+
+
+def event_start(*lines: bytes) -> bytes:
+    """Unterminated VEVENT, to be completed with more lines and ``EVENT_END``."""
+    return b"".join((b"BEGIN:VEVENT\r\n", *lines))
+
+
+def calendar(properties: Iterable[bytes], events: Iterable[bytes]) -> Iterator[bytes]:
+    """Chunks of a VCALENDAR with ``properties`` followed by ``events``."""
+    yield b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"
+    yield text("PRODID", PRODID)
+    yield from properties
+    yield from events
+    yield b"END:VCALENDAR\r\n"
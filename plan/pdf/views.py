@@ -12,7 +12,7 @@ from django import http, shortcuts
 from django.utils import dateformat, html, translation
 
 from plan.common import utils
-from plan.common.models import Course, Lecture, Room
+from plan.common.catalog import get_schedule_rows
 from plan.common.models import Student
 from plan.common.snapshot import (
     ScheduleSnapshot,
@@ -20,7 +20,7 @@ from plan.common.snapshot import (
     get_schedule_snapshot,
 )
 from plan.common.templatetags.title import render_title
-from plan.common.timetable import Timetable
+from plan.common.timetable import get_timetable
 from plan.common.utils import ColorMap
 
 outer_border = colors.HexColor("#666666")
@@ -118,31 +118,18 @@ def pdf(request, semester, slug, size=None, week=None):
     day_width = (width - time_width) / 5
 
     with tracer.start_as_current_span("PDF DATA"):
-        # NOTE: This could be cached, and shared with schedule, but to be honest I
-        # doubt it is worth it for this code path.
-        lectures = Lecture.objects.get_lectures_data(
-            snapshot.semester.id,
-            snapshot.student.id,
-        )
-        lecture_ids = [lecture.lecture_id for lecture in lectures]
-        rooms = Lecture.get_related(Room, lecture_ids)
-        courses = Course.objects.get_courses(
-            snapshot.semester.year,
-            snapshot.semester.type,
-            snapshot.student.slug,
-        )
-
-        for course in courses:
+        rows = get_schedule_rows(snapshot.semester, snapshot.student.id)
+        lectures = rows.lectures
+        rooms = {
+            lecture_id: [room["name"] for room in lecture_rooms]
+            for lecture_id, lecture_rooms in rows.rooms.items()
+        }
+
+        for course in rows.courses:
             color_map[course.id]
 
     with tracer.start_as_current_span("PDF TIMETABLE BUILD"):
-        timetable = Timetable(lectures)
-        if lectures:
-            timetable.place_lectures(week)
-            timetable.do_expansion()
-        timetable.insert_times()
-        if week:
-            timetable.set_week(snapshot.semester.year, week)
+        timetable = get_timetable(snapshot, lectures, week)
 
     with tracer.start_as_current_span("PDF TITLE"):
         paragraph_style = default_styles["Normal"]
@@ -19,6 +19,12 @@ class TelemetryComponent(StrEnum):
     METRICS = "metrics"
 
 
+class CacheWriteQueuePolicy(StrEnum):
+    DROP_NEW = "drop_new"
+    DROP_OLDEST = "drop_oldest"
+    WRITE_THROUGH = "write_through"
+
+
 class Settings(ParsedEnvSettings):
     model_config = SettingsConfigDict(env_prefix="", extra="ignore")
 
@@ -77,6 +83,18 @@ class Settings(ParsedEnvSettings):
         3 * 24 * 60 * 60,
         validation_alias="TIMETABLE_SEMESTER_FRESHNESS_CACHE_DEFAULT_TTL",
     )
+    timetable_snapshot_cache_revalidate_after: int | None = Field(
+        None,
+        validation_alias="TIMETABLE_SNAPSHOT_CACHE_REVALIDATE_AFTER",
+    )
+    timetable_semester_freshness_cache_revalidate_after: int | None = Field(
+        None,
+        validation_alias="TIMETABLE_SEMESTER_FRESHNESS_CACHE_REVALIDATE_AFTER",
+    )
+    timetable_local_cache_ttl: int | None = Field(
+        None,
+        validation_alias="TIMETABLE_LOCAL_CACHE_TTL",
+    )
     timetable_location_cache_ttl: int = Field(
         24 * 60 * 60,
         validation_alias="TIMETABLE_LOCATION_CACHE_TTL",
@@ -89,6 +107,41 @@ class Settings(ParsedEnvSettings):
         5 * 60,
         validation_alias="TIMETABLE_COURSE_STATS_CACHE_TTL",
     )
+    timetable_layout_cache_default_ttl: int = Field(
+        24 * 60 * 60,
+        validation_alias="TIMETABLE_LAYOUT_CACHE_DEFAULT_TTL",
+    )
+    timetable_course_catalog_cache_default_ttl: int | None = Field(
+        24 * 60 * 60,
+        validation_alias="TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL",
+    )
+    timetable_fragment_cache_default_ttl: int | None = Field(
+        24 * 60 * 60,
+        validation_alias="TIMETABLE_FRAGMENT_CACHE_DEFAULT_TTL",
+    )
+    timetable_ical_fragment_cache_default_ttl: int | None = Field(
+        24 * 60 * 60,
+        validation_alias="TIMETABLE_ICAL_FRAGMENT_CACHE_DEFAULT_TTL",
+    )
+    timetable_cache_write_workers: int = Field(
+        2, validation_alias="TIMETABLE_CACHE_WRITE_WORKERS"
+    )
+    timetable_cache_write_queue_size: int = Field(
+        256, ge=1, validation_alias="TIMETABLE_CACHE_WRITE_QUEUE_SIZE"
+    )
+    timetable_cache_write_queue_policy: CacheWriteQueuePolicy = Field(
+        CacheWriteQueuePolicy.DROP_OLDEST,
+        validation_alias="TIMETABLE_CACHE_WRITE_QUEUE_POLICY",
+    )
+    timetable_ical_rate_limit_burst: int | None = Field(
+        10, validation_alias="TIMETABLE_ICAL_RATE_LIMIT_BURST"
+    )
+    timetable_ical_rate_limit_interval: float = Field(
+        60, validation_alias="TIMETABLE_ICAL_RATE_LIMIT_INTERVAL"
+    )
+    timetable_ical_rate_limit_cache: str | None = Field(
+        None, validation_alias="TIMETABLE_ICAL_RATE_LIMIT_CACHE"
+    )
 
     pgdatabase: str = Field("plan", validation_alias="PGDATABASE")
     pguser: str = Field("plan", validation_alias="PGUSER")
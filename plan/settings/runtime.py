@@ -83,7 +83,7 @@ MIDDLEWARE = (
     "plan.common.middleware.CspMiddleware",
     "plan.common.middleware.AppendSlashMiddleware",
     "plan.common.middleware.locale_middleware",
-    "plan.common.middleware.HtmlMinifyMiddleware",
+    "plan.common.middleware.ContentLengthMiddleware",
 )
 
 INSTALLED_APPS = (
@@ -109,7 +109,7 @@ TEMPLATES = [
         "OPTIONS": {
             "loaders": (
                 (
-                    "django.template.loaders.cached.Loader",
+                    "plan.common.loaders.MinifyingLoader",
                     (
                         "django.template.loaders.filesystem.Loader",
                         "django.template.loaders.app_directories.Loader",
@@ -130,9 +130,15 @@ CACHES = {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
         "KEY_PREFIX": "",
     },
+    "local": {
+        "BACKEND": "plan.common.local_cache.LocalLRUCache",
+        "OPTIONS": {
+            "MAX_BYTES": 16 * 1024 * 1024,
+        },
+    },
     "disk": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": "./cache/disk",
+        "BACKEND": "plan.common.sqlite_cache.SQLiteCache",
+        "LOCATION": "./cache/sqlite/disk",
         "TIMEOUT": timedelta(days=7).total_seconds(),
         "KEY_PREFIX": "disk",
         "OPTIONS": {
@@ -140,8 +146,8 @@ CACHES = {
         },
     },
     "scraper": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": "./cache/scraper",
+        "BACKEND": "plan.common.sqlite_cache.SQLiteCache",
+        "LOCATION": "./cache/sqlite/scraper",
         "TIMEOUT": timedelta(days=7).total_seconds(),
         "KEY_PREFIX": "scraper",
         "OPTIONS": {
@@ -229,6 +235,11 @@ TIMETABLE_SLOTS = [
     (time(19, 15), time(20, 0)),
 ]
 
+# Set to a number of minutes to lay out lectures by their actual start and end
+# times in rows of that length, instead of pigeonholing them into the slots
+# above. The slots still set the hours that are always shown.
+TIMETABLE_SLOT_MINUTES = None
+
 # Available scrapers for loading data into plan. can be run using
 # './manage.py scrape <type>' where type is one of the keys bellow.
 TIMETABLE_SCRAPERS = {
@@ -302,11 +313,60 @@ TIMETABLE_SNAPSHOT_CACHE_DISK_TTL = None
 # Timeout for semester-wide freshness metadata in the default cache.
 TIMETABLE_SEMESTER_FRESHNESS_CACHE_DEFAULT_TTL = None
 
+# Age after which cached snapshot and semester freshness entries are refreshed
+# in the background while still being served, until the TTLs above expire.
+# Set to None to only rebuild them on expiry.
+TIMETABLE_SNAPSHOT_CACHE_REVALIDATE_AFTER = None
+TIMETABLE_SEMESTER_FRESHNESS_CACHE_REVALIDATE_AFTER = None
+
+# Optional timeout for small, hot values such as semester freshness and
+# locations kept in each process in front of the default cache. Deletes only
+# reach the current process, so keep this short. Set to None to disable.
+TIMETABLE_LOCAL_CACHE_TTL = None
+
 # Timeouts for other values stored in the default cache backend.
 TIMETABLE_LOCATION_CACHE_TTL = None
 TIMETABLE_SCHEDULE_DATA_CACHE_TTL = None
 TIMETABLE_COURSE_STATS_CACHE_TTL = None
 
+# Timeout for timetable layouts, keyed by schedule freshness and week, in the
+# default cache backend.
+TIMETABLE_LAYOUT_CACHE_DEFAULT_TTL = None
+
+# Timeout for per-course lecture catalogs shared by all students, keyed by
+# semester version, in the default cache backend. Set to None to load each
+# student's schedule data with a single query instead.
+TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL = None
+
+# Timeout for rendered schedule page fragments in the disk cache. The lecture
+# list and course table are keyed by schedule freshness, the timetable also by
+# week, so most schedule page misses only render the page around them. Set to
+# None to render every fragment for each page.
+TIMETABLE_FRAGMENT_CACHE_DEFAULT_TTL = None
+
+# Timeout for serialized iCal lecture events in the default cache backend,
+# keyed by semester version and shared by all subscribers of a lecture. Set to
+# None to serialize every lecture for each feed.
+TIMETABLE_ICAL_FRAGMENT_CACHE_DEFAULT_TTL = None
+
+# Background threads writing queued cache entries, such as iCal responses,
+# the most entries each process keeps waiting, and what happens to new entries
+# when it is full: "drop_new", "drop_oldest" or "write_through" on the request
+# thread.
+TIMETABLE_CACHE_WRITE_WORKERS = 2
+TIMETABLE_CACHE_WRITE_QUEUE_SIZE = 256
+TIMETABLE_CACHE_WRITE_QUEUE_POLICY = "drop_oldest"
+
+# iCal polls each client may make of a feed in a row, and the seconds it then
+# has to wait for each following poll. Only polls that miss the response cache
+# are counted, and throttled clients get a 429. Set the burst to None to allow
+# any rate.
+# Polls are only counted per process, unless a cache alias shared by the
+# workers, such as "disk", is set as the rate limit cache.
+TIMETABLE_ICAL_RATE_LIMIT_BURST = None
+TIMETABLE_ICAL_RATE_LIMIT_INTERVAL = 60
+TIMETABLE_ICAL_RATE_LIMIT_CACHE = None
+
 # Freshness updates advance at least one whole second, matching HTTP-date
 # precision and keeping If-Modified-Since revalidation safe after mutations.
 TIMETABLE_ENABLE_IF_MODIFIED_SINCE = True
@@ -347,9 +407,30 @@ TIMETABLE_SNAPSHOT_CACHE_DISK_TTL = env.timetable_snapshot_cache_disk_ttl
 TIMETABLE_SEMESTER_FRESHNESS_CACHE_DEFAULT_TTL = (
     env.timetable_semester_freshness_cache_default_ttl
 )
+TIMETABLE_SNAPSHOT_CACHE_REVALIDATE_AFTER = (
+    env.timetable_snapshot_cache_revalidate_after
+)
+TIMETABLE_SEMESTER_FRESHNESS_CACHE_REVALIDATE_AFTER = (
+    env.timetable_semester_freshness_cache_revalidate_after
+)
+TIMETABLE_LOCAL_CACHE_TTL = env.timetable_local_cache_ttl
 TIMETABLE_LOCATION_CACHE_TTL = env.timetable_location_cache_ttl
 TIMETABLE_SCHEDULE_DATA_CACHE_TTL = env.timetable_schedule_data_cache_ttl
 TIMETABLE_COURSE_STATS_CACHE_TTL = env.timetable_course_stats_cache_ttl
+TIMETABLE_LAYOUT_CACHE_DEFAULT_TTL = env.timetable_layout_cache_default_ttl
+TIMETABLE_COURSE_CATALOG_CACHE_DEFAULT_TTL = (
+    env.timetable_course_catalog_cache_default_ttl
+)
+TIMETABLE_FRAGMENT_CACHE_DEFAULT_TTL = env.timetable_fragment_cache_default_ttl
+TIMETABLE_ICAL_FRAGMENT_CACHE_DEFAULT_TTL = (
+    env.timetable_ical_fragment_cache_default_ttl
+)
+TIMETABLE_CACHE_WRITE_WORKERS = env.timetable_cache_write_workers
+TIMETABLE_CACHE_WRITE_QUEUE_SIZE = env.timetable_cache_write_queue_size
+TIMETABLE_CACHE_WRITE_QUEUE_POLICY = str(env.timetable_cache_write_queue_policy)
+TIMETABLE_ICAL_RATE_LIMIT_BURST = env.timetable_ical_rate_limit_burst
+TIMETABLE_ICAL_RATE_LIMIT_INTERVAL = env.timetable_ical_rate_limit_interval
+TIMETABLE_ICAL_RATE_LIMIT_CACHE = env.timetable_ical_rate_limit_cache
 
 DEBUG = env.django_debug
 TIMETABLE_REPORT_URI = env.timetable_report_uri
@@ -421,9 +502,15 @@ CACHES = {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
         "KEY_PREFIX": "plan",
     },
+    "local": {
+        "BACKEND": "plan.common.local_cache.LocalLRUCache",
+        "OPTIONS": {
+            "MAX_BYTES": 16 * 1024 * 1024,
+        },
+    },
     "disk": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": str(CACHE_DIR / "disk"),
+        "BACKEND": "plan.common.sqlite_cache.SQLiteCache",
+        "LOCATION": str(CACHE_DIR / "sqlite" / "disk"),
         "TIMEOUT": timedelta(days=7).total_seconds(),
         "KEY_PREFIX": "disk",
         "OPTIONS": {
@@ -431,8 +518,8 @@ CACHES = {
         },
     },
     "scraper": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": str(CACHE_DIR / "scraper"),
+        "BACKEND": "plan.common.sqlite_cache.SQLiteCache",
+        "LOCATION": str(CACHE_DIR / "sqlite" / "scraper"),
         "TIMEOUT": timedelta(days=7).total_seconds(),
         "KEY_PREFIX": env.plan_scraper_cache_key_prefix,
         "OPTIONS": {
@@ -60,6 +60,8 @@ _tracer = trace.get_tracer("plan.telemetry.cache")
 _meter = metrics.get_meter("plan.telemetry.cache")
 _duration = _meter.create_histogram("django.cache.operation.duration", unit="s")
 _operations = _meter.create_counter("django.cache.operations", unit="{operation}")
+_lookups = _meter.create_counter("django.cache.lookups", unit="{key}")
+_evictions = _meter.create_counter("django.cache.evictions", unit="{entry}")
 
 
 def _cache_operation(name: str) -> CacheOperation | None:
@@ -109,9 +111,9 @@ def _metric_backend(cache: BaseCache) -> CacheBackend:
     match type(cache).__name__:
         case "PyLibMCCache":
             return "memcached"
-        case "FileBasedCache":
+        case "FileBasedCache" | "SQLiteCache":
             return "file"
-        case "LocMemCache":
+        case "LocMemCache" | "LocalLRUCache":
             return "memory"
         case _:
             return "other"
@@ -168,11 +170,17 @@ def _record(
                 span_attributes["cache.hit"] = cache_hit
                 metric_attributes["cache.hit"] = cache_hit
                 span.set_attribute("cache.hit", cache_hit)
+                _lookups.add(1, metric_attributes)
             elif operation == "get_many":
                 span_attributes["cache.hit_count"] = len(result)
                 span_attributes["cache.miss_count"] = span_attributes.get(
                     "cache.batch.size", 0
                 ) - len(result)
+                _record_lookups(
+                    metric_attributes,
+                    span_attributes["cache.hit_count"],
+                    span_attributes["cache.miss_count"],
+                )
             return result
         finally:
             elapsed = time.perf_counter() - start
@@ -180,6 +188,22 @@ def _record(
             _operations.add(1, metric_attributes)
 
 
+def _record_lookups(attributes: MetricAttributes, hits: int, misses: int) -> None:
+    if hits:
+        _lookups.add(hits, {**attributes, "cache.hit": True})
+    if misses:
+        _lookups.add(misses, {**attributes, "cache.hit": False})
+
+
+def record_evictions(cache: BaseCache, count: int) -> None:
+    """Count entries a backend dropped to stay within its size bounds."""
+    attributes = {
+        "cache.alias": str(getattr(cache, "_plan_telemetry_alias", "unknown")),
+        "cache.backend": _metric_backend(cache),
+    }
+    _evictions.add(count, attributes)
+
+
 def _call_cache_operation(
     operation: CacheOperation,
     function: Callable[..., T],
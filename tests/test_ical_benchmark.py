@@ -0,0 +1,89 @@
+"""iCal serialization baselines, the writer compared with vobject."""
+
+import datetime
+
+import pytest
+import vobject
+from dateutil import rrule
+
+from django import template
+from django.test import RequestFactory
+
+from plan.common.catalog import get_schedule_rows
+from plan.common.models import Semester
+from plan.common.snapshot import get_schedule_snapshot
+from plan.ical import views, writer
+
+DTSTAMP = datetime.datetime(2026, 1, 1, tzinfo=datetime.UTC)
+
+
+def _rows():
+    semester = Semester.objects.get(year=2026, type=Semester.SPRING)
+    snapshot = get_schedule_snapshot(semester, "debug")
+    return semester, get_schedule_rows(semester, snapshot.student.id)
+
+
+def _serialize_with_writer(semester, rows, request):
+    events = views.add_lectutures(
+        rows.lectures, rows.rooms, semester, request, "example.com", DTSTAMP
+    )
+    return b"".join(writer.calendar([writer.text("METHOD", "PUBLISH")], events))
+
+
+def _serialize_with_vobject(semester, rows, request):
+    """The vobject calendar the writer replaced, one component per occurrence."""
+    cal = vobject.iCalendar()
+    cal.add("method").value = "PUBLISH"
+    for lecture in rows.lectures:
+        if lecture.exclude or not lecture.week_numbers:
+            continue
+        rooms = rows.rooms.get(lecture.lecture_id, [])
+        desc = views.DESCRIPTION_TEXT.render(
+            template.Context({"lecture": lecture, "rooms": rooms})
+        )
+        for d in rrule.rrule(
+            rrule.WEEKLY,
+            byweekno=list(lecture.week_numbers),
+            count=len(lecture.week_numbers),
+            byweekday=lecture.day,
+            dtstart=datetime.datetime(semester.year, 1, 1),
+        ):
+            vevent = cal.add("vevent")
+            vevent.add("summary").value = lecture.alias or lecture.course_code
+            vevent.add("location").value = ", ".join(r["name"] for r in rooms)
+            vevent.add("description").value = desc
+            vevent.add("dtstart").value = views._to_utc(
+                d.replace(hour=lecture.start.hour, minute=lecture.start.minute)
+            )
+            vevent.add("dtend").value = views._to_utc(
+                d.replace(hour=lecture.end.hour, minute=lecture.end.minute)
+            )
+            vevent.add("dtstamp").value = DTSTAMP
+            vevent.add("uid").value = "lecture-%d-%s@example.com" % (
+                lecture.lecture_id,
+                d.strftime("%Y%m%d"),
+            )
+    return cal.serialize()
+
+
+@pytest.mark.benchmark
+def test_ical_writer_serialize(benchmark, benchmark_schedule_data, cache_isolation):
+    """Measure building and serializing lecture events with the writer."""
+    semester, rows = _rows()
+    request = RequestFactory().get("/")
+
+    body = benchmark(_serialize_with_writer, semester, rows, request)
+
+    assert body.count(b"BEGIN:VEVENT") > 0
+
+
+@pytest.mark.benchmark
+def test_ical_vobject_serialize(benchmark, benchmark_schedule_data, cache_isolation):
+    """vobject baseline for test_ical_writer_serialize, same events."""
+    semester, rows = _rows()
+    request = RequestFactory().get("/")
+
+    body = benchmark(_serialize_with_vobject, semester, rows, request)
+
+    expected = _serialize_with_writer(semester, rows, request)
+    assert body.count("BEGIN:VEVENT") == expected.count(b"BEGIN:VEVENT")
@@ -1,12 +1,13 @@
 """Repeatable response-cache-miss baselines for schedule rendering."""
 
+import pickle
 from dataclasses import replace
 
 import pytest
 
 from django.urls import reverse
 
-from plan.common import timetable, views
+from plan.common import codec, timetable, views
 from plan.common.models import Semester
 from plan.common.snapshot import get_schedule_snapshot
 from plan.common.table_render import render_lectures_table, render_schedule_table
@@ -131,3 +132,35 @@ def test_worst_case_non_template_lectures_table(
     )
 
     assert 'id="lectures"' in rendered
+
+
+def _benchmark_schedule_data():
+    semester = Semester.objects.get(year=2026, type=Semester.SPRING)
+    return views._schedule_data(get_schedule_snapshot(semester, "debug"))
+
+
+@pytest.mark.benchmark
+def test_schedule_data_codec_decode(
+    benchmark, benchmark_schedule_data, cache_isolation
+):
+    """Measure decoding cached schedule data, compare with pickle below."""
+    data = _benchmark_schedule_data()
+    payload = codec.encode_schedule_data(data)
+
+    decoded = benchmark(codec.decode_schedule_data, payload)
+
+    assert decoded.lectures == data.lectures
+    assert len(payload) < len(pickle.dumps(data))
+
+
+@pytest.mark.benchmark
+def test_schedule_data_pickle_decode(
+    benchmark, benchmark_schedule_data, cache_isolation
+):
+    """Pickle baseline for test_schedule_data_codec_decode."""
+    data = _benchmark_schedule_data()
+    payload = pickle.dumps(data)
+
+    decoded = benchmark(pickle.loads, payload)
+
+    assert decoded.lectures == data.lectures
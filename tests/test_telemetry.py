@@ -277,6 +277,7 @@ def test_multi_cache_get_contains_layer_operations(
         "cache.hit.layer": "disk",
         "cache.miss.count": 1,
         "cache.promoted": True,
+        "cache.stale": False,
     }
     assert {
         (span.name, span.attributes["cache.alias"], span.attributes.get("cache.hit"))
@@ -0,0 +1,27 @@
+import json, os, hashlib
+from plan.common import timetable, views
+from plan.common.models import Semester
+from plan.common.snapshot import get_schedule_snapshot
+from plan.common.table_render import render_schedule_table
+
+GOLDEN = "/tmp/golden/golden.json"
+
+def _build(lectures, week, year):
+    return timetable.WeekLayouts(lectures).timetable(year, week)
+
+def test_golden(benchmark_schedule_data, cache_isolation):
+    semester = Semester.objects.get(year=2026, type=Semester.SPRING)
+    snapshot = get_schedule_snapshot(semester, "debug")
+    data = views._schedule_data(snapshot)
+    out = {}
+    for week in [None] + list(data.weeks):
+        t = _build(data.lectures, week, semester.year)
+        html = render_schedule_table(t, data.rooms, snapshot, None, None)
+        lect = [(d["i"], d["j"], d["k"], d["height"], d.get("width"), d["l"].lecture_id) for d in t.lectures]
+        out[str(week)] = [hashlib.sha256(html.encode()).hexdigest(), lect, list(t.span)]
+    if os.environ.get("GOLDEN_WRITE"):
+        json.dump(out, open(GOLDEN, "w"))
+    else:
+        ref = json.load(open(GOLDEN))
+        assert ref == json.loads(json.dumps(out))
+    print("weeks", len(out), "lectures", len(data.lectures))